@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+""" run_benchmarks.py
+
+This script times the parsing, transform and load stages of the ETL on synthetic data,
+reporting rows/s and peak memory of each stage, and compares them against stored baselines.
+
+    python bench/run_benchmarks.py --scale 1 --baseline bench/baseline.json
+"""
+
+__author__ = "Alejandro de la Calle"
+__copyright__ = "Copyright 2019"
+__credits__ = [""]
+__license__ = ""
+__version__ = "0.1"
+__maintainer__ = "Alejandro de la Calle"
+__email__ = "alejandrodelacallenegro@gmail.com"
+__status__ = "Development"
+
+
+import os
+import sys
+import gc
+import json
+import time
+import tempfile
+import subprocess
+import importlib.util
+import tracemalloc
+from absl import flags, app, logging
+
+this_dir = os.path.dirname(os.path.realpath(__file__))
+root_dir = os.path.join(this_dir, '..')
+# The ETL scripts import their own 'tools' package (etl/tools)
+sys.path.insert(0, os.path.join(root_dir, 'etl'))
+sys.path.insert(0, this_dir)
+
+import synthetic
+
+
+def define_flags():
+    flags.DEFINE_float(name='scale', default=1., help='Size of the synthetic dataset, relative to the default one')
+    flags.DEFINE_string(name='data_path', default=None, help='Folder for the synthetic data. Temporary if not given')
+    flags.DEFINE_list(name='stages', default=None, help='Stages to run. All of them if not given')
+    flags.DEFINE_integer(name='repeat', default=3, help='Runs of each stage. The fastest one is reported')
+    flags.DEFINE_string(name='baseline', default=None, help='Json file with the baseline rows/s of each stage')
+    flags.DEFINE_boolean(name='update_baseline', default=False, help='Store the results as the new baseline')
+    flags.DEFINE_float(name='tolerance', default=0.2, help='Slowdown over the baseline flagged as a regression')
+    flags.DEFINE_string(name='mongo_host', default=None, help='Host of a mongod to load into. mongomock if not given')
+    flags.DEFINE_integer(name='mongo_port', default=27017, help='Port of the mongod to load into')
+    flags.DEFINE_string(name='output', default=None, help='Json file where the results are written')
+    flags.DEFINE_float(name='startup_budget', default=0.3,
+                       help='Seconds allowed to start the smoggy entry point and to import the codes. Not checked if 0')
+
+
+def load_module(name, path):
+    # Modules of the analysis 'tools' package, loaded by path so they do not clash with etl/tools
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def get_database(host=None, port=None):
+    if host is None:
+        import mongomock
+        return mongomock.MongoClient()['smoggy_bench']
+    from tools import database as db
+    client = db.get_shared_client(host, port)
+    client.drop_database('smoggy_bench')
+    return client['smoggy_bench']
+
+
+def get_stages(paths, database):
+    """ Stages as name -> (setup, run). setup prepares the inputs outside of the timing, and
+    run returns the number of rows processed. """
+    import etl_calendar
+    import etl_traffic
+    import etl_weather
+    from tools import etl_utils, database as db
+    timeseries = load_module('smoggy_timeseries', os.path.join(root_dir, 'tools', 'timeseries.py'))
+
+    def parse_txt(_):
+        return len(etl_utils.parse_pollution_txt(paths['txt']))
+
+    def parse_csv(_):
+        return len(etl_utils.parse_pollution_csv(paths['csv']))
+
+    def hourly_series(df):
+        return len(timeseries.to_hourly_series(df))
+
+    def pmed_locations(dfs):
+        return sum(len(dd) for dd in etl_traffic.get_location_for_pmeds(dfs))
+
+    def count_density_rows():
+        with open(paths['density'], 'r', encoding='latin1') as f:
+            return sum(1 for _ in f) - 1
+
+    def traffic_hourly(nrows):
+        etl_traffic.aggregate_traffic_file_hourly(paths['density'])
+        return nrows
+
+    def calendar(_):
+        return len(etl_calendar.get_calendar_from_source(os.path.dirname(paths['calendar'])))
+
+    def weather_parse(_):
+        batches = etl_weather.iter_batches(etl_weather.iter_json_records(paths['aemet']), 10000)
+        return sum(len(etl_weather.coerce_weather_batch(batch)) for batch in batches)
+
+    def load_density(records):
+        database.drop_collection('density')
+        return db.bulk_insert_documents(database, 'density', records, batch_size=10000)['inserted']
+
+    def read_density():
+        return next(etl_traffic.read_traffic_density_chunks(paths['density'])).to_dict(orient='records')
+
+    return {'parse_txt': (lambda: None, parse_txt),
+            'parse_csv': (lambda: None, parse_csv),
+            'hourly_series': (lambda: etl_utils.parse_pollution_txt(paths['txt']), hourly_series),
+            'pmed_locations': (lambda: etl_traffic.get_pmed_dataframes_from_paths(os.path.dirname(
+                os.path.dirname(paths['pmed']))), pmed_locations),
+            'traffic_hourly': (count_density_rows, traffic_hourly),
+            'calendar': (lambda: None, calendar),
+            'weather_parse': (lambda: None, weather_parse),
+            'load_density': (read_density, load_density)}
+
+
+def measure(setup, run, repeat):
+    """ Fastest wall time of repeat runs, and peak of the memory allocated by the stage.
+    tracemalloc slows the code down, so the peak is taken in an extra run that is not timed. """
+    inputs = setup()
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        rows = run(inputs)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    gc.collect()
+    tracemalloc.start()
+    run(inputs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'rows': rows, 'seconds': best, 'rows_per_second': rows / best if best > 0 else 0.,
+            'peak_mb': peak / 2**20}
+
+
+def measure_startup(repeat):
+    # Fastest wall time of fresh interpreters running the cheap paths that cron hits most
+    commands = {'smoggy_help': [sys.executable, os.path.join(root_dir, 'etl', 'smoggy.py'), '--help'],
+                'import_codes': [sys.executable, '-c', 'import tools.codes']}
+    results = {}
+    for name, command in commands.items():
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run(command, cwd=root_dir, check=True, stdout=subprocess.DEVNULL)
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        results[name] = best
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    regressions = []
+    for stage, result in results.items():
+        if stage in baseline and result['rows_per_second'] < baseline[stage] * (1. - tolerance):
+            regressions.append(stage)
+    return regressions
+
+
+def main(argv):
+    logging.info('=' * 80)
+    logging.info(' ' * 20 + 'ETL benchmarks')
+    logging.info('=' * 80)
+
+    data_path = FLAGS.data_path or tempfile.mkdtemp(prefix='smoggy_bench_')
+    logging.info('Writing synthetic data (scale {}) to {}'.format(FLAGS.scale, data_path))
+    paths = synthetic.write_dataset(data_path, scale=FLAGS.scale)
+
+    stages = get_stages(paths, get_database(FLAGS.mongo_host, FLAGS.mongo_port))
+    names = FLAGS.stages or list(stages.keys())
+
+    results = {}
+    for name in names:
+        setup, run = stages[name]
+        results[name] = measure(setup, run, FLAGS.repeat)
+        logging.info('{:<16} {:>10d} rows {:>8.3f} s {:>12.0f} rows/s {:>9.1f} MB peak'.format(
+            name, results[name]['rows'], results[name]['seconds'], results[name]['rows_per_second'],
+            results[name]['peak_mb']))
+
+    startup = {}
+    if FLAGS.startup_budget > 0:
+        startup = measure_startup(FLAGS.repeat)
+        for name, seconds in startup.items():
+            logging.info('{:<16} {:>8.3f} s startup'.format(name, seconds))
+        over_budget = [name for name, seconds in startup.items() if seconds > FLAGS.startup_budget]
+        for name in over_budget:
+            logging.error('Startup of {} over budget: {:.3f} s against {:.3f} s'.format(
+                name, startup[name], FLAGS.startup_budget))
+
+    if FLAGS.output is not None:
+        with open(FLAGS.output, 'w') as f:
+            json.dump({'scale': FLAGS.scale, 'results': results, 'startup': startup}, f, indent=1)
+
+    if FLAGS.baseline is not None:
+        baseline = {}
+        if os.path.exists(FLAGS.baseline):
+            with open(FLAGS.baseline, 'r') as f:
+                baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline, FLAGS.tolerance)
+        for stage in regressions:
+            logging.error('Regression in {}: {:.0f} rows/s against a baseline of {:.0f} rows/s'.format(
+                stage, results[stage]['rows_per_second'], baseline[stage]))
+        if FLAGS.update_baseline:
+            baseline.update({stage: result['rows_per_second'] for stage, result in results.items()})
+            with open(FLAGS.baseline, 'w') as f:
+                json.dump(baseline, f, indent=1, sort_keys=True)
+            logging.info('Baseline updated')
+        elif len(regressions) > 0:
+            sys.exit(1)
+
+    logging.info('=' * 80)
+    if FLAGS.startup_budget > 0 and len(over_budget) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    FLAGS = flags.FLAGS
+    define_flags()
+    app.run(main)
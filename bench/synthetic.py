@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+""" synthetic.py
+
+This module generates synthetic source files in the formats of the open data sources
+(pollution txt and csv, pmed and traffic density csv, AEMET json and calendar csv), at any
+scale, for benchmarking the ETL.
+"""
+
+__author__ = "Alejandro de la Calle"
+__copyright__ = "Copyright 2019"
+__credits__ = [""]
+__license__ = ""
+__version__ = "0.1"
+__maintainer__ = "Alejandro de la Calle"
+__email__ = "alejandrodelacallenegro@gmail.com"
+__status__ = "Development"
+
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+
+stations = ['004', '008', '011', '016', '017', '018', '024', '027', '035', '036', '038', '039', '040', '047',
+            '048', '049', '050', '054', '055', '056', '057', '058', '059', '060']
+magnitudes = ['01', '06', '07', '08', '09', '10', '12', '14']
+
+
+def pollution_rows(nrows, seed=0):
+    # Station, magnitude and day of nrows consecutive daily records
+    rng = np.random.default_rng(seed)
+    days = pd.date_range('2001-01-01', periods=nrows // (len(stations) * len(magnitudes)) + 1, freq='D')
+    station = np.resize(np.repeat(stations, len(magnitudes)), nrows)
+    magnitude = np.resize(np.tile(magnitudes, len(stations)), nrows)
+    day = days[np.arange(nrows) // (len(stations) * len(magnitudes))]
+    values = rng.integers(0, 500, size=(nrows, 24))
+    valid = rng.random((nrows, 24)) < 0.97
+    return station, magnitude, day, values, valid
+
+
+def write_pollution_txt(path, nrows, seed=0):
+    # Fixed-width format: header of 20 characters, then 24 hours of 5 digits plus a V/N flag
+    station, magnitude, day, values, valid = pollution_rows(nrows, seed)
+    # Province and municipality, station, magnitude, technique, period and date
+    header = np.char.add(np.char.add(np.char.add('28079', station), np.char.add(magnitude, '3804')),
+                         day.strftime('%y%m%d').to_numpy().astype(str))
+    hours = np.char.add(np.char.zfill(values.astype(str), 5), np.where(valid, 'V', 'N'))
+    lines = [h + ''.join(row) for h, row in zip(header.tolist(), hours.tolist())]
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def write_pollution_csv(path, nrows, seed=0):
+    station, magnitude, day, values, valid = pollution_rows(nrows, seed)
+    df = pd.DataFrame({'PROVINCIA': 28, 'MUNICIPIO': 79, 'ESTACION': station.astype(int),
+                       'MAGNITUD': magnitude.astype(int),
+                       'PUNTO_MUESTREO': ['28079{}_{}_6'.format(s, int(m)) for s, m in zip(station, magnitude)],
+                       'ANO': day.year, 'MES': day.month, 'DIA': day.day})
+    for h in range(24):
+        df['H{:02d}'.format(h + 1)] = values[:, h].astype(np.float64)
+        df['V{:02d}'.format(h + 1)] = np.where(valid[:, h], 'V', 'N')
+    df.to_csv(path, sep=';', index=False)
+
+
+def write_pmed_csv(path, npoints, seed=0):
+    # Measure points around the centre of Madrid, with UTM coordinates using decimal commas
+    rng = np.random.default_rng(seed)
+    x = 440000 + rng.normal(scale=3000, size=npoints)
+    y = 4474000 + rng.normal(scale=3000, size=npoints)
+    df = pd.DataFrame({'tipo_elem': rng.choice(['URB', 'M30'], npoints), 'id': np.arange(1000, 1000 + npoints),
+                       'cod_cent': ['{:05d}'.format(i) for i in range(npoints)],
+                       'nombre': ['Punto {}'.format(i) for i in range(npoints)],
+                       'utm_x': np.char.replace(np.round(x, 2).astype(str), '.', ','),
+                       'utm_y': np.char.replace(np.round(y, 2).astype(str), '.', ',')})
+    df.to_csv(path, sep=';', index=False, encoding='latin1')
+
+
+def write_density_csv(path, npoints, ndays, seed=0):
+    # 15-minute readings of every measure point
+    rng = np.random.default_rng(seed)
+    times = pd.date_range('2019-01-01', periods=ndays * 96, freq='15min').strftime('%Y-%m-%d %H:%M:%S')
+    n = npoints * len(times)
+    df = pd.DataFrame({'id': np.repeat(np.arange(1000, 1000 + npoints), len(times)),
+                       'fecha': np.tile(times.to_numpy(), npoints), 'tipo_elem': 'URB',
+                       'intensidad': rng.integers(0, 2000, n), 'ocupacion': rng.integers(0, 100, n),
+                       'carga': rng.integers(0, 100, n), 'vmed': 0,
+                       'error': np.where(rng.random(n) < 0.99, 'N', 'E'), 'periodo_integracion': 15})
+    df.to_csv(path, sep=';', index=False)
+
+
+def aemet_records(ndays, station='3195', seed=0):
+    # Daily climate records as returned by AEMET: numbers as strings with decimal commas,
+    # and 'Ip' (inapreciable) for tiny amounts of rain
+    rng = np.random.default_rng(seed)
+    days = pd.date_range('2015-01-01', periods=ndays, freq='D').strftime('%Y-%m-%d')
+    tmed = np.round(rng.normal(15, 8, ndays), 1)
+    prec = np.round(rng.exponential(1., ndays), 1)
+    decimal = lambda x: str(round(x, 1)).replace('.', ',')
+    return [{'fecha': day, 'indicativo': station, 'nombre': 'MADRID, RETIRO', 'provincia': 'MADRID',
+             'altitud': '667', 'tmed': decimal(t), 'prec': 'Ip' if p < 0.1 else decimal(p),
+             'tmin': decimal(t - 5), 'horatmin': '06:10', 'tmax': decimal(t + 5), 'horatmax': '15:40',
+             'dir': '99', 'velmedia': '2,5', 'racha': '8,1', 'horaracha': 'Varias',
+             'presMax': '947,1', 'horaPresMax': '10', 'presMin': '940,2', 'horaPresMin': 'Varias'}
+            for day, t, p in zip(days, tmed, prec)]
+
+
+def write_aemet_json(path, ndays, station='3195', seed=0):
+    with open(path, 'w') as f:
+        json.dump(aemet_records(ndays, station, seed), f)
+
+
+def write_calendar_csv(path, ndays):
+    days = pd.date_range('2013-01-01', periods=ndays, freq='D')
+    kind = np.where(days.dayofweek == 6, 'domingo', np.where(days.dayofweek == 5, 'sabado', 'laborable'))
+    kind = np.where((days.month == 1) & (days.day == 1), 'festivo', kind)
+    df = pd.DataFrame({'Dia': days.strftime('%d/%m/%Y'), 'Dia_semana': days.day_name(),
+                       'laborable / festivo / domingo festivo': kind,
+                       'Tipo de Festivo': np.where(kind == 'festivo', 'Festivo nacional', ''),
+                       'Festividad': np.where(kind == 'festivo', 'Año Nuevo', '')})
+    df.to_csv(path, sep=';', index=False, encoding='latin1')
+
+
+def write_dataset(root, scale=1., seed=0):
+    """ Write every kind of source file under root, with sizes proportional to scale.
+    Returns a dict with the path of each of them. """
+    paths = {'txt': os.path.join(root, 'raw', 'Anio2001', 'datos01.txt'),
+             'csv': os.path.join(root, 'raw', 'Anio2002', 'datos02.csv'),
+             'pmed': os.path.join(root, 'pmed', 'pmed_ubicacion_01-2019', 'pmed_ubicacion_01-2019.csv'),
+             'density': os.path.join(root, 'density', '01-2019.csv'),
+             'aemet': os.path.join(root, 'weather', 'weather_Retiro_2015-01.json'),
+             'calendar': os.path.join(root, 'calendar', 'calendario.csv')}
+    for path in paths.values():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    write_pollution_txt(paths['txt'], int(50000 * scale), seed)
+    write_pollution_csv(paths['csv'], int(50000 * scale), seed)
+    write_pmed_csv(paths['pmed'], int(4000 * scale), seed)
+    write_density_csv(paths['density'], int(400 * scale) or 1, 7, seed)
+    write_aemet_json(paths['aemet'], int(3650 * scale) or 1, seed=seed)
+    write_calendar_csv(paths['calendar'], int(3650 * scale) or 1)
+    return paths
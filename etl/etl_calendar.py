@@ -3,18 +3,24 @@ import sys
 import pandas as pd
 import glob
 from absl import app, flags, logging
+from tools import cache
+from tools import metrics
 
 def define_flags():
     flags.DEFINE_string('source_path', default=None, help='Path to the data source')
+    flags.DEFINE_string('cache_dir', default=None, help='Path to the cache of parsed files')
+    metrics.define_flags()
 
-def get_calendar_from_source(source_path):
-    df = pd.read_csv(os.path.join(source_path, 'calendario.csv'),
-                     encoding='latin1', delimiter=';')
+def parse_calendar(calendar_file):
+    df = pd.read_csv(calendar_file, encoding='latin1', delimiter=';')
     df['Fecha'] = df['Dia'].apply(lambda x: pd.to_datetime(x, format='%d/%M/%Y'))
     df['Día'] = df['Fecha'].apply(lambda x: x.day)
     df['Mes'] = df['Fecha'].apply(lambda x: x.month)
     df['Año'] = df['Fecha'].apply(lambda x: x.year)
+    return df
 
+def get_calendar_from_source(source_path, cache_dir=None):
+    df = cache.load_cached(os.path.join(source_path, 'calendario.csv'), parse_calendar, cache_dir)
     return [val for val in df.drop(columns=['Fecha']).to_dict(orient='index').values()]
 
 
@@ -27,9 +33,15 @@ def main(argv):
         logging.error('Source path for input data must be provided.')
         sys.exit(1)
     logging.info('Data sourced from :' + FLAGS.source_path)
+    metrics.configure_from_flags(script='etl_calendar')
 
     logging.info('Extracting data...')
-    calendar = get_calendar_from_source(FLAGS.source_path)
+    with metrics.stage('extract_calendar') as stage:
+        calendar = get_calendar_from_source(FLAGS.source_path, FLAGS.cache_dir)
+        stage.add_files([os.path.join(FLAGS.source_path, 'calendario.csv')])
+        stage.rows_out = len(calendar)
+
+    metrics.log_summary()
 
     logging.info('ETL calendar process finished.')
     logging.info('=' * 80)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+""" etl_pollution.py
+
+This scipt loads the daily pollution records of the air quality stations (txt and csv
+files of the raw folders) to a mongo database.
+"""
+
+__author__ = "Alejandro de la Calle"
+__copyright__ = "Copyright 2019"
+__credits__ = [""]
+__license__ = ""
+__version__ = "0.1"
+__maintainer__ = "Alejandro de la Calle"
+__email__ = "alejandrodelacallenegro@gmail.com"
+__status__ = "Development"
+
+
+import sys
+import pandas as pd
+from absl import flags, app, logging
+from tools import database as db
+from tools import etl_utils as utils
+from tools.manifest import MongoManifest
+from tools import metrics
+
+
+def define_flags():
+    flags.DEFINE_string(name='source_path', default=None, help='Path to the folder with the raw/Anio* folders')
+    flags.DEFINE_string(name='cache_dir', default=None, help='Path to the cache of parsed files')
+    flags.DEFINE_integer(name='workers', default=None, help='Processes parsing files. All the cores if not given')
+    flags.DEFINE_string(name='mongo_host', default=None, help='Host of the mongo daemon')
+    flags.DEFINE_integer(name='mongo_port', default=None, help='Port of the mongo daemon')
+    metrics.define_flags()
+
+
+def iter_pollution_documents(df, chunksize=10000):
+    # One document per row, converted a slice of rows at a time. Rows are upserted on
+    # utils.pollution_keys
+    for start in range(0, len(df), chunksize):
+        yield from df.iloc[start:start + chunksize].to_dict(orient='records')
+
+
+def load_pollution_frames(files, frames, database, coll, batch_size=10000, workers=2, manifest=None):
+    """ Stream the rows of the frame parsed from each file into the collection. Files are
+    recorded in the manifest once loaded. Returns the writer stats. """
+    with db.BulkWriter(database, coll, batch_size=batch_size, workers=workers, keys=utils.pollution_keys) as writer:
+        for file, df in zip(files, frames):
+            failed = writer.failed
+            writer.extend(iter_pollution_documents(df, batch_size))
+            # Written before the file is recorded as loaded
+            writer.sync()
+            # Files with failed writes are loaded again in the next run
+            if manifest is not None and writer.failed == failed:
+                manifest.record(file)
+    return writer.stats()
+
+
+def get_ingest_scope(frames):
+    # Stations and days [start, end) of the parsed frames, for the ingest log
+    df = pd.concat([frame[['PROVINCIA', 'MUNICIPIO', 'ESTACION', 'ANO', 'MES', 'DIA']] for frame in frames])
+    stations = set(df['PROVINCIA'].astype(str) + df['MUNICIPIO'].astype(str) + df['ESTACION'].astype(str))
+    days = pd.to_datetime(pd.DataFrame({'year': df['ANO'].astype(int), 'month': df['MES'].astype(int),
+                                        'day': df['DIA'].astype(int)}))
+    return stations, days.min(), days.max() + pd.Timedelta(days=1)
+
+
+def main(argv):
+    logging.info('=' * 80)
+    logging.info(' ' * 20 + 'ETL pollution')
+    logging.info('=' * 80)
+
+    if FLAGS.source_path is None:
+        logging.error('Source path for input data must be provided.')
+        sys.exit(1)
+    metrics.configure_from_flags(script='etl_pollution')
+
+    client = db.connect_mongo_daemon(host=FLAGS.mongo_host, port=FLAGS.mongo_port)
+    aire = db.get_mongo_database(client, 'aire')
+    manifest = MongoManifest(aire, 'manifest')
+    db.ensure_indexes(aire, colls=['pollution', db.ingest_log_coll])
+
+    # Only files new or modified since the last run. They are recorded in the manifest once
+    # loaded, so a run that fails halfway loads them again.
+    txt_files, csv_files = utils.get_pollution_files(FLAGS.source_path)
+    files = manifest.pending(txt_files + csv_files)
+    logging.info('Extracting data from {} files...'.format(len(files)))
+    with metrics.stage('extract_pollution') as stage:
+        data, failures = utils.parse_pollution_files(files, workers=FLAGS.workers, cache_dir=FLAGS.cache_dir)
+        stage.add_files(files)
+        stage.rows_out = sum(len(df) for df in data)
+    for file, error in failures:
+        logging.error('Could not parse {}: {}'.format(file, error))
+    failed = set(file for file, _ in failures)
+    parsed = [file for file in files if file not in failed]
+
+    nrows = sum(len(df) for df in data)
+    try:
+        with metrics.stage('load_pollution', rows_in=nrows) as stage:
+            stats = load_pollution_frames(parsed, data, aire, 'pollution', manifest=manifest)
+            stage.add_write_stats(stats)
+            stage.rows_out = stats['inserted']
+    finally:
+        # Logged even if some writes failed or the load stopped part way, as the batches
+        # written did change the collection
+        if nrows > 0:
+            stations, start, end = get_ingest_scope(data)
+            db.log_ingest(aire, 'pollution', stations=stations, start=start, end=end)
+    logging.info('Upserted {inserted} pollution documents ({failed} failed)'.format(**stats))
+
+    metrics.log_summary()
+    logging.info('ETL pollution finished.')
+    logging.info('=' * 80)
+    if len(failures) > 0 or stats['failed'] > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    FLAGS = flags.FLAGS
+    define_flags()
+    app.run(main)
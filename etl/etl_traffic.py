@@ -17,22 +17,33 @@ __status__ = "Development"
 import numpy as np
 import pandas as pd
 import os
+import sys
 import glob
-from absl import logging
+from absl import flags, app, logging
+from pyproj import Transformer
 
 from tools import database as db
+from tools import cache
+from tools.manifest import MongoManifest, FileManifest
+from tools import metrics
 
 
+DATA_PATH = '/Users/adelacalle/Documents/master_data/data/trafico_madrid/ubicacion_puntos_medida/ubicacion'
+DENSITY_PATH = '/Users/adelacalle/Documents/master_data/data/trafico_madrid/intensidad_trafico/csv'
+
 ##################################################################################
 
-def get_pmed_dataframes_from_paths(path):
+def read_pmed_csv(file):
+    return pd.read_csv(file, delimiter=';', encoding='latin1')
+
+def get_pmed_dataframes_from_paths(path, cache_dir=None):
     if not os.path.exists(path):
         logging.error('Given path for pmed dataframes does not exists.')
         exit(1)
     else:
         folders = glob.glob(os.path.join(path, 'pmed*'))
         files = [glob.glob(os.path.join(folder,'*csv'))[0] for folder in folders]
-        dfs = [pd.read_csv(file, delimiter=';', encoding='latin1') for file in files]
+        dfs = [cache.load_cached(file, read_pmed_csv, cache_dir) for file in files]
     return dfs
 
 def get_traffic_density_dataframes_from_paths(path):
@@ -44,44 +55,204 @@ def get_traffic_density_dataframes_from_paths(path):
         dfs = [pd.read_csv(file, delimiter=';', encoding='latin1') for file in files]
     return dfs
 
+# Columns of the traffic density files. Older files name the measure point 'idelem'
+# and carry an extra 'identif' column instead of 'id'.
+density_dtypes = {'id': np.int32, 'idelem': np.int32, 'identif': str, 'fecha': str, 'tipo_elem': 'category',
+                  'intensidad': np.float32, 'ocupacion': np.float32, 'carga': np.float32, 'vmed': np.float32,
+                  'error': 'category', 'periodo_integracion': np.float32}
+
+# Fields identifying a density reading, used to upsert them
+density_keys = ['id', 'idelem', 'fecha']
+
+def get_traffic_density_files(path):
+    if not os.path.exists(path):
+        logging.error('Given path for density dataframes does not exists.')
+        exit(1)
+    return sorted(glob.glob(os.path.join(path, '*csv')))
+
+def read_traffic_density_chunks(file, chunksize=500000):
+    logging.info('Reading density file {}'.format(os.path.basename(file)))
+    reader = pd.read_csv(file, delimiter=';', encoding='latin1', chunksize=chunksize,
+                         usecols=lambda col: col in density_dtypes, dtype=density_dtypes)
+    for chunk in reader:
+        yield chunk
+
+def iter_traffic_density_chunks(path, chunksize=500000):
+    # Yield each density file in chunks of at most chunksize rows, so that memory
+    # does not depend on the size or number of files.
+    for file in get_traffic_density_files(path):
+        yield from read_traffic_density_chunks(file, chunksize=chunksize)
+
+def load_traffic_density(path, database, coll, chunksize=500000, batch_size=10000, workers=2, manifest=None):
+    # Stream the density files into the database chunk by chunk. With a manifest only new or
+    # modified files are loaded, and readings are upserted so that re-runs are idempotent.
+    files = get_traffic_density_files(path)
+    keys = None
+    if manifest is not None:
+        files = manifest.pending(files)
+        keys = density_keys
+        logging.info('{} density files to load'.format(len(files)))
+    with db.BulkWriter(database, coll, batch_size=batch_size, workers=workers, keys=keys) as writer:
+        for file in files:
+            failed = writer.failed
+            with metrics.stage('read_density:' + os.path.basename(file)) as stage:
+                stage.add_files([file])
+                stage.rows_out = 0
+                for chunk in read_traffic_density_chunks(file, chunksize=chunksize):
+                    if keys is not None:
+                        # Files have either 'id' or 'idelem', and the other key is stored as null
+                        for key in keys:
+                            if key not in chunk.columns:
+                                chunk[key] = None
+                    writer.extend(chunk.to_dict(orient='records'))
+                    stage.rows_out += len(chunk)
+            if manifest is not None:
+                writer.sync()
+                # Files with failed writes are loaded again in the next run
+                if writer.failed == failed:
+                    manifest.record(file)
+    return writer.stats()
+
+# Hourly aggregates of the 15-minute density readings. Partial aggregates (sum, count and
+# max) are computed per chunk and merged once per file, so only one month of compact
+# aggregates is held in memory at a time.
+hourly_fields = ['intensidad', 'ocupacion', 'carga']
+
+def partial_hourly_aggregates(chunk):
+    chunk = chunk.rename(columns={'idelem': 'id'})
+    # Readings flagged with an error are left out
+    if 'error' in chunk.columns:
+        chunk = chunk[chunk['error'] == 'N']
+    hour = pd.to_datetime(chunk['fecha'], format='%Y-%m-%d %H:%M:%S', errors='coerce').dt.floor('h')
+    fields = [field for field in hourly_fields if field in chunk.columns]
+    grouped = chunk[fields].groupby([chunk['id'].rename('id'), hour.rename('fecha')])
+    partial = pd.concat([grouped.sum().add_suffix('_sum'), grouped.count().add_suffix('_count'),
+                         grouped.max().add_suffix('_max')], axis=1)
+    return partial
+
+def merge_partial_aggregates(partials):
+    # A single reduction of all the partials, as merging them one at a time would group
+    # the growing aggregate again for every chunk
+    if len(partials) == 1:
+        return partials[0]
+    merged = pd.concat(partials)
+    how = {col: 'max' if col.endswith('_max') else 'sum' for col in merged.columns}
+    return merged.groupby(level=['id', 'fecha']).agg(how)
+
+def finalize_hourly_aggregates(partial):
+    hourly = pd.DataFrame(index=partial.index)
+    for field in hourly_fields:
+        if field + '_sum' in partial.columns:
+            hourly[field + '_mean'] = (partial[field + '_sum'] / partial[field + '_count']).astype(np.float32)
+            hourly[field + '_max'] = partial[field + '_max'].astype(np.float32)
+    hourly['nreadings'] = partial[[col for col in partial.columns if col.endswith('_count')]].max(axis=1).astype(np.int16)
+    return hourly.reset_index()
+
+def aggregate_traffic_file_hourly(file, chunksize=500000):
+    partials = [partial_hourly_aggregates(chunk) for chunk in read_traffic_density_chunks(file, chunksize=chunksize)]
+    if len(partials) == 0:
+        return pd.DataFrame()
+    return finalize_hourly_aggregates(merge_partial_aggregates(partials))
+
+def aggregate_traffic_density_hourly(path, output_path=None, database=None, coll='density_hourly',
+                                     chunksize=500000, manifest=None):
+    # Reduce every density file to hourly aggregates per measure point, and write them
+    # to parquet files in output_path and/or to a mongo collection, one file at a time.
+    files = get_traffic_density_files(path)
+    if manifest is not None:
+        files = manifest.pending(files)
+    if database is not None:
+        db.ensure_indexes(database, {coll: db.index_specs['density_hourly']})
+    nrows = 0
+    for file in files:
+        with metrics.stage('aggregate_density:' + os.path.basename(file)) as stage:
+            stage.add_files([file])
+            hourly = aggregate_traffic_file_hourly(file, chunksize=chunksize)
+            stage.rows_out = len(hourly)
+        if output_path is not None:
+            name = os.path.splitext(os.path.basename(file))[0] + '_hourly.parquet'
+            hourly.to_parquet(os.path.join(output_path, name), index=False)
+        failed = 0
+        if database is not None:
+            failed = db.upsert_documents(database, coll, hourly.to_dict(orient='records'), keys=['id', 'fecha'],
+                                         batch_size=10000, workers=2)['failed']
+        if manifest is not None and failed == 0:
+            manifest.record(file)
+        nrows += len(hourly)
+        logging.info('{}: {} hourly aggregates'.format(os.path.basename(file), len(hourly)))
+    return nrows
+
+# Coordinates of the measure points come in UTM zone 30N (ETRS89). Newer files also
+# carry longitude and latitude.
+utm_crs = 'EPSG:25830'
+wgs84_crs = 'EPSG:4326'
+utm_columns = [('utm_x', 'utm_y'), ('st_x', 'st_y'), ('x', 'y')]
+lonlat_columns = [('longitud', 'latitud'), ('lon', 'lat')]
+
+def parse_coordinates(series):
+    # Coordinates use comma as decimal separator
+    if series.dtype.kind in 'if':
+        return series.to_numpy(dtype=np.float64)
+    return pd.to_numeric(series.astype(str).str.replace(',', '.', regex=False), errors='coerce').to_numpy()
+
+def find_coordinate_columns(df, candidates):
+    columns = {col.lower(): col for col in df.columns}
+    for xcol, ycol in candidates:
+        if xcol in columns and ycol in columns:
+            return columns[xcol], columns[ycol]
+    return None, None
+
+def get_pmed_lonlat(df):
+    # Longitude and latitude of every measure point, projecting all of them at once
+    loncol, latcol = find_coordinate_columns(df, lonlat_columns)
+    if loncol is not None:
+        return parse_coordinates(df[loncol]), parse_coordinates(df[latcol])
+    xcol, ycol = find_coordinate_columns(df, utm_columns)
+    if xcol is None:
+        return None, None
+    transformer = Transformer.from_crs(utm_crs, wgs84_crs, always_xy=True)
+    return transformer.transform(parse_coordinates(df[xcol]), parse_coordinates(df[ycol]))
+
+def get_pmed_documents(df):
+    # Measure points as documents with a GeoJSON point, ready for a 2dsphere index.
+    # Points without valid coordinates get no location.
+    docs = df.to_dict(orient='records')
+    lon, lat = get_pmed_lonlat(df)
+    if lon is None:
+        return docs
+    ok = np.isfinite(lon) & np.isfinite(lat)
+    for doc, x, y, valid in zip(docs, lon.tolist(), lat.tolist(), ok.tolist()):
+        if valid:
+            doc['location'] = {"type": "Point", "coordinates": [x, y]}
+    return docs
+
 def get_location_for_pmeds(dfs):
-    # Convert all dataframes into dicts
-    dicts = [df.to_dict(orient='index') for df in dfs]
-
-    # Iterate. Look for the coordinates columns. Then add a key
-    # with the coordinates (in UTM) in each of the entries. 
-    for df, dd in zip(dfs,dicts):
-        xcol = None
-        ycol = None
-        for col in df.columns:
-            if ("x" in col) or ("X" in col):
-                xcol = col
-            elif ("y" in col) or ("Y" in col):
-                ycol = col
-        if (xcol is not None) and (ycol is not None):
-            for idx in df.index:
-                dd[idx]['location'] = {"coordinates": [df[xcol].iloc[idx], df[xcol].iloc[idx]],
-                                "type":"Point"}
-    
-    # Return the dictionaries
-    return dicts
+    # Dictionaries of documents, keyed by the index of each dataframe
+    return [dict(zip(df.index, get_pmed_documents(df))) for df in dfs]
 
-if __name__ == '__main__':
+def define_flags():
+    flags.DEFINE_string(name='data_path', default=DATA_PATH, help='Path to the pmed location files')
+    flags.DEFINE_string(name='density_path', default=DENSITY_PATH, help='Path to the traffic density files')
+    flags.DEFINE_string(name='mongo_host', default='localhost', help='Host of the mongo daemon')
+    flags.DEFINE_integer(name='mongo_port', default=27019, help='Port of the mongo daemon')
+    flags.DEFINE_string(name='hourly_path', default=None,
+                        help='Folder where the hourly aggregates of density are written. Not computed if not given')
+    metrics.define_flags()
+
+def main(argv):
 
     logging.info('Initializing ETL for traffic data...')
     logging.info('------------------------------------\n')
-
-    DATA_PATH = '/Users/adelacalle/Documents/master_data/data/trafico_madrid/ubicacion_puntos_medida/ubicacion'
-    DENSITY_PATH = '/Users/adelacalle/Documents/master_data/data/trafico_madrid/intensidad_trafico/csv'
+    metrics.configure_from_flags(script='etl_traffic')
 
     # logging.info('Get measure points dataframes from path')
-    # dfs = get_pmed_dataframes_from_paths(DATA_PATH)
+    # dfs = get_pmed_dataframes_from_paths(FLAGS.data_path)
 
     # logging.info('Get pmed dictionaries with location info')
     # pmed_dicts = get_location_for_pmeds(dfs)
 
     # # Connect with the mongo daemon
-    client = db.connect_mongo_daemon(host='localhost', port=27019)
+    client = db.connect_mongo_daemon(host=FLAGS.mongo_host, port=FLAGS.mongo_port)
     logging.info('Creating traffic database')
     traffic = db.get_mongo_database(client, 'traffic')
     
@@ -97,7 +268,29 @@ if __name__ == '__main__':
     
     logging.info('Creating density collection for traffic database')
     density_col = db.get_mongo_collection(traffic, 'density')
+    db.ensure_indexes(traffic, colls=['density'])
     
-    density_dfs = get_traffic_density_dataframes_from_paths(DENSITY_PATH)
+    with metrics.stage('load_traffic_density') as stage:
+        stats = load_traffic_density(FLAGS.density_path, traffic, 'density',
+                                     manifest=MongoManifest(traffic, 'manifest'))
+        stage.add_write_stats(stats)
+        stage.rows_out = stats['inserted']
+    logging.info('Inserted {inserted} density documents ({failed} failed) at {docs_per_second:.0f} docs/s'.format(**stats))
 
-    logging.info('ETL process finished!')
\ No newline at end of file
+    if FLAGS.hourly_path is not None:
+        os.makedirs(FLAGS.hourly_path, exist_ok=True)
+        nrows = aggregate_traffic_density_hourly(FLAGS.density_path, output_path=FLAGS.hourly_path,
+                                                 manifest=FileManifest(os.path.join(FLAGS.hourly_path,
+                                                                                    'manifest.json')))
+        logging.info('{} hourly aggregates written to {}'.format(nrows, FLAGS.hourly_path))
+
+    metrics.log_summary()
+    logging.info('ETL process finished!')
+    # Failed writes make the pipeline run the stage again
+    if stats['failed'] > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    FLAGS = flags.FLAGS
+    define_flags()
+    app.run(main)
@@ -19,18 +19,145 @@ import sys
 import glob
 import json
 import datetime
+import numpy as np
+import pandas as pd
 from absl import flags, app, logging
 from tools import database as db
+from tools.manifest import MongoManifest
+from tools import metrics
 
 def define_flags():
     flags.DEFINE_string(name='source_path', default=None, help='Path to the source of the data')
+    flags.DEFINE_string(name='mongo_host', default=None, help='Host of the mongo daemon')
+    flags.DEFINE_integer(name='mongo_port', default=None, help='Port of the mongo daemon')
+    metrics.define_flags()
 
 
+def get_weather_stations_file(source_path):
+    return os.path.join(source_path, 'estaciones_meteo.json')
+
 def get_weather_stations(source_path):
-    clima_stations_file = os.path.join(source_path, 'estaciones_meteo.json')
+    clima_stations_file = get_weather_stations_file(source_path)
     with open(clima_stations_file, 'r') as f:
         return json.load(f)
 
+##############################################################################
+## Daily climate records of AEMET. Numbers come as strings with decimal commas, and a few
+## fields carry sentinels instead of numbers.
+
+weather_keys = ['indicativo', 'fecha']
+weather_numeric_fields = ['altitud', 'tmed', 'prec', 'tmin', 'tmax', 'dir', 'velmedia', 'racha', 'sol',
+                          'presMax', 'presMin', 'hrMedia', 'hrMax', 'hrMin']
+weather_time_fields = ['horatmin', 'horatmax', 'horaracha', 'horaPresMax', 'horaPresMin', 'horaHrMax',
+                       'horaHrMin']
+# 'Ip' is inapreciable precipitation (less than 0.1 mm) and 'Acum' precipitation accumulated
+# over several days. 'Varias' means that the maximum or minimum was reached several times.
+weather_sentinels = {'Ip': 0., 'Acum': np.nan, 'Varias': np.nan}
+
+def get_weather_files(source_path):
+    # Files written by request_weather_data, and the old datos_clima dumps
+    return sorted(glob.glob(os.path.join(source_path, 'weather_*.json')) +
+                  glob.glob(os.path.join(source_path, 'datos_clima*')))
+
+def iter_json_records(file, chunk_size=1 << 20, max_record_size=1 << 24):
+    """ Yield the objects of a file holding a json array, reading it in chunks so that only
+    one chunk and one record are in memory at a time. Raises ValueError on a record that
+    does not decode within max_record_size characters. """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    # Characters dropped from the front of the buffer, to report where a bad record starts
+    offset = 0
+    started = False
+    with open(file, 'r', encoding='utf-8') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            buffer += chunk
+            pos = 0
+            while True:
+                # Skip the separators between records
+                while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] in ',[]'):
+                    started = started or buffer[pos] == '['
+                    pos += 1
+                if pos == len(buffer):
+                    break
+                if not started:
+                    raise ValueError('{} does not hold a json array'.format(file))
+                try:
+                    record, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError as e:
+                    # Record cut by the end of the chunk. A malformed one never decodes, so
+                    # the buffer is bounded instead of growing up to the end of the file
+                    if len(chunk) == 0 or len(buffer) - pos > max_record_size:
+                        raise ValueError('{}: malformed json record at character {}: {}'.format(
+                            file, offset + pos, e.msg)) from e
+                    break
+                yield record
+                pos = end
+            buffer = buffer[pos:]
+            offset += pos
+            if len(chunk) == 0:
+                return
+
+def iter_batches(records, batch_size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+def coerce_weather_values(series, sentinels=weather_sentinels):
+    # Decimal commas to points and sentinels to their values. Anything else that is not a
+    # number (including missing values) is NaN.
+    values = series.astype(str)
+    numbers = pd.to_numeric(values.str.replace(',', '.', regex=False), errors='coerce').to_numpy(np.float64, copy=True)
+    for sentinel, value in sentinels.items():
+        numbers[(values == sentinel).to_numpy()] = value
+    return pd.Series(numbers, index=series.index)
+
+def coerce_weather_batch(records):
+    """ Frame of typed weather records: numeric fields as floats, fecha as a datetime and
+    times with no single value ('Varias') as None. """
+    df = pd.DataFrame.from_records(records)
+    for field in weather_numeric_fields:
+        if field in df.columns:
+            df[field] = coerce_weather_values(df[field])
+    for field in weather_time_fields:
+        if field in df.columns:
+            df[field] = df[field].where(df[field] != 'Varias', None)
+    df['fecha'] = pd.to_datetime(df['fecha'], format='%Y-%m-%d')
+    return df
+
+def get_weather_documents(df):
+    # Missing values are left out of the documents instead of stored as NaN
+    return [{key: value for key, value in record.items() if value is not None and value == value}
+            for record in df.to_dict(orient='records')]
+
+def load_weather_files(files, database, coll, batch_size=10000, workers=2, manifest=None):
+    """ Stream the records of every file into the collection, upserting them by station
+    and day. Files are recorded in the manifest once loaded. Returns the writer stats. """
+    if manifest is not None:
+        files = manifest.pending(files)
+    with db.BulkWriter(database, coll, batch_size=batch_size, workers=workers, keys=weather_keys) as writer:
+        for file in files:
+            with metrics.stage('load_weather:' + os.path.basename(file)) as stage:
+                stage.add_files([file])
+                nrecords = 0
+                failed = writer.failed
+                for batch in iter_batches(iter_json_records(file), batch_size):
+                    writer.extend(get_weather_documents(coerce_weather_batch(batch)))
+                    nrecords += len(batch)
+                # Written before the file is recorded as loaded
+                writer.sync()
+                stage.rows_out = nrecords
+            # Files with failed writes are loaded again in the next run
+            if manifest is not None and writer.failed == failed:
+                manifest.record(file)
+    return writer.stats()
+
+
 def main(argv):
 
     logging.info('='*80)
@@ -40,10 +167,11 @@ def main(argv):
     if FLAGS.source_path is None:
         logging.error('A path to the data must be provided')
         sys.exit(1)
+    metrics.configure_from_flags(script='etl_weather')
 
     # Connect with the mongo daemon
     logging.info('Connecting to the database client')
-    client = db.connect_mongo_daemon()
+    client = db.connect_mongo_daemon(host=FLAGS.mongo_host, port=FLAGS.mongo_port)
     # First, create the database. It's dubbed "aire"
     logging.info('Creating weather collection in database')
     weather = db.get_mongo_database(client, 'weather')
@@ -53,27 +181,42 @@ def main(argv):
     logging.info('Creating climate collection')
     historic = db.get_mongo_collection(weather, 'historic')
 
-    logging.info('ETL weather stations...')
-    stations = get_weather_stations(FLAGS.source_path)
-    result = db.insert_many_documents(weather, 'historic', stations)
-
-    # clima_files = glob.glob(os.path.join(FLAGS.source_path, 'datos_clima*'))
+    # Files already ingested are skipped, and stations are upserted by their AEMET code
+    manifest = MongoManifest(weather, 'manifest')
+    db.ensure_indexes(weather, colls=['historic', 'clima'])
+    stations_file = get_weather_stations_file(FLAGS.source_path)
+    failed = 0
+    if manifest.is_changed(stations_file):
+        logging.info('ETL weather stations...')
+        with metrics.stage('extract_weather_stations') as stage:
+            stations = get_weather_stations(FLAGS.source_path)
+            stage.add_files([stations_file])
+            stage.rows_out = len(stations)
+        with metrics.stage('load_weather_stations', rows_in=len(stations)) as stage:
+            result = db.upsert_documents(weather, 'historic', stations, keys=['indicativo'])
+            stage.add_write_stats(result)
+            stage.rows_out = result['inserted']
+        failed += result['failed']
+        # Loaded again in the next run if some writes failed
+        if result['failed'] == 0:
+            manifest.record(stations_file)
+    else:
+        logging.info('Weather stations already loaded')
 
     logging.info('Inserting weather data...')
-    logging.info('Starting at ' + datetime.datetime.now().strftime('%d/%m/%Y - %H:%m:%s'))
-
-    #
-    # print('Writing ...')
-    # for file in clima_files:
-    #     with open(file, 'r') as f:
-    #         clima_data = json.load(f)
-    #     print('Inserting from {} into clima collection...'.format(file))
-    #     result = db.insert_many_documents(aire, 'clima', clima_data)
-    #
+    logging.info('Starting at ' + datetime.datetime.now().strftime('%d/%m/%Y - %H:%M:%S'))
+    stats = load_weather_files(get_weather_files(FLAGS.source_path), weather, 'clima', manifest=manifest)
+    logging.info('Upserted {inserted} weather records ({failed} failed) at {docs_per_second:.0f} docs/s'.format(
+        **stats))
+    failed += stats['failed']
 
+    metrics.log_summary()
     logging.info('=' * 80)
-    logging.info('Creation database finished at ' + datetime.datetime.now()).strftime('%d/%m/%Y - %H:%m:%s')
+    logging.info('Creation database finished at ' + datetime.datetime.now().strftime('%d/%m/%Y - %H:%M:%S'))
     logging.info('='*80)
+    # Failed writes make the pipeline run the stage again
+    if failed > 0:
+        sys.exit(1)
 
 if __name__ == '__main__':
     FLAGS = flags.FLAGS
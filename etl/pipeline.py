@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+""" pipeline.py
+
+This script runs the ETL stages described in a YAML config. Every stage is one of the ETL
+scripts, run as a subprocess with the flags given in the config. Stages run as soon as the
+stages they depend on are done, up to a number of them at the same time. The state of each
+stage is kept in a json file, so a failed run resumes from the stages that did not finish.
+
+    python pipeline.py --config pipeline.yaml --dry_run
+    python pipeline.py --config pipeline.yaml --workers 3
+"""
+
+__author__ = "Alejandro de la Calle"
+__copyright__ = "Copyright 2019"
+__credits__ = [""]
+__license__ = ""
+__version__ = "0.1"
+__maintainer__ = "Alejandro de la Calle"
+__email__ = "alejandrodelacallenegro@gmail.com"
+__status__ = "Development"
+
+
+import os
+import sys
+import json
+import time
+import hashlib
+import datetime
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import yaml
+from absl import flags, app, logging
+
+this_dir = os.path.dirname(os.path.realpath(__file__))
+root_dir = os.path.dirname(this_dir)
+
+
+def define_flags():
+    flags.DEFINE_string(name='config', default=None, help='YAML file with the stages of the pipeline')
+    flags.DEFINE_integer(name='workers', default=None,
+                         help='Stages run at the same time. As in the config if not given')
+    flags.DEFINE_list(name='stages', default=None,
+                      help='Stages to run. All of them if not given. Their dependencies are taken as done')
+    flags.DEFINE_boolean(name='dry_run', default=False, help='Print the execution plan and exit')
+    flags.DEFINE_boolean(name='resume', default=True, help='Skip the stages done in the previous runs')
+
+
+##############################################################################
+## Config
+
+def load_config(config_file):
+    """ Read and check the config. Stages get their name, and their script path and working
+    directory resolved, with relative paths taken from the folder of the config. """
+    with open(config_file, 'r') as f:
+        config = yaml.safe_load(f)
+    config_dir = os.path.dirname(os.path.abspath(config_file))
+    stages = config.get('stages') or {}
+    if len(stages) == 0:
+        raise ValueError('No stages in {}'.format(config_file))
+
+    for name, stage in stages.items():
+        if ('script' in stage) == ('module' in stage):
+            raise ValueError('Stage {} must have either a script or a module'.format(name))
+        unknown = [dep for dep in stage.get('depends_on', []) if dep not in stages]
+        if len(unknown) > 0:
+            raise ValueError('Stage {} depends on unknown stages: {}'.format(name, unknown))
+        stage['name'] = name
+        stage['depends_on'] = list(stage.get('depends_on', []))
+        stage['flags'] = stage.get('flags') or {}
+        # Scripts are looked for next to this one, and modules in the root of the repository.
+        # Modules run from the root too, as python -m puts the working directory first in the
+        # path, and etl/tools would shadow the root tools package.
+        if 'script' in stage:
+            stage['script'] = os.path.join(this_dir, stage['script'])
+        default_cwd = root_dir if 'module' in stage else config_dir
+        stage['cwd'] = os.path.join(config_dir, stage['cwd']) if 'cwd' in stage else default_cwd
+
+    config['workers'] = config.get('workers', 1)
+    config['state_file'] = os.path.join(config_dir, config.get('state_file', 'pipeline_state.json'))
+    get_execution_levels(stages)
+    return config
+
+
+def get_execution_levels(stages):
+    # Stages grouped by their depth in the dependency graph. Stages of a level only depend on
+    # stages of the previous ones.
+    depth = {}
+    pending = dict(stages)
+    levels = []
+    while len(pending) > 0:
+        level = [name for name, stage in pending.items() if all(dep in depth for dep in stage['depends_on'])]
+        if len(level) == 0:
+            raise ValueError('Dependency cycle between stages {}'.format(sorted(pending)))
+        for name in level:
+            depth[name] = len(levels)
+            del pending[name]
+        levels.append(sorted(level))
+    return levels
+
+
+def format_flag(name, value):
+    if isinstance(value, bool):
+        return '--{}'.format(name) if value else '--no{}'.format(name)
+    if isinstance(value, (list, tuple)):
+        return '--{}={}'.format(name, ','.join(str(v) for v in value))
+    return '--{}={}'.format(name, value)
+
+
+def get_command(stage, python=sys.executable):
+    args = [format_flag(name, value) for name, value in stage['flags'].items() if value is not None]
+    if 'script' in stage:
+        return [python, stage['script']] + args
+    return [python, '-m', stage['module']] + args
+
+
+def get_stage_digest(stage):
+    # A stage done with other flags is not done
+    spec = {key: stage.get(key) for key in ('script', 'module', 'flags', 'cwd')}
+    return hashlib.sha1(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()
+
+
+##############################################################################
+## State
+
+def read_state(state_file):
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file, 'r') as f:
+        return json.load(f)
+
+
+def write_state(state_file, state):
+    # Write to a temporary file first, so an interrupted run never leaves a broken state
+    tmp = state_file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp, state_file)
+
+
+def is_done(stage, state):
+    entry = state.get(stage['name'])
+    return entry is not None and entry['status'] == 'ok' and entry['digest'] == get_stage_digest(stage)
+
+
+##############################################################################
+## Execution
+
+def run_stage(stage):
+    # Run the stage in a subprocess. Modules need the root of the repository in the path.
+    env = dict(os.environ)
+    if 'module' in stage:
+        env['PYTHONPATH'] = os.pathsep.join([root_dir] + [p for p in [env.get('PYTHONPATH')] if p])
+    start = time.perf_counter()
+    returncode = subprocess.call(get_command(stage), cwd=stage['cwd'], env=env)
+    return returncode, time.perf_counter() - start
+
+
+def get_plan(stages, state, selected=None, resume=True):
+    """ Action of every stage: 'run', 'skip' (done in a previous run) or 'assume' (not
+    selected, so taken as done). A stage runs again if any of its dependencies runs. """
+    selected = set(stages if selected is None else selected)
+    plan = {}
+    for level in get_execution_levels(stages):
+        for name in level:
+            stage = stages[name]
+            if name not in selected:
+                plan[name] = 'assume'
+            elif any(plan[dep] == 'run' for dep in stage['depends_on']):
+                plan[name] = 'run'
+            elif resume and is_done(stage, state):
+                plan[name] = 'skip'
+            else:
+                plan[name] = 'run'
+    return plan
+
+
+def log_plan(stages, plan):
+    for i, level in enumerate(get_execution_levels(stages)):
+        logging.info('Level {}'.format(i))
+        for name in level:
+            deps = stages[name]['depends_on']
+            logging.info('  {:<20} {:<6} after {}'.format(name, plan[name], ', '.join(deps) if deps else '-'))
+            if plan[name] == 'run':
+                logging.info('    ' + ' '.join(get_command(stages[name])))
+
+
+def run_pipeline(config, workers=None, selected=None, resume=True, dry_run=False):
+    """ Run the stages of the plan, each as soon as its dependencies are done. The stages
+    depending on a failed one are not run. Returns the status of every stage. """
+    stages = config['stages']
+    workers = workers or config['workers']
+    state = read_state(config['state_file'])
+    plan = get_plan(stages, state, selected, resume)
+    log_plan(stages, plan)
+    if dry_run:
+        return {}
+
+    status = {name: 'ok' for name, action in plan.items() if action != 'run'}
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while len(status) < len(stages):
+            for name, stage in stages.items():
+                if name in status or name in running:
+                    continue
+                deps = [status.get(dep) for dep in stage['depends_on']]
+                if any(dep in ('failed', 'cancelled') for dep in deps):
+                    logging.warning('Stage {} cancelled, as its dependencies did not finish'.format(name))
+                    status[name] = 'cancelled'
+                elif all(dep == 'ok' for dep in deps):
+                    logging.info('Starting stage {}'.format(name))
+                    running[name] = executor.submit(run_stage, stage)
+            if len(running) == 0:
+                continue
+
+            done, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+            for name in [name for name, future in running.items() if future in done]:
+                returncode, seconds = running.pop(name).result()
+                status[name] = 'ok' if returncode == 0 else 'failed'
+                if returncode == 0:
+                    logging.info('Stage {} done in {:.1f} s'.format(name, seconds))
+                else:
+                    logging.error('Stage {} failed with exit code {} after {:.1f} s'.format(name, returncode, seconds))
+                state[name] = {'status': status[name], 'digest': get_stage_digest(stages[name]),
+                               'finished': datetime.datetime.now().isoformat(), 'seconds': seconds}
+                write_state(config['state_file'], state)
+    return status
+
+
+def main(argv):
+    logging.info('=' * 80)
+    logging.info(' ' * 20 + 'ETL pipeline')
+    logging.info('=' * 80)
+
+    if FLAGS.config is None:
+        logging.error('A config file must be provided.')
+        sys.exit(1)
+    config = load_config(FLAGS.config)
+    unknown = [name for name in FLAGS.stages or [] if name not in config['stages']]
+    if len(unknown) > 0:
+        logging.error('Unknown stages: {}'.format(unknown))
+        sys.exit(1)
+
+    status = run_pipeline(config, workers=FLAGS.workers, selected=FLAGS.stages, resume=FLAGS.resume,
+                          dry_run=FLAGS.dry_run)
+    if FLAGS.dry_run:
+        return
+
+    for name in sorted(status):
+        logging.info('{:<20} {}'.format(name, status[name]))
+    logging.info('=' * 80)
+    if any(value != 'ok' for value in status.values()):
+        logging.error('Pipeline failed. Run it again to resume from the stages that did not finish.')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    FLAGS = flags.FLAGS
+    define_flags()
+    app.run(main)
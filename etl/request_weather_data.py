@@ -17,16 +17,29 @@ import os
 import sys
 import pandas as pd
 import json
+import time
+import random
+import asyncio
 from absl import flags, app, logging
 import requests
 from tools import etl_utils as utils
+from tools import metrics
+
+aemet_url = "https://opendata.aemet.es/opendata/api"
+climate_endpoint = "valores/climatologicos/diarios/datos/fechaini"
+
 
 def define_flags():
     flags.DEFINE_list(name='init_date', default=None, help='Initial date of the request')
     flags.DEFINE_list(name='end_date', default=None, help='Initial date of the request')
-    flags.DEFINE_string(name='station', default=None, help='Station info')
+    flags.DEFINE_list(name='station', default=None, help='Stations info. All of them if not given')
     flags.DEFINE_string(name='apikey',default='./api-key', help='Path to the API key')
     flags.DEFINE_string(name='output_path', default='None', help='Path to the output folder')
+    flags.DEFINE_string(name='base_url', default=aemet_url, help='Base URL of the AEMET open data API')
+    flags.DEFINE_integer(name='requests_per_minute', default=40, help='Maximum number of requests per minute')
+    flags.DEFINE_integer(name='concurrency', default=4, help='Number of months requested at the same time')
+    flags.DEFINE_integer(name='max_retries', default=5, help='Number of retries of a failed request')
+    metrics.define_flags()
 
 
 def request_climate_info(init_date, end_date, station=None, apikey=None):
@@ -37,14 +50,8 @@ def request_climate_info(init_date, end_date, station=None, apikey=None):
         logging.info('Please provide a weather station')
         sys.exit(1)
 
-    preurl = "https://opendata.aemet.es/opendata/api/valores/climatologicos/diarios/datos/fechaini"
-    url = os.path.join(preurl, init_date.strftime('%Y-%m-%dT%H:%M:%SUTC'), 'fechafin',
-                       end_date.strftime('%Y-%m-%dT%H:%M:%SUTC'), 'estacion', utils.estaciones_meteo[station])
-    # Get AEMET API key
-    with open(apikey, 'r') as f:
-        key = f.readlines()[0]
-
-    querystring = {"api_key": key}
+    url = get_climate_url(aemet_url, init_date, end_date, station)
+    querystring = {"api_key": read_apikey(apikey)}
     logging.info('Requesting climate info between {} and {} for station {}'.format(init_date, end_date, station))
     response = requests.get(url, params=querystring)
     if response.json()['estado'] != 200:
@@ -53,6 +60,115 @@ def request_climate_info(init_date, end_date, station=None, apikey=None):
     return weather_info.json()
 
 
+def get_climate_url(base_url, init_date, end_date, station):
+    return '/'.join([base_url.rstrip('/'), climate_endpoint, init_date.strftime('%Y-%m-%dT%H:%M:%SUTC'), 'fechafin',
+                     end_date.strftime('%Y-%m-%dT%H:%M:%SUTC'), 'estacion', utils.estaciones_meteo[station]])
+
+
+def read_apikey(apikey):
+    # Get AEMET API key
+    with open(apikey, 'r') as f:
+        return f.readlines()[0].strip()
+
+
+def get_weather_filename(output_path, station, start):
+    return os.path.join(output_path, 'weather_{}_{}.json'.format(station, start.strftime('%Y-%m')))
+
+
+class RateLimiter(object):
+    """ Space the start of the requests so that no more than requests_per_minute are sent. """
+
+    def __init__(self, requests_per_minute):
+        self.interval = 60. / requests_per_minute
+        self.next_time = 0.
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class RetryableError(Exception):
+    pass
+
+
+def fetch_json(session, url, params=None):
+    response = session.get(url, params=params, timeout=60)
+    # Throttling and server errors are worth a retry. Anything else is not.
+    if response.status_code == 429 or response.status_code >= 500:
+        raise RetryableError('HTTP {} from {}'.format(response.status_code, url))
+    response.raise_for_status()
+    return response.json()
+
+
+def fetch_climate_window(session, base_url, key, start, end, station):
+    # The API answers with a description of the request, and the data behind its 'datos' URL
+    meta = fetch_json(session, get_climate_url(base_url, start, end, station), params={"api_key": key})
+    if meta.get('estado') == 429:
+        raise RetryableError(meta.get('descripcion'))
+    if meta.get('estado') != 200:
+        raise ValueError('Climate request has an error: {}'.format(meta.get('descripcion')))
+    return fetch_json(session, meta['datos'])
+
+
+async def download_window(session, limiter, semaphore, base_url, key, start, end, station, output_path,
+                          max_retries=5):
+    filename = get_weather_filename(output_path, station, start)
+    # Windows already on disk are not requested again, so interrupted backfills resume
+    if os.path.exists(filename):
+        return filename, None
+
+    async with semaphore:
+        for attempt in range(max_retries + 1):
+            # Each window costs two requests: the description and the data
+            await limiter.wait()
+            await limiter.wait()
+            try:
+                data = await asyncio.to_thread(fetch_climate_window, session, base_url, key, start, end, station)
+                break
+            except (RetryableError, requests.ConnectionError, requests.Timeout) as e:
+                if attempt == max_retries:
+                    return filename, str(e)
+                backoff = 2 ** attempt + random.random()
+                logging.warning('Request for {} {} failed ({}). Retrying in {:.1f}s'.format(
+                    station, start.strftime('%Y-%m'), e, backoff))
+                await asyncio.sleep(backoff)
+            except (ValueError, requests.HTTPError) as e:
+                return filename, str(e)
+
+    # Write to a temporary file first, so that a partial file is never taken as downloaded
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, filename)
+    return filename, None
+
+
+async def download_weather_info_async(start_date, end_date, stations, output_path, apikey, base_url=aemet_url,
+                                      requests_per_minute=40, concurrency=4, max_retries=5):
+    key = read_apikey(apikey)
+    limiter = RateLimiter(requests_per_minute)
+    semaphore = asyncio.Semaphore(concurrency)
+    with requests.Session() as session:
+        tasks = [download_window(session, limiter, semaphore, base_url, key, start, end, station, output_path,
+                                 max_retries=max_retries)
+                 for station in stations for start, end in zip(start_date, end_date)]
+        results = await asyncio.gather(*tasks)
+    return [(filename, error) for filename, error in results if error is not None]
+
+
+def download_weather_info(start_date, end_date, stations, output_path, apikey, base_url=aemet_url,
+                          requests_per_minute=40, concurrency=4, max_retries=5):
+    # Download every station/month window concurrently. Returns the windows that failed.
+    return asyncio.run(download_weather_info_async(start_date, end_date, stations, output_path, apikey,
+                                                   base_url=base_url, requests_per_minute=requests_per_minute,
+                                                   concurrency=concurrency, max_retries=max_retries))
+
+
 def get_weather_info(start_date, end_date, station, output_path, apikey):
     for start, end in zip(start_date, end_date):
         print('Requesting from {} to {}'.format(start, end))
@@ -71,19 +187,30 @@ def main(argv):
     if FLAGS.init_date is None or FLAGS.end_date is None:
         logging.info('A Initial and end data for requesting data is mandatory. Please provide one.')
         sys.exit(1)
+    metrics.configure_from_flags(script='request_weather_data')
 
     init_date = utils.get_date(FLAGS.init_date[2], FLAGS.init_date[1], FLAGS.init_date[0])
     end_date = utils.get_date(FLAGS.end_date[2], FLAGS.end_date[1], FLAGS.end_date[0])
 
     starting_months = pd.date_range(init_date, end_date, freq='MS')
-    ending_months = pd.date_range(init_date, end_date, freq='M')
-
-    get_weather_info(starting_months, ending_months, FLAGS.station,
-                     FLAGS.output_path, FLAGS.apikey)
-
+    ending_months = pd.date_range(init_date, end_date, freq=pd.offsets.MonthEnd())
+
+    stations = FLAGS.station if FLAGS.station is not None else list(utils.estaciones_meteo.keys())
+    nwindows = len(stations) * len(starting_months)
+    with metrics.stage('download_weather', rows_in=nwindows) as stage:
+        failures = download_weather_info(starting_months, ending_months, stations, FLAGS.output_path, FLAGS.apikey,
+                                         base_url=FLAGS.base_url, requests_per_minute=FLAGS.requests_per_minute,
+                                         concurrency=FLAGS.concurrency, max_retries=FLAGS.max_retries)
+        stage.rows_out = nwindows - len(failures)
+    for filename, error in failures:
+        logging.error('Could not download {}: {}'.format(os.path.basename(filename), error))
+
+    metrics.log_summary()
     logging.info('=' * 80)
     logging.info('Request finished')
     logging.info('=' * 80)
+    if len(failures) > 0:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
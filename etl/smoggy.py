@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+""" smoggy.py
+
+This script is the single entry point of the ETL. Each subcommand runs one of the ETL scripts
+with its own flags, and only the script of the chosen subcommand is imported, so the
+startup of a run does not pay for the libraries of the others.
+
+    python smoggy.py calendar --source_path /data/calendario
+    python smoggy.py --help
+"""
+
+__author__ = "Alejandro de la Calle"
+__copyright__ = "Copyright 2019"
+__credits__ = [""]
+__license__ = ""
+__version__ = "0.1"
+__maintainer__ = "Alejandro de la Calle"
+__email__ = "alejandrodelacallenegro@gmail.com"
+__status__ = "Development"
+
+
+# Only the standard library is imported here. absl, pandas and the rest come with the script
+# of the subcommand.
+import os
+import sys
+import importlib
+
+this_dir = os.path.dirname(os.path.realpath(__file__))
+
+# Subcommand -> (script module, description)
+commands = {'calendar': ('etl_calendar', 'Extract the working calendar'),
+            'weather': ('etl_weather', 'Load AEMET stations and daily climate records'),
+            'traffic': ('etl_traffic', 'Load traffic density and its hourly aggregates'),
+            'pollution': ('etl_pollution', 'Load the daily records of the air quality stations'),
+            'download': ('request_weather_data', 'Download daily climate records from AEMET'),
+            'pipeline': ('pipeline', 'Run the stages of a YAML pipeline config')}
+
+
+def usage():
+    lines = ['usage: smoggy <command> [--flags]', '', 'commands:']
+    lines += ['  {:<12} {}'.format(name, description) for name, (_, description) in commands.items()]
+    lines += ['', 'Run smoggy <command> --help for the flags of a command.']
+    return '\n'.join(lines)
+
+
+def load_command(name):
+    # The scripts import their own 'tools' package (etl/tools)
+    if this_dir not in sys.path:
+        sys.path.insert(0, this_dir)
+    return importlib.import_module(commands[name][0])
+
+
+def run_command(name, argv):
+    # Same as running the script: its main reads the flags through the module global FLAGS
+    module = load_command(name)
+    from absl import app, flags
+    module.FLAGS = flags.FLAGS
+    module.define_flags()
+    app.run(module.main, argv=['smoggy ' + name] + list(argv))
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) == 0 or argv[0] in ('-h', '--help', 'help'):
+        print(usage())
+        return 0
+    if argv[0] not in commands:
+        print('Unknown command {}\n\n{}'.format(argv[0], usage()), file=sys.stderr)
+        return 2
+    run_command(argv[0], argv[1:])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
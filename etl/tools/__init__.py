@@ -4,4 +4,4 @@ def add_path(path):
     if path not in sys.path:
         sys.path.insert(0, path)
 
-__all__ = ["etl_utils", "database"]
\ No newline at end of file
+__all__ = ["etl_utils", "database", "cache", "manifest", "metrics", "codes"]
\ No newline at end of file
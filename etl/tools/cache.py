@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+""" cache.py
+
+This module contain a content-addressed cache of parsed raw files. The parsed
+dataframes are stored as parquet files and reloaded when the source file has not changed.
+"""
+
+__author__ = "Alejandro de la Calle"
+__copyright__ = "Copyright 2019"
+__credits__ = [""]
+__license__ = ""
+__version__ = "0.1"
+__maintainer__ = "Alejandro de la Calle"
+__email__ = "alejandrodelacallenegro@gmail.com"
+__status__ = "Development"
+
+
+import os
+import sys
+import glob
+import hashlib
+import pandas as pd
+from absl import flags, app, logging
+
+
+def define_flags():
+    flags.DEFINE_string(name='cache_dir', default=None, help='Path to the cache folder')
+    flags.DEFINE_list(name='invalidate', default=None,
+                      help='Source files whose cache entries are removed. Use "all" to clear the cache')
+
+
+def path_digest(path):
+    return hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:16]
+
+
+def content_digest(path, blocksize=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_key(path):
+    # Key is made of the path, size, modification time and content hash of the file
+    st = os.stat(path)
+    meta = '{}:{}:{}'.format(st.st_size, st.st_mtime_ns, content_digest(path))
+    return '{}_{}'.format(path_digest(path), hashlib.sha1(meta.encode('utf-8')).hexdigest()[:16])
+
+
+def remove_entry(entry):
+    # Another process may have removed it already
+    try:
+        os.remove(entry)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+class ParquetCache(object):
+    """ Cache of parsed dataframes, keyed by source file.
+
+    Entries are evicted by least recent use once the cache folder grows above max_bytes.
+    Several processes may share the folder, so an entry can vanish at any time: it is
+    then taken as a miss.
+    """
+
+    def __init__(self, cache_dir, max_bytes=4 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + '.parquet')
+
+    def get(self, path, key=None):
+        entry = self.entry_path(file_key(path) if key is None else key)
+        try:
+            # Touch the entry, so eviction sees it as recently used
+            os.utime(entry)
+            return pd.read_parquet(entry)
+        except FileNotFoundError:
+            return None
+
+    def put(self, path, df, key=None):
+        key = file_key(path) if key is None else key
+        # Older versions of the same source file are stale
+        self.invalidate(path)
+        tmp = '{}.{}.tmp'.format(self.entry_path(key), os.getpid())
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, self.entry_path(key))
+        self.evict()
+
+    def load(self, path, parser, *args, **kwargs):
+        # Return the cached dataframe for path, parsing and caching it on a miss. The source
+        # file is hashed once for both.
+        key = file_key(path)
+        df = self.get(path, key)
+        if df is None:
+            df = parser(path, *args, **kwargs)
+            self.put(path, df, key)
+        return df
+
+    def entries(self):
+        return glob.glob(os.path.join(self.cache_dir, '*.parquet'))
+
+    def stat_entries(self):
+        # (mtime, size, path) of the entries, skipping those removed meanwhile
+        stats = []
+        for entry in self.entries():
+            try:
+                st = os.stat(entry)
+            except FileNotFoundError:
+                continue
+            stats.append((st.st_mtime, st.st_size, entry))
+        return stats
+
+    def size(self):
+        return sum(size for _, size, _ in self.stat_entries())
+
+    def evict(self):
+        entries = sorted(self.stat_entries())
+        total = sum(size for _, size, _ in entries)
+        while total > self.max_bytes and len(entries) > 0:
+            _, size, entry = entries.pop(0)
+            total -= size
+            remove_entry(entry)
+
+    def invalidate(self, path=None):
+        # Remove the entries of a source file, or every entry if no file is given
+        pattern = '*.parquet' if path is None else path_digest(path) + '_*.parquet'
+        entries = glob.glob(os.path.join(self.cache_dir, pattern))
+        return sum(remove_entry(entry) for entry in entries)
+
+
+def load_cached(path, parser, cache_dir=None, *args, **kwargs):
+    # Parse path, going through the cache when a cache folder is given
+    if cache_dir is None:
+        return parser(path, *args, **kwargs)
+    return ParquetCache(cache_dir).load(path, parser, *args, **kwargs)
+
+
+def main(argv):
+    if FLAGS.cache_dir is None:
+        logging.error('A path to the cache folder must be provided')
+        sys.exit(1)
+
+    cache = ParquetCache(FLAGS.cache_dir)
+    if FLAGS.invalidate is not None:
+        if 'all' in FLAGS.invalidate:
+            removed = cache.invalidate()
+        else:
+            removed = sum(cache.invalidate(path) for path in FLAGS.invalidate)
+        logging.info('Removed {} cache entries'.format(removed))
+    logging.info('Cache holds {} entries ({:.1f} MB)'.format(len(cache.entries()), cache.size() / 2**20))
+
+
+if __name__ == '__main__':
+    FLAGS = flags.FLAGS
+    define_flags()
+    app.run(main)
@@ -15,9 +15,14 @@ __status__ = "Development"
 
 
 import os
-from pymongo import MongoClient
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import MongoClient, ReplaceOne
+from pymongo.errors import BulkWriteError
 import glob
 import datetime
+import pandas as pd
 
 #MONGO_CONFIG = '/Volumes/TRIPLET/db/mongod_airdb.conf'
 
@@ -28,6 +33,18 @@ def connect_mongo_daemon(host=None, port=None):
         client = MongoClient(host, port)
     return client
 
+# Clients are thread-safe and keep their own connection pool, so they are shared
+# across the whole process.
+_shared_clients = {}
+_shared_clients_lock = threading.Lock()
+
+def get_shared_client(host=None, port=None, max_pool_size=100):
+    key = (host, port)
+    with _shared_clients_lock:
+        if key not in _shared_clients:
+            _shared_clients[key] = MongoClient(host, port, maxPoolSize=max_pool_size)
+        return _shared_clients[key]
+
 def get_mongo_database(client, dbname):
     return client[dbname]
 
@@ -42,4 +59,199 @@ def insert_many_documents(db, coll, entries):
     mycoll = db[coll]
     return mycoll.insert_many(entries).inserted_ids
 
+class BulkWriter(object):
+    """ Buffer documents and write them to a collection in unordered batches.
+
+    With workers > 0 the batches are flushed on a thread pool, overlapping the
+    network round-trips with the production of new documents. At most max_pending
+    batches (twice the workers if not given) are in flight, so a fast producer waits
+    for the oldest write instead of queueing every batch in memory. If keys are given,
+    documents are upserted on those fields instead of inserted, so writes are
+    idempotent. Documents of a batch that raised are counted as failed, and the error
+    is kept in errors. Stats are available through the stats() method, or returned by close().
+    """
+
+    def __init__(self, db, coll, batch_size=1000, workers=0, keys=None, max_pending=None):
+        self.collection = db[coll]
+        self.keys = keys
+        self.batch_size = batch_size
+        self.buffer = []
+        self.inserted = 0
+        self.failed = 0
+        self.write_seconds = 0.
+        self.batches = 0
+        self.errors = []
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        self.futures = []
+        self.max_pending = max_pending or 2 * workers
+        self.start = time.perf_counter()
+        self.end = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, entry):
+        self.buffer.append(entry)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def extend(self, entries):
+        for entry in entries:
+            self.add(entry)
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        batch, self.buffer = self.buffer, []
+        if self.executor is None:
+            self._write(batch)
+        else:
+            # Wait for the oldest writes while too many are in flight
+            while len(self.futures) >= self.max_pending:
+                self.futures.pop(0).result()
+            self.futures.append(self.executor.submit(self._write, batch))
+
+    def _write(self, batch):
+        start = time.perf_counter()
+        try:
+            if self.keys is None:
+                inserted = len(self.collection.insert_many(batch, ordered=False).inserted_ids)
+            else:
+                requests = self.upserts(batch)
+                if len(requests) < len(batch):
+                    with self.lock:
+                        self.errors.append('KeyError: {} documents without all of the keys {}'.format(
+                            len(batch) - len(requests), self.keys))
+                inserted = 0
+                if len(requests) > 0:
+                    result = self.collection.bulk_write(requests, ordered=False)
+                    inserted = result.upserted_count + result.matched_count
+        except BulkWriteError as e:
+            # Not every server reports all of the counts
+            inserted = sum(e.details.get(count, 0) for count in ('nInserted', 'nUpserted', 'nMatched'))
+        except Exception as e:
+            # Network errors and the like: nothing of the batch is known to be written
+            inserted = 0
+            with self.lock:
+                self.errors.append('{}: {}'.format(type(e).__name__, e))
+        with self.lock:
+            self.inserted += inserted
+            self.failed += len(batch) - inserted
+            self.write_seconds += time.perf_counter() - start
+            self.batches += 1
+
+    def upserts(self, batch):
+        # Documents missing any of the keys are not written (they count as failed), as a
+        # filter without them could replace an unrelated document
+        return [ReplaceOne({key: entry[key] for key in self.keys}, entry, upsert=True)
+                for entry in batch if all(key in entry for key in self.keys)]
+
+    def sync(self):
+        # Flush and wait for every pending write
+        self.flush()
+        for future in self.futures:
+            future.result()
+        self.futures = []
+
+    def close(self):
+        self.sync()
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.end = time.perf_counter()
+        return self.stats()
+
+    def stats(self):
+        seconds = (self.end or time.perf_counter()) - self.start
+        return {'inserted': self.inserted, 'failed': self.failed, 'seconds': seconds,
+                'docs_per_second': self.inserted / seconds if seconds > 0 else 0.,
+                'write_seconds': self.write_seconds, 'batches': self.batches}
+
+def bulk_insert_documents(db, coll, entries, batch_size=1000, workers=0):
+    # Drop-in replacement for insert_many_documents. Returns the writer stats.
+    with BulkWriter(db, coll, batch_size=batch_size, workers=workers) as writer:
+        writer.extend(entries)
+    return writer.stats()
+
+def upsert_documents(db, coll, entries, keys, batch_size=1000, workers=0):
+    # Replace the documents matching the keys of each entry, inserting them if missing
+    with BulkWriter(db, coll, batch_size=batch_size, workers=workers, keys=keys) as writer:
+        writer.extend(entries)
+    return writer.stats()
+
+##############################################################################
+## Ingest log. Every load appends the stations and time range it wrote, so that query
+## results cached by other processes (see tools.querycache) can tell when they are stale.
+
+ingest_log_coll = 'ingest_log'
+
+def utc_now():
+    # Naive UTC time, as pymongo stores and returns dates
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def log_ingest(db, coll, stations=None, start=None, end=None):
+    # stations (codes) and [start, end) as None stand for all of them
+    entry = {'coll': coll, 'stations': None if stations is None else sorted(set(str(s) for s in stations)),
+             'start': None if start is None else pd.Timestamp(start).to_pydatetime(),
+             'end': None if end is None else pd.Timestamp(end).to_pydatetime(),
+             'time': utc_now()}
+    return db[ingest_log_coll].insert_one(entry).inserted_id
+
+##############################################################################
+## Indexes
+
+# Indexes expected in each collection: one document per station, magnitude and day
+# ('pollution'), monthly buckets ('pollution_buckets'), measure points ('pmed') and loads
+# by time ('ingest_log'). The fields the loaders upsert on have a unique index, so each
+# upsert is an index lookup instead of a collection scan: daily pollution records
+# ('pollution'), density readings and their hourly aggregates ('density' and
+# 'density_hourly'), and weather stations and their daily records ('historic' and 'clima').
+# Specs are lists of (field, direction) pairs, or dicts with them as 'keys' and the
+# options of create_index.
+index_specs = {'pollution': [[('ESTACION', 1), ('MAGNITUD', 1), ('ANO', 1), ('MES', 1), ('DIA', 1)],
+                             {'keys': [('PROVINCIA', 1), ('MUNICIPIO', 1), ('ESTACION', 1), ('MAGNITUD', 1),
+                                       ('ANO', 1), ('MES', 1), ('DIA', 1)], 'unique': True}],
+               'pollution_buckets': [[('station', 1), ('magnitude', 1), ('start', 1)]],
+               'pmed': [[('location', '2dsphere')]],
+               'density': [{'keys': [('id', 1), ('idelem', 1), ('fecha', 1)], 'unique': True}],
+               'density_hourly': [{'keys': [('id', 1), ('fecha', 1)], 'unique': True}],
+               'historic': [{'keys': [('indicativo', 1)], 'unique': True}],
+               'clima': [{'keys': [('indicativo', 1), ('fecha', 1)], 'unique': True}],
+               ingest_log_coll: [[('coll', 1), ('time', 1)]]}
+
+def get_index_options(spec):
+    # Keys and create_index options of an index spec
+    if isinstance(spec, dict):
+        return list(spec['keys']), {option: value for option, value in spec.items() if option != 'keys'}
+    return list(spec), {}
+
+def missing_indexes(db, specs=None, colls=None):
+    # (collection, spec) pairs of the specs with no matching index. A unique spec is only
+    # matched by a unique index.
+    specs = index_specs if specs is None else specs
+    missing = []
+    for coll, indexes in specs.items():
+        if colls is not None and coll not in colls:
+            continue
+        existing = {tuple((field, direction) for field, direction in info['key']): info.get('unique', False)
+                    for info in db[coll].index_information().values()}
+        for spec in indexes:
+            keys, options = get_index_options(spec)
+            if tuple(keys) not in existing or (options.get('unique', False) and not existing[tuple(keys)]):
+                missing.append((coll, spec))
+    return missing
+
+def ensure_indexes(db, specs=None, colls=None):
+    # Create the missing indexes (of the given collections only, if any), and check
+    # afterwards that all of them exist
+    for coll, spec in missing_indexes(db, specs, colls):
+        keys, options = get_index_options(spec)
+        db[coll].create_index(keys, **options)
+    missing = missing_indexes(db, specs, colls)
+    if len(missing) > 0:
+        raise RuntimeError('Could not create indexes: {}'.format(missing))
+
 #def mongo_lookup(query):
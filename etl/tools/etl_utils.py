@@ -15,122 +15,225 @@ __status__ = "Development"
 
 
 import os
+import numpy as np
 import pandas as pd
 import glob
 import datetime
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from absl import logging
+from tools import cache
+# Dictionaries useful for pollution and weather data
+from tools.codes import estaciones_aire, sustancias, mes, estaciones_meteo
 #import json
 
 
-##############################################
-## Dictionaries useful for pollution and weather data
-
-estaciones_aire = {'28079001': 'Plz. Recoletos', '28079002': 'Glta. Carlos V', '28079003': 'Pza. Carmen (<2011)',
-              '28079035': 'Plz. Carmen', '28079004': 'Plz. España', '28079005': 'Barrio del Pilar (<2011)',
-              '28079039': 'Barrio del Pilar', '28079006': 'Plz. Dr. Marañon', '28079007': 'Plz. M. de Salamanca',
-              '28079008': 'Escuelas Aguirre', '28079009': 'Plz. Luca de Tena', '28079010': 'Cuatro Caminos (<2011)',
-              '28079038': 'Cuatro Caminos', '28079011': 'Av. Ramón y Cajal', '28079012': 'Plz. Manuel Becerra',
-              '28079013': 'Vallecas (<2011)', '28079040': 'Vallecas', '28079014': 'Plz. Fernández Ladreda (<2009)',
-              '28079015': 'Plz. Castilla (<2008)', '28079016': 'Arturo Soria', '28079017': 'Villaverde Alto',
-              '28079018': 'C/ Farolillo', '28079019': 'Huerta Castañeda', '28079020': 'Moratalaz (<2011)',
-              '28079036': 'Moratalaz', '28079021': 'Pza. Cristo Rey', '28079022': 'P. Pontones', '28079023': 'Final Alcalá',
-              '28079024': 'Casa campo', '28079025': 'St. Eugenia', '28079026': 'Urb. Embajada-Barajas (<2010)',
-              '28079027': 'Barajas', '28079047': 'Mendez Álvaro', '28079048': 'P. Castellana', '28079049': 'Retiro',
-              '28079050': 'Plz. Castilla', '28079054': 'Ensanche Vallecas', '28079055': 'Urb. Embajada-Barajas',
-              '28079056': 'Plz. Fdz Ladreda', '28079057': 'Sanchinarro', '28079058': 'El Pardo',
-              '28079059': 'Parque Juan Carlos I', '28079086': 'Tres Olivos (<2011)', '28079060': 'Tres Olivos',
-              '28079099': 'Media global'}
-
-sustancias = {'01': 'SO2', '06': 'CO', '07': 'NO', '08': 'NO2', '09': 'PM2.5', '10': 'PM10', '12': 'NOx', '14': 'O3',
-              '20': 'TOL', '30': 'BEN', '35': 'EBE', '37': 'MXY', '38': 'PXY', '39': 'OXY', '42': 'TCH', '43': 'CH4',
-              '44': 'NMHC', '58': 'HCl'}
-
-mes = {1: 'Enero', 2: 'Febrero', 3: 'Marzo', 4: 'Abril', 5: 'Mayo', 6: 'Junio', 7: 'Julio', 8: 'Agosto',
-       9: 'Septiembre', 10: 'Octubre', 11: 'Noviembre', 12: 'Diciembre'}
-
-estaciones_meteo = {'Retiro': '3195', 'Aeropuerto': '3129', 'Ciudad_Universitaria': '3194U', 'Cuatro_Vientos': '3196'}
-
-################################################################################
-
-
 def get_date(year, month, day, hour=0, minute=0):
     return pd.to_datetime('{}-{}-{} {}:{}'.format(year, month, day, hour, minute))
 
 def create_date_column(df):
     df['date'] = datetime.date(year=df['año'], month=df['mes'], dia=df['dia'])
 
-def parse_pollution_txt(txt_file):
+# Fixed-width layout of the hourly pollution txt files: a header of 20 characters
+# followed by 24 blocks of 5 characters for the value plus 1 for the validity flag.
+pollution_txt_header = [('PROVINCIA', 0, 2), ('MUNICIPIO', 2, 5), ('ESTACION', 5, 8), ('MAGNITUD', 8, 10),
+                        ('TECNICA', 10, 12), ('ANO', 14, 16), ('MES', 16, 18), ('DIA', 18, 20)]
+pollution_txt_width = 20 + 24 * 6
+
+
+def read_fixed_width_buffer(txt_file, width):
+    # Read the whole file as a single byte buffer and return it as a (nrows, width) uint8 array
+    with open(txt_file, 'rb') as f:
+        buf = f.read()
+    if b'\r' in buf:
+        buf = buf.replace(b'\r\n', b'\n')
+    if len(buf) == 0:
+        return np.zeros((0, width), dtype=np.uint8)
+    if not buf.endswith(b'\n'):
+        buf += b'\n'
+
+    rowlen = buf.index(b'\n') + 1
+    if rowlen > width and len(buf) % rowlen == 0:
+        arr = np.frombuffer(buf, dtype=np.uint8).reshape(-1, rowlen)
+        if np.all(arr[:, -1] == ord('\n')):
+            return arr[:, :width]
+
+    # Ragged lines (trailing blanks, empty lines...). Pad them to a common width.
+    lines = [line.ljust(width)[:width] for line in buf.split(b'\n') if line.strip()]
+    return np.frombuffer(b''.join(lines), dtype=np.uint8).reshape(-1, width)
+
+
+# Fields identifying a row (see pollution_keys) come in different forms: the txt files have
+# zero-padded codes and two-digit years, the csv files numeric codes and full years. They
+# are normalized in every parse, compact or not, so documents get the same keys either way.
+code_widths = {'PROVINCIA': 2, 'MUNICIPIO': 3, 'ESTACION': 3, 'MAGNITUD': 2}
+date_columns = ['ANO', 'MES', 'DIA']
+
+# Compact dtypes of the parsed pollution frames. Code columns are categorical, with the
+# categories taken from the dictionaries of stations and substances.
+code_categories = {'PROVINCIA': sorted(set(code[:2] for code in estaciones_aire)),
+                   'MUNICIPIO': sorted(set(code[2:5] for code in estaciones_aire)),
+                   'ESTACION': sorted(set(code[5:8] for code in estaciones_aire)),
+                   'MAGNITUD': sorted(sustancias)}
+small_int_dtypes = {'TECNICA': np.int8, 'ANO': np.int16, 'MES': np.int8, 'DIA': np.int8}
+
+
+def normalize_pollution_keys(df):
+    # Codes as zero-padded strings, and dates as integers with the full year. Codes read as
+    # strings are already zero-padded (fixed-width fields of the txt files), only numeric
+    # ones are padded, once per distinct value.
+    for col, width in code_widths.items():
+        if col not in df.columns or df[col].dtype.kind not in 'iuf':
+            continue
+        inverse, uniques = pd.factorize(df[col].astype(np.int64))
+        df[col] = np.array([str(code).zfill(width) for code in uniques], dtype=object)[inverse]
+
+    for col in date_columns:
+        if col not in df.columns:
+            continue
+        values = df[col].astype(np.int64)
+        if col == 'ANO':
+            values = values.where(values >= 100, np.where(values < 50, 2000 + values, 1900 + values))
+        df[col] = values
+    return df
+
+
+def categorical_codes(col, uniques, inverse):
+    # Categorical code column from its distinct values and the position of every row among
+    # them. Codes missing in the dictionaries are kept as extra categories.
+    categories = code_categories[col] + sorted(set(uniques) - set(code_categories[col]))
+    positions = pd.Index(categories).get_indexer(uniques)
+    return pd.Categorical.from_codes(positions[inverse], categories=categories)
+
+
+def compact_pollution_dtypes(df):
+    df = normalize_pollution_keys(df)
+    for col in code_categories:
+        if col not in df.columns or df[col].dtype == 'category':
+            continue
+        inverse, uniques = pd.factorize(df[col])
+        df[col] = categorical_codes(col, list(uniques), inverse)
+
+    for col, dtype in small_int_dtypes.items():
+        if col in df.columns:
+            df[col] = df[col].astype(dtype)
+
+    hours = [col for col in df.columns if len(col) == 3 and col[0] == 'H' and col[1:].isdigit()]
+    flags = [col for col in df.columns if len(col) == 3 and col[0] == 'V' and col[1:].isdigit()]
+    df[hours] = df[hours].astype(np.float32)
+    for col in flags:
+        if df[col].dtype != bool:
+            df[col] = (df[col] == 'V').to_numpy()
+    return df
+
+
+def parse_pollution_txt(txt_file, compact=True):
     horasstr = ['H{:02d}'.format(h) for h in range(1, 25)]
     valstr = ['V{:02d}'.format(v) for v in range(1, 25)]
 
-    cod_provincia = []
-    cod_municipio = []
-    cod_estacion = []
-    cod_magnitud = []
-    cod_tecnica = []
-    anno = []
-    mes = []
-    dia = []
-    horas = []
-    val = []
-
-    with open(txt_file) as f:
-        lines = f.readlines()
-        for line in lines:
-            line.replace('\n', '')
-            cod_provincia.append(line[:2])
-            cod_municipio.append(line[2:5])
-            cod_estacion.append(line[5:8])
-            cod_magnitud.append(line[8:10])
-            cod_tecnica.append(line[10:12])
-            anno.append(line[14:16])
-            mes.append(line[16:18])
-            dia.append(line[18:20])
-            hh = [line[20 + h * 6:25 + h * 6] for h in range(24)]
-            horas.append(hh)
-            vv = [line[25 + v * 6] for v in range(24)]
-            val.append(vv)
-
-    # Transform hhh to have only 24 columns (one per hour), and the length of each column
-    # is the number of measures
-    horas = list(zip(*horas))
-    val = list(zip(*val))
-
-    measures = dict(zip(horasstr, horas))
-    validez = dict(zip(valstr, val))
-
-    cols1 = {'PROVINCIA': cod_provincia, 'MUNICIPIO': cod_municipio, 'ESTACION': cod_estacion,
-             'MAGNITUD': cod_magnitud, 'TECNICA': cod_tecnica, 'ANO': anno, 'MES': mes, 'DIA': dia}
-
-    cols = {**cols1, **measures, **validez}
-
-    dataf = pd.DataFrame(data=cols)
-    return dataf
-
-def parse_pollution_csv(csv_file):
+    arr = read_fixed_width_buffer(txt_file, pollution_txt_width)
+    nrows = arr.shape[0]
+
+    cols = {}
+    for name, start, end in pollution_txt_header:
+        # Fields have very few distinct values, so pack them into integers and decode only the unique ones
+        packed = arr[:, start:end].astype(np.int32) @ (256 ** np.arange(end - start - 1, -1, -1, dtype=np.int32))
+        _, first, inverse = np.unique(packed, return_index=True, return_inverse=True)
+        codes = np.ascontiguousarray(arr[first, start:end]).view('S{}'.format(end - start)).ravel().astype(str)
+        if name in code_categories:
+            # Already zero-padded, so they are kept as they are
+            cols[name] = categorical_codes(name, list(codes), inverse) if compact else codes.astype(object)[inverse]
+        else:
+            cols[name] = codes.astype(np.int64)[inverse]
+
+    # Split the 24 hourly blocks into value (5 chars) and validity flag (1 char)
+    blocks = arr[:, 20:pollution_txt_width].reshape(nrows, 24, 6)
+    digits = blocks[:, :, :5] - np.uint8(ord('0'))
+    horas = digits.astype(np.float32) @ np.array([10000, 1000, 100, 10, 1], dtype=np.float32)
+    # Values which are not plain 5-digit integers (signs, decimals, blanks) are decoded by numpy
+    odd = (digits > 9).any(axis=2)
+    if odd.any():
+        values = np.ascontiguousarray(blocks[:, :, :5]).view('S5').reshape(nrows, 24)[odd]
+        values[np.char.strip(values) == b''] = b'nan'
+        horas[odd] = values.astype(np.float32)
+    val = blocks[:, :, 5] == ord('V')
+
+    # Build each group of columns as a single 2D block
+    dataf = pd.concat([pd.DataFrame(data=cols),
+                       pd.DataFrame(horas, columns=horasstr),
+                       pd.DataFrame(val, columns=valstr)], axis=1)
+    return compact_pollution_dtypes(dataf) if compact else normalize_pollution_keys(dataf)
+
+def parse_pollution_csv(csv_file, compact=True):
     dd = pd.read_csv(csv_file, delimiter=';')
     dd['TECNICA'] = dd['PUNTO_MUESTREO'].apply(lambda x: int(x.split('_')[-1]))
     dd.drop(columns=['PUNTO_MUESTREO'], inplace=True)
-    return dd
-
-def extract_pollution_data(txt_path):
-
+    return compact_pollution_dtypes(dd) if compact else normalize_pollution_keys(dd)
+
+def parse_pollution_file(file, cache_dir=None, compact=True):
+    # Parse one txt or csv file. Errors are returned instead of raised, so that a
+    # broken file does not abort a whole extraction.
+    try:
+        # The cache holds the frames as parsed, so the same entries serve both dtypes
+        parser = parse_pollution_txt if file.endswith('txt') else parse_pollution_csv
+        df = cache.load_cached(file, parser, cache_dir, compact=False)
+        # Entries cached before the keys were normalized are normalized here
+        return compact_pollution_dtypes(df) if compact else normalize_pollution_keys(df), None
+    except Exception as e:
+        return None, '{}: {}'.format(type(e).__name__, e)
+
+def parse_pollution_files(files, workers=1, cache_dir=None, compact=True):
+    # Parse files keeping the order of the input list. With workers > 1 the files are
+    # spread across a process pool (workers=None uses all the available cores).
+    if workers is None:
+        workers = os.cpu_count()
+    parse = partial(parse_pollution_file, cache_dir=cache_dir, compact=compact)
+    if workers <= 1 or len(files) <= 1:
+        results = [parse(file) for file in files]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(files))) as executor:
+            results = list(executor.map(parse, files))
+
+    data = [df for df, error in results if error is None]
+    failures = [(file, error) for file, (df, error) in zip(files, results) if error is not None]
+    return data, failures
+
+# Fields identifying a row of daily pollution measures, used to upsert them. The csv files
+# have no TECNICA, so it is not part of them.
+pollution_keys = ['PROVINCIA', 'MUNICIPIO', 'ESTACION', 'MAGNITUD', 'ANO', 'MES', 'DIA']
+
+def get_pollution_files(txt_path):
     folders = sorted(glob.glob(os.path.join(txt_path, 'raw', 'Anio*')))
     #print('Getting files from year {}'.format(os.path.basename(folder)[4:8]))
 
     txt_files = [sorted(glob.glob(os.path.join(folder, '*txt'))) for folder in folders]
     csv_files = [sorted(glob.glob(os.path.join(folder, '*csv'))) for folder in folders]
     # Flatten list
-    if len(txt_files) > 1:
-        txt_files = [item for sublist in txt_files for item in sublist]
-    if len(csv_files) > 1:
-        csv_files = [item for sublist in csv_files for item in sublist]
-
-    print('Parsing data...')
-    if len(txt_files) > 0:
-        data_from_txt = [parse_pollution_txt(file) for file in txt_files]
-
-    if len(csv_files) > 0:
-        data_from_csv = [parse_pollution_csv(file) for file in csv_files]
+    txt_files = [item for sublist in txt_files for item in sublist]
+    csv_files = [item for sublist in csv_files for item in sublist]
+    return txt_files, csv_files
+
+def extract_pollution_data(txt_path, workers=1, cache_dir=None, compact=True, failures=None):
+    # Frames parsed from the txt and the csv files. Files that could not be parsed are
+    # logged and left out, and their (file, error) pairs appended to failures if given.
+
+    # Incremental loads go through get_pollution_files and the manifest instead (see
+    # etl_pollution), so files are recorded only once written
+    txt_files, csv_files = get_pollution_files(txt_path)
+
+    logging.info('Parsing data...')
+    # Both kind of files go to the same pool so the work is balanced across workers
+    data, errors = parse_pollution_files(txt_files + csv_files, workers=workers, cache_dir=cache_dir,
+                                         compact=compact)
+    failed = set(file for file, _ in errors)
+    ntxt = len([file for file in txt_files if file not in failed])
+    data_from_txt = data[:ntxt]
+    data_from_csv = data[ntxt:]
+
+    for file, error in errors:
+        logging.error('Could not parse {}: {}'.format(file, error))
+    if failures is not None:
+        failures.extend(errors)
 
     return data_from_txt, data_from_csv
 
@@ -145,6 +248,6 @@ if __name__ == '__main__':
     DATASET_PATH = '/Users/adelacalle/Downloads'
     #DESTINATION_PATH = os.path.join(DATASET_PATH, 'csv')
 
-    extract_pollution_data(DATASET_PATH)
+    extract_pollution_data(DATASET_PATH, workers=None)
 
     print('Script dataclean finished')
\ No newline at end of file
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+""" manifest.py
+
+This module keeps track of the source files already ingested, so that ETL runs only
+process new or modified files. The manifest can be stored on disk or in mongo.
+"""
+
+__author__ = "Alejandro de la Calle"
+__copyright__ = "Copyright 2019"
+__credits__ = [""]
+__license__ = ""
+__version__ = "0.1"
+__maintainer__ = "Alejandro de la Calle"
+__email__ = "alejandrodelacallenegro@gmail.com"
+__status__ = "Development"
+
+
+import os
+import json
+import datetime
+from tools import cache
+
+
+def file_state(file):
+    st = os.stat(file)
+    return {'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+
+class Manifest(object):
+    """ Base manifest. Subclasses store the entries, keyed by absolute file path. """
+
+    def get(self, file):
+        raise NotImplementedError
+
+    def put(self, file, entry):
+        raise NotImplementedError
+
+    def is_changed(self, file):
+        entry = self.get(file)
+        if entry is None:
+            return True
+        state = file_state(file)
+        if entry['size'] == state['size'] and entry['mtime'] == state['mtime']:
+            return False
+        # Touched but maybe not modified. Only the checksum tells
+        return entry['checksum'] != cache.content_digest(file)
+
+    def pending(self, files):
+        # Files never ingested or changed since the last ingestion, in the given order
+        return [file for file in files if self.is_changed(file)]
+
+    def record(self, file, **info):
+        entry = {**file_state(file), 'checksum': cache.content_digest(file),
+                 'ingested': datetime.datetime.now().isoformat(), **info}
+        self.put(file, entry)
+
+
+class FileManifest(Manifest):
+
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.entries = {}
+        if os.path.exists(manifest_file):
+            with open(manifest_file, 'r') as f:
+                self.entries = json.load(f)
+
+    def get(self, file):
+        return self.entries.get(os.path.abspath(file))
+
+    def put(self, file, entry):
+        self.entries[os.path.abspath(file)] = entry
+        # Write to a temporary file first, so an interrupted run never leaves a broken manifest
+        tmp = self.manifest_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp, self.manifest_file)
+
+
+class MongoManifest(Manifest):
+
+    def __init__(self, db, coll='manifest'):
+        self.collection = db[coll]
+
+    def get(self, file):
+        return self.collection.find_one({'_id': os.path.abspath(file)})
+
+    def put(self, file, entry):
+        self.collection.replace_one({'_id': os.path.abspath(file)}, entry, upsert=True)
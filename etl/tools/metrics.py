@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+""" metrics.py
+
+This module contain a lightweight instrumentation of the ETL stages. Each stage records wall
+and CPU time, rows in and out, bytes read, memory and database write latency, and is emitted
+as a json line to the file given by the --metrics_file flag.
+"""
+
+__author__ = "Alejandro de la Calle"
+__copyright__ = "Copyright 2019"
+__credits__ = [""]
+__license__ = ""
+__version__ = "0.1"
+__maintainer__ = "Alejandro de la Calle"
+__email__ = "alejandrodelacallenegro@gmail.com"
+__status__ = "Development"
+
+
+import os
+import json
+import time
+import datetime
+import functools
+import resource
+import tracemalloc
+from contextlib import contextmanager
+from absl import flags, logging
+
+
+def define_flags():
+    flags.DEFINE_string(name='metrics_file', default=None, help='Json lines file where stage metrics are appended')
+    flags.DEFINE_string(name='metrics_summary', default=None, help='Json file with the summary of all the stages')
+    flags.DEFINE_boolean(name='metrics_trace_memory', default=False,
+                         help='Trace the peak memory allocated by each stage. Slows the stages down')
+
+
+_config = {'metrics_file': None, 'metrics_summary': None, 'trace_memory': False, 'script': None}
+_records = []
+# Names of the stages open, innermost last, to record the parent of nested stages
+_open_stages = []
+
+
+def configure(metrics_file=None, metrics_summary=None, trace_memory=False, script=None):
+    _config.update(metrics_file=metrics_file, metrics_summary=metrics_summary, trace_memory=trace_memory,
+                   script=script)
+
+
+def configure_from_flags(script=None):
+    FLAGS = flags.FLAGS
+    configure(FLAGS.metrics_file, FLAGS.metrics_summary, FLAGS.metrics_trace_memory, script=script)
+
+
+class StageRecord(object):
+    """ Metrics of one stage. The counters are filled in by the code of the stage. """
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.bytes_read = 0
+        self.write_seconds = 0.
+        self.write_batches = 0
+
+    def add_files(self, files):
+        self.bytes_read += sum(os.path.getsize(file) for file in files)
+
+    def add_write_stats(self, stats):
+        # Stats returned by database.BulkWriter
+        self.write_seconds += stats.get('write_seconds', 0.)
+        self.write_batches += stats.get('batches', 0)
+
+
+def emit(entry):
+    _records.append(entry)
+    if _config['metrics_file'] is not None:
+        with open(_config['metrics_file'], 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+
+@contextmanager
+def stage(name, rows_in=None):
+    record = StageRecord(name, rows_in)
+    tracing = _config['trace_memory'] and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    start = datetime.datetime.now()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    status = 'ok'
+    parent = _open_stages[-1] if len(_open_stages) > 0 else None
+    _open_stages.append(name)
+    try:
+        yield record
+    except BaseException:
+        status = 'failed'
+        raise
+    finally:
+        _open_stages.pop()
+        entry = {'script': _config['script'], 'stage': name, 'parent': parent, 'depth': len(_open_stages),
+                 'status': status, 'start': start.isoformat(),
+                 'wall_seconds': time.perf_counter() - wall, 'cpu_seconds': time.process_time() - cpu,
+                 'rows_in': record.rows_in, 'rows_out': record.rows_out, 'bytes_read': record.bytes_read,
+                 'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+                 'write_seconds': record.write_seconds, 'write_batches': record.write_batches}
+        if tracing:
+            entry['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+        emit(entry)
+
+
+def timed(name=None):
+    """ Decorator running the function as a stage. rows_out is the length of the result, if any. """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name or func.__name__) as record:
+                result = func(*args, **kwargs)
+                if hasattr(result, '__len__'):
+                    record.rows_out = len(result)
+                return result
+        return wrapper
+    return decorator
+
+
+def log_summary():
+    # Log the stages of this run, and write them to the summary file if one was given. Nested
+    # stages are part of the time of their parent, so only top-level stages add up to the total.
+    total = sum(entry['wall_seconds'] for entry in _records if entry['parent'] is None)
+    for entry in _records:
+        logging.info('{:<28} {:>9.2f} s wall {:>9.2f} s cpu {:>5.1f}% rows out {}'.format(
+            '  ' * entry['depth'] + entry['stage'], entry['wall_seconds'], entry['cpu_seconds'],
+            100. * entry['wall_seconds'] / total if total > 0 else 0., entry['rows_out']))
+    if _config['metrics_summary'] is not None:
+        with open(_config['metrics_summary'], 'w') as f:
+            json.dump({'script': _config['script'], 'wall_seconds': total, 'stages': _records}, f, indent=1)
@@ -0,0 +1,76 @@
+import mongomock
+import pytest
+
+from tools import database
+from etl.tools import database as etl_database
+
+# The ETL scripts use their own copy of the writer
+writers = pytest.mark.parametrize('module', [database, etl_database], ids=['tools', 'etl'])
+
+
+def make_docs(n, start=0):
+    return [{'id': i, 'day': i % 3, 'value': float(i)} for i in range(start, start + n)]
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient().aire
+
+
+@writers
+@pytest.mark.parametrize('workers', [0, 2])
+def test_duplicate_keys_are_counted_as_failed(module, workers, db):
+    db['coll'].create_index('id', unique=True)
+    db['coll'].insert_many(make_docs(5))
+    with module.BulkWriter(db, 'coll', batch_size=4, workers=workers) as writer:
+        writer.extend(make_docs(10))
+    stats = writer.stats()
+    assert stats['inserted'] == 5 and stats['failed'] == 5
+    assert db['coll'].count_documents({}) == 10
+
+
+@writers
+def test_failing_batch_is_counted_and_kept(module, db):
+    class Broken(object):
+        def insert_many(self, *args, **kwargs):
+            raise ConnectionError('connection reset')
+
+    writer = module.BulkWriter(db, 'coll', batch_size=4)
+    writer.collection = Broken()
+    writer.extend(make_docs(6))
+    stats = writer.close()
+    assert stats['inserted'] == 0 and stats['failed'] == 6 and stats['batches'] == 2
+    assert writer.errors == ['ConnectionError: connection reset'] * 2
+
+
+@writers
+@pytest.mark.parametrize('workers', [0, 2])
+def test_exit_flushes_the_last_partial_batch(module, workers, db):
+    with module.BulkWriter(db, 'coll', batch_size=4, workers=workers, max_pending=1) as writer:
+        writer.extend(make_docs(10))
+    assert writer.stats()['batches'] == 3
+    assert db['coll'].count_documents({}) == 10
+
+
+@writers
+def test_upserts_are_idempotent(module, db):
+    keys = ['id', 'day']
+    first = module.upsert_documents(db, 'coll', make_docs(7), keys=keys, batch_size=3)
+    docs = make_docs(7)
+    docs[0]['value'] = -1.
+    second = module.upsert_documents(db, 'coll', docs, keys=keys, batch_size=3, workers=2)
+    assert first['inserted'] == second['inserted'] == 7
+    assert first['failed'] == second['failed'] == 0
+    assert db['coll'].count_documents({}) == 7
+    assert db['coll'].find_one({'id': 0})['value'] == -1.
+
+
+@writers
+def test_upserts_without_keys_fail(module, db):
+    docs = make_docs(4)
+    del docs[1]['day']
+    with module.BulkWriter(db, 'coll', keys=['id', 'day']) as writer:
+        writer.extend(docs)
+    assert writer.stats()['failed'] == 1 and writer.stats()['inserted'] == 3
+    assert writer.errors[0].startswith('KeyError')
+    assert db['coll'].count_documents({}) == 3
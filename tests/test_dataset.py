@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+
+from tools.dataset import WindowDataset
+from tools.features import write_feature_store
+
+
+def make_frame(hours, substances, seed=0):
+    # Hourly pollution features of a station measuring the given substances
+    rng = np.random.default_rng(seed)
+    index = pd.date_range('2019-01-01', periods=hours, freq='h', name='date')
+    frame = pd.DataFrame(index=index)
+    for substance in substances:
+        frame[substance] = rng.gamma(4., 10., hours)
+        frame[substance + '_valid'] = 1.
+    return frame
+
+
+def test_station_missing_a_substance_has_windows(tmp_path):
+    path = str(tmp_path / 'store')
+    frames = {'28079004': make_frame(100, ['NO2', 'SO2']), '28079008': make_frame(100, ['NO2'], seed=1)}
+    frames['28079004'].iloc[50:60, frames['28079004'].columns.get_loc('SO2_valid')] = 0.
+    write_feature_store(path, frames)
+
+    ds = WindowDataset(path, lookback=24, horizon=6)
+    assert ds.targets == ['NO2', 'SO2']
+    counts = {station: int(np.sum(ds.samples[:, 0] == s)) for s, station in enumerate(ds.stations)}
+    # Station 008 has no SO2 at all, so only NO2 decides its windows
+    assert counts['28079008'] == 100 - 24 - 6 + 1
+    # Station 004 loses the windows whose horizon overlaps its invalid SO2 hours
+    assert counts['28079004'] == 100 - 24 - 6 + 1 - 15
+
+    # SO2 of station 008 is masked in every window
+    x, y, mask = ds.get_batch(np.nonzero(ds.samples[:, 0] == ds.stations.index('28079008'))[0])
+    assert mask[:, :, 0].all() and not mask[:, :, 1].any()
+
+
+def test_min_valid_is_checked_per_target(tmp_path):
+    path = str(tmp_path / 'store')
+    frame = make_frame(60, ['NO2', 'SO2'])
+    frame.iloc[40:43, frame.columns.get_loc('SO2_valid')] = 0.
+    write_feature_store(path, {'28079004': frame})
+
+    strict = WindowDataset(path, lookback=12, horizon=6)
+    loose = WindowDataset(path, lookback=12, horizon=6, min_valid=0.5)
+    assert len(loose) == 60 - 12 - 6 + 1
+    assert len(strict) == len(loose) - 8
@@ -0,0 +1,77 @@
+import datetime
+import os
+import time
+
+import mongomock
+import numpy as np
+import pandas as pd
+
+from tools import database
+from tools.features import (get_year_files, ingest_scope, new_matrix, open_feature_store, read_schema,
+                            update_feature_store, write_feature_store)
+
+
+def make_frames(start, hours, value):
+    index = pd.date_range(start, periods=hours, freq='h', name='date')
+    return {station: pd.DataFrame({'NO2': np.full(hours, value), 'hour': index.hour}, index=index)
+            for station in ['28079004', '28079008']}
+
+
+def test_grown_store_swaps_with_its_schema(tmp_path):
+    path = str(tmp_path)
+    write_feature_store(path, make_frames('2019-01-01', 48, 1.), built='2019-01-03 00:00:00')
+    first = read_schema(path)['matrix']
+
+    schema = update_feature_store(path, make_frames('2019-01-02', 48, 2.), built='2019-01-04 00:00:00')
+    matrix, schema = open_feature_store(path)
+    assert schema['matrix'] != first and schema['shape'][1] == 72
+    assert not os.path.exists(os.path.join(path, first))
+    assert schema['built'] == '2019-01-04 00:00:00'
+    no2 = schema['columns'].index('NO2')
+    assert (matrix[:, :24, no2] == 1.).all() and (matrix[:, 24:, no2] == 2.).all()
+
+
+def test_unfinished_rebuild_keeps_the_previous_store(tmp_path):
+    path = str(tmp_path)
+    write_feature_store(path, make_frames('2019-01-01', 24, 1.))
+    # A rebuild that stops after writing its matrix leaves the schema on the previous one
+    schema = dict(read_schema(path))
+    np.save(new_matrix(path, schema), np.zeros((1, 1, 1), dtype=np.float32))
+    matrix, schema = open_feature_store(path)
+    assert matrix.shape == (2, 24, 2)
+
+
+def test_in_place_update_keeps_the_matrix(tmp_path):
+    path = str(tmp_path)
+    write_feature_store(path, make_frames('2019-01-01', 48, 1.))
+    first = read_schema(path)['matrix']
+    update_feature_store(path, {'28079004': make_frames('2019-01-01', 24, 3.)['28079004']}, built='x')
+    matrix, schema = open_feature_store(path)
+    assert schema['matrix'] == first and schema['built'] == 'x'
+    no2 = schema['columns'].index('NO2')
+    assert (matrix[0, :24, no2] == 3.).all() and (matrix[0, 24:, no2] == 1.).all() and (matrix[1, :, no2] == 1.).all()
+
+
+def test_ingest_scope():
+    db = mongomock.MongoClient().aire
+    assert ingest_scope(db, None) is None
+    database.log_ingest(db, 'pollution', stations=['28079004'], start='2019-01-01', end='2019-02-01')
+    # Logged times are kept to the millisecond, and loads in the same one count as new
+    time.sleep(0.01)
+    since = database.utc_now()
+    time.sleep(0.01)
+    database.log_ingest(db, 'pollution', stations=['28079008'], start='2019-03-01', end='2019-04-01')
+    database.log_ingest(db, 'clima', start='2018-01-01', end='2020-01-01')
+
+    assert ingest_scope(db, None) == (['28079004', '28079008'], pd.Timestamp('2019-01-01'), pd.Timestamp('2019-04-01'))
+    assert ingest_scope(db, since) == (['28079008'], pd.Timestamp('2019-03-01'), pd.Timestamp('2019-04-01'))
+    assert ingest_scope(db, database.utc_now() + datetime.timedelta(seconds=1)) is None
+    database.log_ingest(db, 'pollution')
+    assert ingest_scope(db, since) == (None, None, None)
+
+
+def test_year_files():
+    files = ['/data/raw/Anio2017/datos17.txt', '/data/raw/Anio2018/datos18.txt', '/data/raw/Anio2019/datos19.csv']
+    assert get_year_files(files) == files
+    assert get_year_files(files, pd.Timestamp('2018-03-01'), pd.Timestamp('2019-01-01')) == files[1:2]
+    assert get_year_files(files, start=pd.Timestamp('2018-12-31')) == files[1:]
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+
+from tools.indicators import IndicatorEngine, batch_indicators
+
+
+def make_hourly(start='2018-12-01', days=60, seed=0):
+    # Long hourly series as returned by timeseries.to_hourly_series, crossing a year end and
+    # with missing and invalid hours
+    rng = np.random.default_rng(seed)
+    times = pd.date_range(start, periods=days * 24, freq='h')
+    frames = []
+    for station in ['28079004', '28079008']:
+        for magnitude, scale in [('14', 90.), ('10', 40.), ('09', 20.), ('08', 150.)]:
+            values = rng.gamma(4., scale / 4., len(times))
+            values[rng.random(len(times)) < 0.05] = np.nan
+            frames.append(pd.DataFrame({'station': station, 'magnitude': magnitude, 'value': values,
+                                        'valid': rng.random(len(times)) > 0.05}, index=times))
+    hourly = pd.concat(frames).sort_index(kind='stable')
+    hourly.index.name = 'date'
+    hourly['station'] = hourly['station'].astype('category')
+    hourly['magnitude'] = hourly['magnitude'].astype('category')
+    return hourly
+
+
+def sort_indicators(df):
+    df = df.reset_index()
+    df['station'] = df['station'].astype(str)
+    df['indicator'] = df['indicator'].astype(str)
+    return df.sort_values(['date', 'indicator', 'station']).reset_index(drop=True)
+
+
+def test_weekly_updates_match_batch(tmp_path):
+    hourly = make_hourly()
+    expected = batch_indicators(hourly)
+    assert expected['exceedances'].max() > 0
+
+    # Weekly blocks, with the state saved and loaded between them
+    path = str(tmp_path / 'state.json')
+    blocks = []
+    for _, block in hourly.groupby(hourly.index.to_period('W')):
+        engine = IndicatorEngine.load(path)
+        blocks.append(engine.update(block))
+        assert engine.dropped == 0
+        engine.save(path)
+    pd.testing.assert_frame_equal(sort_indicators(pd.concat(blocks)), sort_indicators(expected))
+
+
+def test_late_hours_are_counted():
+    hourly = make_hourly(days=10)
+    split = hourly.index[len(hourly) // 2]
+    engine = IndicatorEngine()
+    engine.update(hourly[hourly.index < split])
+    late = hourly[hourly.index >= split - pd.Timedelta(hours=3)]
+    engine.update(late)
+    assert engine.dropped == int((late.index < split).sum())
+    assert engine.state['dropped'] == engine.dropped
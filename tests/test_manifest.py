@@ -0,0 +1,76 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import mongomock
+import pytest
+
+from etl.tools.manifest import FileManifest, MongoManifest
+
+etl_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'etl')
+
+
+def write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+    return str(path)
+
+
+@pytest.fixture(params=['mongo', 'file'])
+def manifest(request, tmp_path):
+    if request.param == 'mongo':
+        return MongoManifest(mongomock.MongoClient().aire)
+    return FileManifest(str(tmp_path / 'manifest.json'))
+
+
+def test_unchanged_files_are_skipped(manifest, tmp_path):
+    first, second = write(tmp_path / 'a.txt', 'first'), write(tmp_path / 'b.txt', 'second')
+    assert manifest.pending([first, second]) == [first, second]
+    manifest.record(first)
+    assert manifest.pending([first, second]) == [second]
+
+    # Touched without changes: only the checksum tells, and it is the same
+    os.utime(first, ns=(0, 0))
+    assert manifest.pending([first, second]) == [second]
+
+
+def test_modified_files_are_processed_again(manifest, tmp_path):
+    file = write(tmp_path / 'a.txt', 'first')
+    manifest.record(file)
+    write(file, 'first, modified')
+    assert manifest.pending([file]) == [file]
+
+
+def test_file_manifest_persists(tmp_path):
+    file = write(tmp_path / 'a.txt', 'first')
+    FileManifest(str(tmp_path / 'manifest.json')).record(file)
+    assert FileManifest(str(tmp_path / 'manifest.json')).pending([file]) == []
+
+
+def test_files_with_failed_writes_are_not_recorded(tmp_path):
+    # One file with a record missing its date, which cannot be upserted
+    records = [{'indicativo': '3195', 'fecha': '2019-01-0{}'.format(day), 'tmed': '5,0'} for day in range(1, 4)]
+    good = write(tmp_path / 'weather_Retiro_2019-01.json', json.dumps(records))
+    bad = write(tmp_path / 'weather_Retiro_2019-02.json', json.dumps(records[:1] + [{'indicativo': '3195'}]))
+
+    # The ETL scripts import the tools package of the etl folder, so they run on their own
+    script = textwrap.dedent('''
+        import json, mongomock
+        import etl_weather
+        from tools.manifest import MongoManifest
+        db = mongomock.MongoClient().weather
+        manifest = MongoManifest(db)
+        files = etl_weather.get_weather_files({path!r})
+        stats = etl_weather.load_weather_files(files, db, 'clima', manifest=manifest)
+        print(json.dumps({{'failed': stats['failed'], 'pending': manifest.pending(files),
+                          'again': etl_weather.load_weather_files(files, db, 'clima', manifest=manifest)['inserted']}}))
+    ''').format(path=str(tmp_path))
+    result = subprocess.run([sys.executable, '-c', script], cwd=etl_dir, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    output = json.loads(result.stdout.strip().splitlines()[-1])
+    assert output['failed'] == 1
+    assert output['pending'] == [bad]
+    # Only the file that failed is loaded again
+    assert output['again'] == 1
@@ -0,0 +1,102 @@
+import threading
+import time
+
+import mongomock
+import pandas as pd
+import pytest
+
+from tools import database
+from tools.querycache import QueryCache, get_scope
+
+
+class Query(object):
+    # Stand-in for a database query, counting how many times it runs
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return pd.DataFrame({'value': [1., 2., 3.], 'call': self.calls})
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient().aire
+
+
+def load(cache, query, station='28079004', start='2019-01-01', end='2019-02-01'):
+    params = {'station': station, 'start': start, 'end': end}
+    return cache.load('query', params, get_scope('pollution', [station], start, end), query)
+
+
+def test_overlapping_ingest_invalidates(db):
+    cache, query = QueryCache(db), Query()
+    load(cache, query)
+    load(cache, query)
+    assert query.calls == 1 and cache.stats()['hits'] == 1
+
+    database.log_ingest(db, 'pollution', stations=['28079004'], start='2019-01-31', end='2019-02-01')
+    assert load(cache, query)['call'].iloc[0] == 2
+    assert cache.stats()['invalidated'] == 1
+    # The load was already logged when the query ran again, so the new entry is fresh
+    load(cache, query)
+    assert query.calls == 2
+
+
+def test_ingests_elsewhere_keep_the_entry(db):
+    cache, query = QueryCache(db), Query()
+    load(cache, query)
+    database.log_ingest(db, 'pollution', stations=['28079008'], start='2019-01-01', end='2019-02-01')
+    database.log_ingest(db, 'pollution', stations=['28079004'], start='2019-02-01', end='2019-03-01')
+    database.log_ingest(db, 'clima', start='2019-01-01', end='2019-02-01')
+    load(cache, query)
+    assert query.calls == 1 and cache.stats()['invalidated'] == 0
+
+    # A load with no stations or range covers every entry
+    database.log_ingest(db, 'pollution')
+    load(cache, query)
+    assert query.calls == 2
+
+
+def test_ttl_expires(db):
+    cache, query = QueryCache(db, ttl=0.05), Query()
+    load(cache, query)
+    load(cache, query)
+    assert query.calls == 1
+    time.sleep(0.1)
+    load(cache, query)
+    assert query.calls == 2 and cache.stats()['expired'] == 1
+
+
+def test_disk_tier_serves_a_fresh_cache(db, tmp_path):
+    query = Query()
+    first = load(QueryCache(db, disk_dir=str(tmp_path)), query)
+
+    cache = QueryCache(db, disk_dir=str(tmp_path))
+    pd.testing.assert_frame_equal(load(cache, query), first)
+    assert query.calls == 1 and cache.stats()['disk_hits'] == 1
+    # Served from memory afterwards
+    load(cache, query)
+    assert cache.stats()['hits'] == 1
+
+    # Entries on disk are checked against the ingest log as well
+    database.log_ingest(db, 'pollution', stations=['28079004'])
+    load(QueryCache(db, disk_dir=str(tmp_path)), query)
+    assert query.calls == 2
+
+
+def test_counts_across_threads(db):
+    cache, query = QueryCache(db), Query()
+    load(cache, query)
+
+    def worker():
+        for _ in range(50):
+            load(cache, query)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.stats()
+    assert stats['hits'] + stats['misses'] == 8 * 50 + 1
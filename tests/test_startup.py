@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Seconds allowed, as the --startup_budget default of bench/run_benchmarks.py
+startup_budget = 0.3
+
+
+def best_time(command, repeat=3):
+    # Fastest wall time of fresh interpreters, as in bench/run_benchmarks.measure_startup
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=root_dir, check=True, stdout=subprocess.DEVNULL)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+@pytest.mark.parametrize('command', [['bash', os.path.join(root_dir, 'bin', 'smoggy'), '--help'],
+                                     [sys.executable, '-c', 'import tools.codes']],
+                         ids=['smoggy_help', 'import_codes'])
+def test_startup_within_budget(command):
+    seconds = best_time(command)
+    assert seconds <= startup_budget, '{} took {:.3f} s against a budget of {:.3f} s'.format(
+        ' '.join(command), seconds, startup_budget)
@@ -0,0 +1,82 @@
+import mongomock
+import numpy as np
+import pandas as pd
+import pytest
+
+from tools import database as db
+from tools import timeseries as ts
+
+
+def make_documents(days=70, seed=0):
+    # Daily documents of two stations and substances in the normalized form of the parsed
+    # frames, with missing and invalid hours
+    rng = np.random.default_rng(seed)
+    docs = []
+    for station in ['28079004', '28079008']:
+        for magnitude in ['08', '10']:
+            for day in pd.date_range('2018-12-01', periods=days):
+                doc = {'PROVINCIA': station[:2], 'MUNICIPIO': station[2:5], 'ESTACION': station[5:],
+                       'MAGNITUD': magnitude, 'ANO': day.year, 'MES': day.month, 'DIA': day.day}
+                for h in range(1, 25):
+                    value = float(rng.gamma(4., 10.))
+                    # Blank hours are None in some documents and NaN (as parsed) in others
+                    blank = None if rng.random() < 0.5 else float('nan')
+                    doc['H{:02d}'.format(h)] = blank if rng.random() < 0.05 else value
+                    doc['V{:02d}'.format(h)] = bool(rng.random() > 0.05)
+                docs.append(doc)
+    return docs
+
+
+def raw_documents(docs):
+    # The same documents as loaded from raw frames: two-digit string years and 'V'/'N'
+    # flags as in the txt files, numeric codes as in the csv files
+    raw = []
+    for i, doc in enumerate(docs):
+        doc = dict(doc)
+        if i % 2 == 0:
+            doc['ANO'] = '{:02d}'.format(doc['ANO'] % 100)
+            doc['MES'] = '{:02d}'.format(doc['MES'])
+            for h in range(1, 25):
+                doc['V{:02d}'.format(h)] = 'V' if doc['V{:02d}'.format(h)] else 'N'
+        else:
+            for col in ['PROVINCIA', 'MUNICIPIO', 'ESTACION', 'MAGNITUD']:
+                doc[col] = int(doc[col])
+        raw.append(doc)
+    return raw
+
+
+@pytest.mark.parametrize('raw', [False, True])
+@pytest.mark.parametrize('period, by_day_type', [('day', False), ('month', False), ('year', True)])
+def test_pipeline_matches_frame(raw, period, by_day_type):
+    docs = make_documents()
+    database = mongomock.MongoClient().aire
+    database['pollution'].insert_many(raw_documents(docs) if raw else [dict(doc) for doc in docs])
+    stats = ('mean', 'max', 'min', 'count')
+    holidays = ['2018-12-06', '2018-12-25', '2019-01-01']
+    kwargs = dict(station='28079004', substance=['08', '10'], start='2018-12-10', end='2019-02-01', period=period,
+                  stats=stats, by_day_type=by_day_type, holidays=holidays)
+
+    result = db.pollution_statistics(database, **kwargs)
+    assert len(result) > 0
+    assert set(result['station']) == {'28079004'}
+
+    # Same statistics computed with pandas on the hours of the normalized documents
+    hourly = ts.to_hourly_series(pd.DataFrame(docs))
+    days = hourly.index.normalize()
+    hourly = hourly[(days >= pd.Timestamp('2018-12-10')) & (days < pd.Timestamp('2019-02-01')) &
+                    (hourly['station'].astype(str) == '28079004').to_numpy()]
+    expected = db.statistics_result(db.statistics_frame(hourly, period, stats, None, by_day_type,
+                                                        holidays).to_dict(orient='records'),
+                                    stats, None, by_day_type)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+    pd.testing.assert_frame_equal(db.pollution_statistics(database, engine='pandas', **kwargs), expected,
+                                  check_dtype=False)
+
+
+def test_percentiles_are_sorted_per_group():
+    pipeline = db.statistics_pipeline(period='month', percentiles=[0.5])
+    stages = [list(stage)[0] for stage in pipeline]
+    # No global sort of the hours: each group sorts the values it pushed
+    assert '$sort' not in stages
+    assert stages.index('$addFields') == stages.index('$group') + 1
+    assert pipeline[stages.index('$addFields')]['$addFields']['values']['$sortArray']['sortBy'] == 1
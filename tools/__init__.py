@@ -5,4 +5,4 @@ def add_path(path):
         sys.path.insert(0, path)
 
 
-__all__ = ["dataclean", "database"]
\ No newline at end of file
+__all__ = ["dataclean", "database", "cache", "timeseries", "spatial", "features", "dataset", "codes", "quality", "indicators", "querycache"]
\ No newline at end of file
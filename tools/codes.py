@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+""" codes.py
+
+This module contain the dictionaries of stations, substances and months of the air pollution
+and weather data. It imports nothing, so the codes are cheap to reach from any script.
+"""
+
+__author__ = "Alejandro de la Calle"
+__copyright__ = "Copyright 2019"
+__credits__ = [""]
+__license__ = ""
+__version__ = "0.1"
+__maintainer__ = "Alejandro de la Calle"
+__email__ = "alejandrodelacallenegro@gmail.com"
+__status__ = "Development"
+
+
+estaciones_aire = {'28079001': 'Plz. Recoletos', '28079002': 'Glta. Carlos V', '28079003': 'Pza. Carmen (<2011)',
+              '28079035': 'Plz. Carmen', '28079004': 'Plz. España', '28079005': 'Barrio del Pilar (<2011)',
+              '28079039': 'Barrio del Pilar', '28079006': 'Plz. Dr. Marañon', '28079007': 'Plz. M. de Salamanca',
+              '28079008': 'Escuelas Aguirre', '28079009': 'Plz. Luca de Tena', '28079010': 'Cuatro Caminos (<2011)',
+              '28079038': 'Cuatro Caminos', '28079011': 'Av. Ramón y Cajal', '28079012': 'Plz. Manuel Becerra',
+              '28079013': 'Vallecas (<2011)', '28079040': 'Vallecas', '28079014': 'Plz. Fernández Ladreda (<2009)',
+              '28079015': 'Plz. Castilla (<2008)', '28079016': 'Arturo Soria', '28079017': 'Villaverde Alto',
+              '28079018': 'C/ Farolillo', '28079019': 'Huerta Castañeda', '28079020': 'Moratalaz (<2011)',
+              '28079036': 'Moratalaz', '28079021': 'Pza. Cristo Rey', '28079022': 'P. Pontones', '28079023': 'Final Alcalá',
+              '28079024': 'Casa campo', '28079025': 'St. Eugenia', '28079026': 'Urb. Embajada-Barajas (<2010)',
+              '28079027': 'Barajas', '28079047': 'Mendez Álvaro', '28079048': 'P. Castellana', '28079049': 'Retiro',
+              '28079050': 'Plz. Castilla', '28079054': 'Ensanche Vallecas', '28079055': 'Urb. Embajada-Barajas',
+              '28079056': 'Plz. Fdz Ladreda', '28079057': 'Sanchinarro', '28079058': 'El Pardo',
+              '28079059': 'Parque Juan Carlos I', '28079086': 'Tres Olivos (<2011)', '28079060': 'Tres Olivos',
+              '28079099': 'Media global'}
+
+sustancias = {'01': 'SO2', '06': 'CO', '07': 'NO', '08': 'NO2', '09': 'PM2.5', '10': 'PM10', '12': 'NOx', '14': 'O3',
+              '20': 'TOL', '30': 'BEN', '35': 'EBE', '37': 'MXY', '38': 'PXY', '39': 'OXY', '42': 'TCH', '43': 'CH4',
+              '44': 'NMHC', '58': 'HCl'}
+
+mes = {1: 'Enero', 2: 'Febrero', 3: 'Marzo', 4: 'Abril', 5: 'Mayo', 6: 'Junio', 7: 'Julio', 8: 'Agosto',
+       9: 'Septiembre', 10: 'Octubre', 11: 'Noviembre', 12: 'Diciembre'}
+
+estaciones_meteo = {'Retiro': '3195', 'Aeropuerto': '3129', 'Ciudad_Universitaria': '3194U', 'Cuatro_Vientos': '3196'}
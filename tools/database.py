@@ -15,9 +15,18 @@ __status__ = "Development"
 
 
 import os
-from pymongo import MongoClient
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import MongoClient, ReplaceOne
+from pymongo.errors import BulkWriteError
 import glob
 import datetime
+import numpy as np
+import pandas as pd
+from bson.binary import Binary
+from tools import timeseries as ts
+from tools.codes import estaciones_aire, sustancias
 
 #MONGO_CONFIG = '/Volumes/TRIPLET/db/mongod_airdb.conf'
 
@@ -28,6 +37,18 @@ def connect_mongo_daemon(host=None, port=None):
         client = MongoClient(host, port)
     return client
 
+# Clients are thread-safe and keep their own connection pool, so they are shared
+# across the whole process.
+_shared_clients = {}
+_shared_clients_lock = threading.Lock()
+
+def get_shared_client(host=None, port=None, max_pool_size=100):
+    key = (host, port)
+    with _shared_clients_lock:
+        if key not in _shared_clients:
+            _shared_clients[key] = MongoClient(host, port, maxPoolSize=max_pool_size)
+        return _shared_clients[key]
+
 def get_mongo_database(client, dbname):
     return client[dbname]
 
@@ -42,4 +63,522 @@ def insert_many_documents(db, coll, entries):
     mycoll = db[coll]
     return mycoll.insert_many(entries).inserted_ids
 
-#def mongo_lookup(query):
+class BulkWriter(object):
+    """ Buffer documents and write them to a collection in unordered batches.
+
+    With workers > 0 the batches are flushed on a thread pool, overlapping the
+    network round-trips with the production of new documents. At most max_pending
+    batches (twice the workers if not given) are in flight, so a fast producer waits
+    for the oldest write instead of queueing every batch in memory. If keys are given,
+    documents are upserted on those fields instead of inserted, so writes are
+    idempotent. Documents of a batch that raised are counted as failed, and the error
+    is kept in errors. Stats are available through the stats() method, or returned by close().
+    """
+
+    def __init__(self, db, coll, batch_size=1000, workers=0, keys=None, max_pending=None):
+        self.collection = db[coll]
+        self.keys = keys
+        self.batch_size = batch_size
+        self.buffer = []
+        self.inserted = 0
+        self.failed = 0
+        self.write_seconds = 0.
+        self.batches = 0
+        self.errors = []
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        self.futures = []
+        self.max_pending = max_pending or 2 * workers
+        self.start = time.perf_counter()
+        self.end = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, entry):
+        self.buffer.append(entry)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def extend(self, entries):
+        for entry in entries:
+            self.add(entry)
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        batch, self.buffer = self.buffer, []
+        if self.executor is None:
+            self._write(batch)
+        else:
+            # Wait for the oldest writes while too many are in flight
+            while len(self.futures) >= self.max_pending:
+                self.futures.pop(0).result()
+            self.futures.append(self.executor.submit(self._write, batch))
+
+    def _write(self, batch):
+        start = time.perf_counter()
+        try:
+            if self.keys is None:
+                inserted = len(self.collection.insert_many(batch, ordered=False).inserted_ids)
+            else:
+                requests = self.upserts(batch)
+                if len(requests) < len(batch):
+                    with self.lock:
+                        self.errors.append('KeyError: {} documents without all of the keys {}'.format(
+                            len(batch) - len(requests), self.keys))
+                inserted = 0
+                if len(requests) > 0:
+                    result = self.collection.bulk_write(requests, ordered=False)
+                    inserted = result.upserted_count + result.matched_count
+        except BulkWriteError as e:
+            # Not every server reports all of the counts
+            inserted = sum(e.details.get(count, 0) for count in ('nInserted', 'nUpserted', 'nMatched'))
+        except Exception as e:
+            # Network errors and the like: nothing of the batch is known to be written
+            inserted = 0
+            with self.lock:
+                self.errors.append('{}: {}'.format(type(e).__name__, e))
+        with self.lock:
+            self.inserted += inserted
+            self.failed += len(batch) - inserted
+            self.write_seconds += time.perf_counter() - start
+            self.batches += 1
+
+    def upserts(self, batch):
+        # Documents missing any of the keys are not written (they count as failed), as a
+        # filter without them could replace an unrelated document
+        return [ReplaceOne({key: entry[key] for key in self.keys}, entry, upsert=True)
+                for entry in batch if all(key in entry for key in self.keys)]
+
+    def sync(self):
+        # Flush and wait for every pending write
+        self.flush()
+        for future in self.futures:
+            future.result()
+        self.futures = []
+
+    def close(self):
+        self.sync()
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.end = time.perf_counter()
+        return self.stats()
+
+    def stats(self):
+        seconds = (self.end or time.perf_counter()) - self.start
+        return {'inserted': self.inserted, 'failed': self.failed, 'seconds': seconds,
+                'docs_per_second': self.inserted / seconds if seconds > 0 else 0.,
+                'write_seconds': self.write_seconds, 'batches': self.batches}
+
+def bulk_insert_documents(db, coll, entries, batch_size=1000, workers=0):
+    # Drop-in replacement for insert_many_documents. Returns the writer stats.
+    with BulkWriter(db, coll, batch_size=batch_size, workers=workers) as writer:
+        writer.extend(entries)
+    return writer.stats()
+
+def upsert_documents(db, coll, entries, keys, batch_size=1000, workers=0):
+    # Replace the documents matching the keys of each entry, inserting them if missing
+    with BulkWriter(db, coll, batch_size=batch_size, workers=workers, keys=keys) as writer:
+        writer.extend(entries)
+    return writer.stats()
+
+##############################################################################
+## Ingest log. Every load appends the stations and time range it wrote, so that query
+## results cached by other processes (see tools.querycache) can tell when they are stale.
+
+ingest_log_coll = 'ingest_log'
+
+def utc_now():
+    # Naive UTC time, as pymongo stores and returns dates
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def log_ingest(db, coll, stations=None, start=None, end=None):
+    # stations (codes) and [start, end) as None stand for all of them
+    entry = {'coll': coll, 'stations': None if stations is None else sorted(set(str(s) for s in stations)),
+             'start': None if start is None else pd.Timestamp(start).to_pydatetime(),
+             'end': None if end is None else pd.Timestamp(end).to_pydatetime(),
+             'time': utc_now()}
+    return db[ingest_log_coll].insert_one(entry).inserted_id
+
+##############################################################################
+## Bucketed pollution documents: one document per station, magnitude and month,
+## holding the hourly values as packed float32 and the validity flags as packed bits.
+
+def pollution_to_buckets(df):
+    values, valid = ts.get_hourly_blocks(df, mask_invalid=False)
+    days = ts.get_day_array(df)
+    months = days.astype('datetime64[M]')
+    dayofmonth = (days - months.astype('datetime64[D]')).astype(np.int64)
+
+    keys = pd.DataFrame({'station': ts.get_station_codes(df), 'magnitude': ts.get_magnitude_codes(df),
+                         'month': months})
+    buckets = []
+    for (station, magnitude, month), rows in keys.groupby(['station', 'magnitude', 'month'], sort=True).indices.items():
+        start = pd.Timestamp(month)
+        end = start + pd.DateOffset(months=1)
+        ndays = (end - start).days
+        hourly = np.full((ndays, 24), np.nan, dtype=np.float32)
+        ok = np.zeros((ndays, 24), dtype=bool)
+        hourly[dayofmonth[rows]] = values[rows]
+        ok[dayofmonth[rows]] = valid[rows]
+        buckets.append({'_id': '{}_{}_{}'.format(station, magnitude, start.strftime('%Y%m')),
+                        'station': station, 'magnitude': magnitude,
+                        'start': start.to_pydatetime(), 'end': end.to_pydatetime(), 'nhours': ndays * 24,
+                        'values': Binary(hourly.tobytes()), 'valid': Binary(np.packbits(ok).tobytes())})
+    return buckets
+
+def buckets_to_series(buckets, start=None, end=None):
+    # Long hourly series, in the same layout as timeseries.to_hourly_series
+    times, values, valid, stations, magnitudes = [], [], [], [], []
+    for bucket in buckets:
+        nhours = bucket['nhours']
+        times.append(np.datetime64(bucket['start'], 'h') + np.arange(nhours, dtype='timedelta64[h]'))
+        values.append(np.frombuffer(bucket['values'], dtype=np.float32))
+        valid.append(np.unpackbits(np.frombuffer(bucket['valid'], dtype=np.uint8))[:nhours].astype(bool))
+        stations.append(bucket['station'])
+        magnitudes.append(bucket['magnitude'])
+    lengths = [len(t) for t in times]
+
+    hourly = pd.DataFrame({'station': pd.Categorical(np.repeat(stations, lengths)),
+                           'magnitude': pd.Categorical(np.repeat(magnitudes, lengths)),
+                           'value': np.concatenate(values) if values else np.zeros(0, dtype=np.float32),
+                           'valid': np.concatenate(valid) if valid else np.zeros(0, dtype=bool)},
+                          index=pd.DatetimeIndex(np.concatenate(times) if times else [], name='date'))
+    if start is not None:
+        hourly = hourly[hourly.index >= pd.Timestamp(start)]
+    if end is not None:
+        hourly = hourly[hourly.index < pd.Timestamp(end)]
+    return hourly.sort_index(kind='stable')
+
+def write_pollution_buckets(db, coll, df, batch_size=500, workers=0):
+    # Buckets are replaced as a whole, so df must hold complete months
+    buckets = pollution_to_buckets(df)
+    try:
+        return upsert_documents(db, coll, buckets, keys=['_id'], batch_size=batch_size, workers=workers)
+    finally:
+        # Logged even if the upsert failed part way, as the batches written did change the collection
+        if len(buckets) > 0:
+            log_ingest(db, coll, stations=[bucket['station'] for bucket in buckets],
+                       start=min(bucket['start'] for bucket in buckets),
+                       end=max(bucket['end'] for bucket in buckets))
+
+def bucket_query(station=None, magnitude=None, start=None, end=None):
+    query = {}
+    for field, value in [('station', station), ('magnitude', magnitude)]:
+        if value is not None:
+            query[field] = {'$in': list(value)} if isinstance(value, (list, tuple, set)) else value
+    # Buckets overlapping [start, end)
+    if start is not None:
+        query['end'] = {'$gt': pd.Timestamp(start).to_pydatetime()}
+    if end is not None:
+        query['start'] = {'$lt': pd.Timestamp(end).to_pydatetime()}
+    return query
+
+def read_pollution_buckets(db, coll, station=None, magnitude=None, start=None, end=None):
+    cursor = db[coll].find(bucket_query(station, magnitude, start, end)).sort([('station', 1), ('magnitude', 1),
+                                                                               ('start', 1)])
+    return buckets_to_series(cursor, start=start, end=end)
+
+##############################################################################
+## Indexes
+
+# Indexes expected in each collection: one document per station, magnitude and day
+# ('pollution'), monthly buckets ('pollution_buckets'), measure points ('pmed') and loads
+# by time ('ingest_log'). The fields the loaders upsert on have a unique index, so each
+# upsert is an index lookup instead of a collection scan: daily pollution records
+# ('pollution'), density readings and their hourly aggregates ('density' and
+# 'density_hourly'), and weather stations and their daily records ('historic' and 'clima').
+# Specs are lists of (field, direction) pairs, or dicts with them as 'keys' and the
+# options of create_index.
+index_specs = {'pollution': [[('ESTACION', 1), ('MAGNITUD', 1), ('ANO', 1), ('MES', 1), ('DIA', 1)],
+                             {'keys': [('PROVINCIA', 1), ('MUNICIPIO', 1), ('ESTACION', 1), ('MAGNITUD', 1),
+                                       ('ANO', 1), ('MES', 1), ('DIA', 1)], 'unique': True}],
+               'pollution_buckets': [[('station', 1), ('magnitude', 1), ('start', 1)]],
+               'pmed': [[('location', '2dsphere')]],
+               'density': [{'keys': [('id', 1), ('idelem', 1), ('fecha', 1)], 'unique': True}],
+               'density_hourly': [{'keys': [('id', 1), ('fecha', 1)], 'unique': True}],
+               'historic': [{'keys': [('indicativo', 1)], 'unique': True}],
+               'clima': [{'keys': [('indicativo', 1), ('fecha', 1)], 'unique': True}],
+               ingest_log_coll: [[('coll', 1), ('time', 1)]]}
+
+def get_index_options(spec):
+    # Keys and create_index options of an index spec
+    if isinstance(spec, dict):
+        return list(spec['keys']), {option: value for option, value in spec.items() if option != 'keys'}
+    return list(spec), {}
+
+def create_bucket_indexes(db, coll):
+    return db[coll].create_index(index_specs['pollution_buckets'][0])
+
+def missing_indexes(db, specs=None, colls=None):
+    # (collection, spec) pairs of the specs with no matching index. A unique spec is only
+    # matched by a unique index.
+    specs = index_specs if specs is None else specs
+    missing = []
+    for coll, indexes in specs.items():
+        if colls is not None and coll not in colls:
+            continue
+        existing = {tuple((field, direction) for field, direction in info['key']): info.get('unique', False)
+                    for info in db[coll].index_information().values()}
+        for spec in indexes:
+            keys, options = get_index_options(spec)
+            if tuple(keys) not in existing or (options.get('unique', False) and not existing[tuple(keys)]):
+                missing.append((coll, spec))
+    return missing
+
+def ensure_indexes(db, specs=None, colls=None):
+    # Create the missing indexes (of the given collections only, if any), and check
+    # afterwards that all of them exist
+    for coll, spec in missing_indexes(db, specs, colls):
+        keys, options = get_index_options(spec)
+        db[coll].create_index(keys, **options)
+    missing = missing_indexes(db, specs, colls)
+    if len(missing) > 0:
+        raise RuntimeError('Could not create indexes: {}'.format(missing))
+
+##############################################################################
+## Queries returning dataframes
+
+def mongo_lookup(db, coll, query=None, projection=None, dtypes=None, sort=None, batch_size=10000):
+    # Stream the cursor in batches, turning each batch into a typed frame as soon as it
+    # is complete, so that the raw documents of only one batch are alive at a time.
+    cursor = db[coll].find(query or {}, projection, batch_size=batch_size)
+    if sort is not None:
+        cursor = cursor.sort(sort)
+    columns = None
+    if projection is not None and not isinstance(projection, dict):
+        columns = list(projection)
+    elif projection is not None and all(projection.values()):
+        columns = [field for field in projection if field != '_id']
+
+    frames = []
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) == batch_size:
+            frames.append(records_to_frame(batch, columns, dtypes))
+            batch = []
+    if len(batch) > 0 or len(frames) == 0:
+        frames.append(records_to_frame(batch, columns, dtypes))
+    return pd.concat(frames, ignore_index=True)
+
+def records_to_frame(records, columns=None, dtypes=None):
+    df = pd.DataFrame.from_records(records, columns=columns)
+    if dtypes is not None:
+        df = df.astype({col: dtype for col, dtype in dtypes.items() if col in df.columns})
+    return df
+
+def get_station_code(station):
+    # Station given either by its code or by its name in estaciones_aire
+    if station in estaciones_aire:
+        return station
+    codes = {name: code for code, name in estaciones_aire.items()}
+    if station not in codes:
+        raise KeyError('Unknown air quality station: {}'.format(station))
+    return codes[station]
+
+def get_substance_code(substance):
+    # Substance given either by its magnitude code or by its name in sustancias
+    if substance in sustancias:
+        return substance
+    codes = {name: code for code, name in sustancias.items()}
+    if substance not in codes:
+        raise KeyError('Unknown substance: {}'.format(substance))
+    return codes[substance]
+
+def query_pollution(db, coll='pollution_buckets', station=None, substance=None, start=None, end=None,
+                    batch_size=1000):
+    # Hourly series of the given stations and substances (names or codes, single or lists)
+    # between start and end, read from the bucketed collection.
+    if station is not None:
+        station = [get_station_code(s) for s in np.atleast_1d(station)]
+    if substance is not None:
+        substance = [get_substance_code(s) for s in np.atleast_1d(substance)]
+    projection = {'station': 1, 'magnitude': 1, 'start': 1, 'nhours': 1, 'values': 1, 'valid': 1, '_id': 0}
+    cursor = db[coll].find(bucket_query(station, substance, start, end), projection, batch_size=batch_size)
+    cursor = cursor.sort([('station', 1), ('magnitude', 1), ('start', 1)])
+    return buckets_to_series(cursor, start=start, end=end)
+
+##############################################################################
+## Statistics computed on the server. Requests are compiled into aggregation pipelines over
+## the daily documents of 'pollution' (see etl_pollution), so only the statistics cross the
+## wire. statistics_frame computes the same on a local hourly series, for verification.
+
+statistic_operators = {'mean': '$avg', 'max': '$max', 'min': '$min', 'count': None}
+
+def percentile_name(q):
+    return 'p{:g}'.format(100 * q)
+
+def get_day_type(dayofweek, holiday):
+    # Day types of the working calendar. dayofweek as in pandas (Monday is 0)
+    return np.where(holiday, 'festivo', np.where(dayofweek == 6, 'domingo',
+                                                 np.where(dayofweek == 5, 'sabado', 'laborable')))
+
+def code_forms(code):
+    # Codes are zero-padded strings in the documents of parsed frames, but documents loaded
+    # from raw csv frames may hold them as numbers
+    return [code, int(code)]
+
+def year_forms(first, last):
+    # Full years in [first, last], and their two-digit forms (strings or numbers) as in the
+    # txt files, read as in etl_utils.normalize_pollution_keys (years 1950 to 2049)
+    years = {}
+    if first is not None:
+        years['$gte'] = first
+    if last is not None:
+        years['$lte'] = last
+    two_digit = ['{:02d}'.format(year % 100) for year in range(max(first or 1950, 1950), min(last or 2049, 2049) + 1)]
+    return [{'ANO': years}, {'ANO': {'$in': two_digit + [int(year) for year in two_digit]}}]
+
+def statistics_match(station=None, substance=None, start=None, end=None):
+    # Filter on the fields of the daily documents, so that the index of 'pollution' is used.
+    # Codes and years match both their normalized and their raw forms.
+    match = {}
+    conditions = []
+    if station is not None:
+        codes = [get_station_code(s) for s in np.atleast_1d(station)]
+        conditions.append({'$or': [{'PROVINCIA': {'$in': code_forms(code[:2])},
+                                    'MUNICIPIO': {'$in': code_forms(code[2:5])},
+                                    'ESTACION': {'$in': code_forms(code[5:])}} for code in codes]})
+    if substance is not None:
+        match['MAGNITUD'] = {'$in': [form for s in np.atleast_1d(substance)
+                                     for form in code_forms(get_substance_code(s))]}
+    if start is not None or end is not None:
+        first = pd.Timestamp(start).year if start is not None else None
+        last = (pd.Timestamp(end) - pd.Timedelta(1)).year if end is not None else None
+        conditions.append({'$or': year_forms(first, last)})
+    if len(conditions) > 0:
+        match['$and'] = conditions
+    return match
+
+def padded_code(field, width):
+    # Zero-padded string of a code stored either as a string or as a number
+    return {'$substr': [{'$toString': {'$add': [10 ** width, {'$toInt': field}]}}, 1, width]}
+
+def document_date(year='$ANO', month='$MES', day='$DIA'):
+    # Date of a daily document. Two-digit years, as in the txt files, are read as in
+    # etl_utils.normalize_pollution_keys
+    century = {'$cond': [{'$gte': ['$$year', 100]}, 0, {'$cond': [{'$lt': ['$$year', 50]}, 2000, 1900]}]}
+    return {'$let': {'vars': {'year': {'$toInt': year}},
+                     'in': {'$dateFromParts': {'year': {'$add': ['$$year', century]},
+                                               'month': {'$toInt': month}, 'day': {'$toInt': day}}}}}
+
+def statistics_pipeline(station=None, substance=None, start=None, end=None, period='month', stats=('mean', 'max'),
+                        percentiles=None, by_day_type=False, holidays=None):
+    """ Aggregation pipeline of the statistics of the valid hours of every station and
+    substance, per day, month or year. With by_day_type, also per day type of the working
+    calendar: laborable, sabado, domingo or festivo (days in holidays). """
+    percentiles = list(percentiles or [])
+    # One element per hour, from a document of expressions (an array literal of them is not
+    # evaluated by every server). Validity flags are booleans, or 'V' in documents of raw frames
+    hours = {'$objectToArray': {'H{:02d}'.format(h): {'value': '$H{:02d}'.format(h),
+                                                       'valid': {'$in': ['$V{:02d}'.format(h), [True, 'V']]}}
+                                for h in range(1, 25)}}
+    codes = [padded_code('$PROVINCIA', 2), padded_code('$MUNICIPIO', 3), padded_code('$ESTACION', 3)]
+    pipeline = [{'$match': statistics_match(station, substance, start, end)},
+                {'$project': {'_id': 0, 'station': {'$concat': codes}, 'magnitude': padded_code('$MAGNITUD', 2),
+                              'date': document_date(), 'hours': hours}}]
+    dates = {}
+    if start is not None:
+        dates['$gte'] = pd.Timestamp(start).to_pydatetime()
+    if end is not None:
+        dates['$lt'] = pd.Timestamp(end).to_pydatetime()
+    if len(dates) > 0:
+        pipeline.append({'$match': {'date': dates}})
+    # Blank hours are None or NaN (as the parsers leave them). NaN sorts below -inf, and
+    # neither passes a numeric comparison
+    pipeline += [{'$unwind': '$hours'},
+                 {'$match': {'hours.v.valid': True, 'hours.v.value': {'$gte': float('-inf')}}}]
+
+    periods = {'day': '$date',
+               'month': {'$dateFromParts': {'year': {'$year': '$date'}, 'month': {'$month': '$date'}}},
+               'year': {'$dateFromParts': {'year': {'$year': '$date'}}}}
+    key = {'station': '$station', 'magnitude': '$magnitude', 'period': periods[period]}
+    if by_day_type:
+        holidays = [pd.Timestamp(day).normalize().to_pydatetime() for day in (holidays or [])]
+        key['day_type'] = {'$switch': {'branches': [{'case': {'$in': ['$date', holidays]}, 'then': 'festivo'},
+                                                    {'case': {'$eq': [{'$dayOfWeek': '$date'}, 1]}, 'then': 'domingo'},
+                                                    {'case': {'$eq': [{'$dayOfWeek': '$date'}, 7]}, 'then': 'sabado'}],
+                                       'default': 'laborable'}}
+
+    group = {'_id': key}
+    for stat in stats:
+        group[stat] = {'$sum': 1} if stat == 'count' else {statistic_operators[stat]: '$hours.v.value'}
+    if len(percentiles) > 0:
+        group['values'] = {'$push': '$hours.v.value'}
+    pipeline.append({'$group': group})
+    if len(percentiles) > 0:
+        # Each group sorts its own values, so percentiles are picked from the sorted arrays
+        pipeline.append({'$addFields': {'values': {'$sortArray': {'input': '$values', 'sortBy': 1}}}})
+
+    project = {'_id': 0, 'station': '$_id.station', 'magnitude': '$_id.magnitude', 'period': '$_id.period'}
+    if by_day_type:
+        project['day_type'] = '$_id.day_type'
+    project.update({stat: 1 for stat in stats})
+    for q in percentiles:
+        # Linear interpolation between the closest ranks, as pandas quantile does
+        position = {'$multiply': [q, {'$subtract': [{'$size': '$values'}, 1]}]}
+        project[percentile_name(q)] = {'$let': {
+            'vars': {'low': {'$arrayElemAt': ['$values', {'$floor': position}]},
+                     'high': {'$arrayElemAt': ['$values', {'$ceil': position}]},
+                     'fraction': {'$subtract': [position, {'$floor': position}]}},
+            'in': {'$add': ['$$low', {'$multiply': [{'$subtract': ['$$high', '$$low']}, '$$fraction']}]}}}
+    pipeline.append({'$project': project})
+    return pipeline
+
+def statistics_frame(hourly, period='month', stats=('mean', 'max'), percentiles=None, by_day_type=False,
+                     holidays=None):
+    """ Same statistics as statistics_pipeline, computed with pandas on a long hourly series
+    (see timeseries.to_hourly_series). """
+    percentiles = list(percentiles or [])
+    hourly = hourly[hourly['valid'].to_numpy(dtype=bool) & hourly['value'].notna().to_numpy()]
+    days = hourly.index.normalize()
+    periods = {'day': days, 'month': days.to_period('M').to_timestamp(), 'year': days.to_period('Y').to_timestamp()}
+    keys = pd.DataFrame({'station': hourly['station'].astype(str).to_numpy(),
+                         'magnitude': hourly['magnitude'].astype(str).to_numpy(),
+                         'period': periods[period]})
+    if by_day_type:
+        holiday = days.isin(pd.DatetimeIndex([pd.Timestamp(day).normalize() for day in (holidays or [])]))
+        keys['day_type'] = get_day_type(days.dayofweek, holiday)
+    grouped = pd.Series(hourly['value'].to_numpy(dtype=np.float64)).groupby([keys[col] for col in keys.columns])
+    functions = {'mean': 'mean', 'max': 'max', 'min': 'min', 'count': 'count'}
+    result = pd.concat([grouped.agg(functions[stat]).rename(stat) for stat in stats] +
+                       [grouped.quantile(q).rename(percentile_name(q)) for q in percentiles], axis=1)
+    return result.reset_index()
+
+def statistics_result(records, stats, percentiles, by_day_type):
+    keys = ['station', 'magnitude', 'period'] + (['day_type'] if by_day_type else [])
+    columns = keys + list(stats) + [percentile_name(q) for q in (percentiles or [])]
+    df = pd.DataFrame.from_records(list(records), columns=columns)
+    return df.sort_values(keys, kind='stable').reset_index(drop=True)
+
+def pollution_statistics(db, coll='pollution', station=None, substance=None, start=None, end=None, period='month',
+                         stats=('mean', 'max'), percentiles=None, by_day_type=False, holidays=None, engine='mongo'):
+    """ Statistics of the hourly values of the given stations and substances (names or
+    codes) in [start, end). engine='pandas' reads the hours and computes them locally,
+    giving the same result as the server for verification. Percentiles on the server need
+    $sortArray (MongoDB 5.2). """
+    if engine == 'mongo':
+        pipeline = statistics_pipeline(station, substance, start, end, period, stats, percentiles, by_day_type,
+                                       holidays)
+        records = db[coll].aggregate(pipeline, allowDiskUse=True)
+    else:
+        daily = mongo_lookup(db, coll, statistics_match(station, substance, start, end), {'_id': 0})
+        if len(daily) == 0:
+            records = []
+        else:
+            hourly = ts.to_hourly_series(daily)
+            # Days in [start, end), as the server filters them
+            days = hourly.index.normalize()
+            if start is not None:
+                hourly = hourly[days >= pd.Timestamp(start)]
+                days = hourly.index.normalize()
+            if end is not None:
+                hourly = hourly[days < pd.Timestamp(end)]
+            records = statistics_frame(hourly, period, stats, percentiles, by_day_type,
+                                       holidays).to_dict(orient='records')
+    return statistics_result(records, stats, percentiles, by_day_type)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+""" dataset.py
+
+This module serves (lookback, horizon) windows of the feature store for training sequence
+models. Windows are strided views over the memory-mapped matrix, so only the batches being
+consumed are ever read into memory.
+"""
+
+__author__ = "Alejandro de la Calle"
+__copyright__ = "Copyright 2019"
+__credits__ = [""]
+__license__ = ""
+__version__ = "0.1"
+__maintainer__ = "Alejandro de la Calle"
+__email__ = "alejandrodelacallenegro@gmail.com"
+__status__ = "Development"
+
+
+import queue
+import threading
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from tools.features import open_feature_store
+
+
+class WindowDataset(object):
+    """ Sliding (lookback, horizon) windows over a feature store.
+
+    Inputs are the lookback hours of every feature column, and targets the following
+    horizon hours of the target columns. By default targets are the substances, and
+    their validity comes from the '<substance>_valid' columns (the V flags of the raw
+    files). Windows where a target has less than min_valid of valid hours are skipped.
+    Targets a station never measures do not count for its windows: they are left to the
+    mask, as any other invalid hour.
+    """
+
+    def __init__(self, path, lookback, horizon, targets=None, features=None, stations=None, stride=1,
+                 min_valid=1.):
+        self.matrix, self.schema = open_feature_store(path, mode='r')
+        self.lookback = lookback
+        self.horizon = horizon
+        columns = self.schema['columns']
+
+        if targets is None:
+            targets = [col for col in columns if col + '_valid' in columns]
+        self.targets = list(targets)
+        self.features = list(features) if features is not None else list(columns)
+        self.feature_idx = np.array([columns.index(col) for col in self.features])
+        self.all_features = self.features == list(columns)
+        self.target_idx = np.array([columns.index(col) for col in self.targets])
+        valid_idx = [columns.index(col + '_valid') if col + '_valid' in columns else None for col in self.targets]
+
+        if stations is None:
+            stations = self.schema['stations']
+        self.stations = list(stations)
+        self.station_idx = np.array([self.schema['stations'].index(s) for s in self.stations])
+
+        # (station, hour, target) validity. Targets with no validity column are valid when not NaN
+        nhours = self.matrix.shape[1]
+        self.valid = np.zeros((len(self.stations), nhours, len(self.targets)), dtype=bool)
+        for s, station in enumerate(self.station_idx):
+            for t, (target, valid) in enumerate(zip(self.target_idx, valid_idx)):
+                values = self.matrix[station, :, target]
+                ok = ~np.isnan(values)
+                if valid is not None:
+                    ok &= self.matrix[station, :, valid] > 0
+                self.valid[s, :, t] = ok
+
+        # Samples are (station, first hour) pairs. The fraction of valid hours of every target
+        # and window is computed at once with a cumulative sum.
+        nwindows = nhours - lookback - horizon + 1
+        starts = np.arange(0, max(nwindows, 0), stride)
+        counts = np.concatenate([np.zeros((len(self.stations), 1, len(self.targets)), dtype=np.int64),
+                                 np.cumsum(self.valid, axis=1)], axis=1)
+        fraction = (counts[:, starts + lookback + horizon] - counts[:, starts + lookback]) / horizon
+        measured = self.valid.any(axis=1)[:, None, :]
+        ok = np.all((fraction >= min_valid) | ~measured, axis=2) & measured.any(axis=2)
+        station_pos, start_pos = np.nonzero(ok)
+        self.samples = np.column_stack([station_pos, starts[start_pos]])
+
+    def __len__(self):
+        return len(self.samples)
+
+    def window(self, i):
+        # Inputs, targets and target validity of sample i. Inputs are a view over the store
+        # unless a subset of features was chosen.
+        s, t = self.samples[i]
+        station = self.station_idx[s]
+        x = self.matrix[station, t:t + self.lookback]
+        if not self.all_features:
+            x = x[:, self.feature_idx]
+        y = self.matrix[station, t + self.lookback:t + self.lookback + self.horizon][:, self.target_idx]
+        mask = self.valid[s, t + self.lookback:t + self.lookback + self.horizon]
+        return x, y, mask
+
+    def station_windows(self, station):
+        # All the lookback windows of a station as a single strided view of shape
+        # (nhours - lookback + 1, nfeatures, lookback)
+        return sliding_window_view(self.matrix[self.schema['stations'].index(station)], self.lookback, axis=0)
+
+    def get_batch(self, ids):
+        s = self.samples[ids, 0]
+        t = self.samples[ids, 1]
+        stations = self.station_idx[s]
+        # Gather every window of the batch with a single fancy indexing per array
+        past = t[:, None] + np.arange(self.lookback)
+        future = t[:, None] + self.lookback + np.arange(self.horizon)
+        x = self.matrix[stations[:, None], past]
+        if not self.all_features:
+            x = x[:, :, self.feature_idx]
+        y = self.matrix[stations[:, None], future][:, :, self.target_idx]
+        mask = self.valid[s[:, None], future]
+        return x, y, mask
+
+    def batches(self, batch_size, shuffle=False, seed=None, prefetch=0, drop_last=False):
+        """ Iterate over (x, y, mask) batches. With prefetch > 0, up to that many batches are
+        prepared ahead on a background thread. """
+        order = np.arange(len(self))
+        if shuffle:
+            np.random.default_rng(seed).shuffle(order)
+        stop = len(order) - len(order) % batch_size if drop_last else len(order)
+        chunks = [order[i:i + batch_size] for i in range(0, stop, batch_size)]
+        if prefetch <= 0:
+            for ids in chunks:
+                yield self.get_batch(ids)
+            return
+
+        batches = queue.Queue(maxsize=prefetch)
+        done = object()
+        stop_event = threading.Event()
+
+        def producer():
+            try:
+                for ids in chunks:
+                    if stop_event.is_set():
+                        return
+                    batches.put(self.get_batch(ids))
+            except Exception as e:
+                batches.put(e)
+                return
+            batches.put(done)
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop_event.set()
+            # Unblock the producer if it is waiting on a full queue
+            while thread.is_alive():
+                try:
+                    batches.get_nowait()
+                except queue.Empty:
+                    thread.join(timeout=0.01)
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+""" features.py
+
+This module assembles the model inputs: pollution, traffic, weather and calendar data are
+aligned on one hourly index per air quality station and stored as a memory-mapped float32
+matrix of shape (stations, hours, features), together with a json schema.
+
+The schema names the matrix file it describes. A rebuilt or grown matrix is written under a
+new name, and the store is swapped by renaming the new schema over the old one.
+"""
+
+__author__ = "Alejandro de la Calle"
+__copyright__ = "Copyright 2019"
+__credits__ = [""]
+__license__ = ""
+__version__ = "0.1"
+__maintainer__ = "Alejandro de la Calle"
+__email__ = "alejandrodelacallenegro@gmail.com"
+__status__ = "Development"
+
+
+import os
+import sys
+import glob
+import json
+import numpy as np
+import pandas as pd
+from absl import flags, app, logging
+from tools.codes import sustancias
+
+
+# Matrix of stores written before the schema named it
+matrix_file = 'features.npy'
+schema_file = 'schema.json'
+
+
+##############################################################################
+## Sources. Each of them is turned into a frame sorted by time, to be joined as-of.
+
+def pollution_features(hourly, station):
+    # One column per substance and a 0/1 column with its validity, from a long hourly
+    # series (see timeseries.to_hourly_series)
+    df = hourly[hourly['station'] == station]
+    magnitude = df['magnitude'].astype(str).map(lambda m: sustancias.get(m, m))
+    values = df['value'].groupby([df.index, magnitude]).last().unstack()
+    valid = df['valid'].groupby([df.index, magnitude]).last().unstack().astype(np.float32)
+    valid.columns = [col + '_valid' for col in valid.columns]
+    return pd.concat([values, valid], axis=1).sort_index()
+
+def traffic_features(traffic, station, time_column='fecha'):
+    # Hourly traffic aggregated per station (see spatial.aggregate_by_station)
+    if isinstance(traffic.index, pd.MultiIndex):
+        if station not in traffic.index.get_level_values('station'):
+            return None
+        df = traffic.xs(station, level='station')
+    else:
+        df = traffic
+    df = df.reset_index().set_index(time_column).sort_index()
+    return df.select_dtypes('number').add_prefix('traffic_')
+
+def to_number(series):
+    # Spanish decimal commas. Anything else that is not a number (e.g. 'Ip') is NaN
+    if series.dtype.kind in 'ifb':
+        return series.astype(np.float64)
+    return pd.to_numeric(series.astype(str).str.replace(',', '.', regex=False), errors='coerce')
+
+def weather_features(weather, columns=None, meteo_station=None):
+    # Daily AEMET records. Records of several meteo stations are averaged, unless one is chosen.
+    df = weather
+    if meteo_station is not None and 'indicativo' in df.columns:
+        df = df[df['indicativo'] == meteo_station]
+    columns = columns or [col for col in df.columns if col not in ('fecha', 'indicativo', 'nombre', 'provincia',
+                                                                    'altitud', 'horatmin', 'horatmax', 'horaracha',
+                                                                    'horaPresMax', 'horaPresMin', 'dir')]
+    values = pd.DataFrame({col: to_number(df[col]) for col in columns})
+    values.index = pd.to_datetime(df['fecha'])
+    return values.groupby(level=0).mean().sort_index().add_prefix('weather_')
+
+def calendar_features(calendar):
+    # Daily calendar flags, from the frame of etl_calendar.parse_calendar
+    days = pd.to_datetime(calendar['Dia'], format='%d/%m/%Y')
+    daytype = [col for col in calendar.columns if 'festivo' in col.lower()]
+    if len(daytype) == 0:
+        raise ValueError('No day type column (named after festivo) in the calendar: {}'.format(list(calendar.columns)))
+    daytype = daytype[0]
+    kind = calendar[daytype].astype(str).str.lower()
+    features = pd.DataFrame({'holiday': kind.str.contains('festivo').astype(np.float32).to_numpy()},
+                            index=days)
+    return features[~features.index.duplicated()].sort_index()
+
+def asof_join(index, frame, tolerance):
+    # Align frame on the hourly index, taking for each hour the last row not older than tolerance
+    if frame is None or len(frame) == 0:
+        return pd.DataFrame(index=index)
+    left = pd.DataFrame({'_time': index})
+    right = frame.rename_axis('_time').reset_index()
+    right['_time'] = right['_time'].astype(left['_time'].dtype)
+    joined = pd.merge_asof(left, right, on='_time', direction='backward', tolerance=tolerance)
+    return joined.set_index('_time').rename_axis(index.name)
+
+def build_station_features(station, start, end, pollution, traffic=None, weather=None, calendar=None):
+    """ Hourly features of one station in [start, end). Daily sources are broadcast to every hour. """
+    index = pd.date_range(start, end, freq='h', inclusive='left', name='date')
+    parts = [asof_join(index, pollution_features(pollution, station), pd.Timedelta(0))]
+    if traffic is not None:
+        parts.append(asof_join(index, traffic_features(traffic, station), pd.Timedelta(hours=1)))
+    if weather is not None:
+        parts.append(asof_join(index, weather_features(weather), pd.Timedelta(days=1) - pd.Timedelta(1)))
+    if calendar is not None:
+        parts.append(asof_join(index, calendar_features(calendar), pd.Timedelta(days=1) - pd.Timedelta(1)))
+    features = pd.concat(parts, axis=1)
+
+    features['hour'] = index.hour.astype(np.float32)
+    features['dayofweek'] = index.dayofweek.astype(np.float32)
+    features['month'] = index.month.astype(np.float32)
+    # Hours with no record are neither valid nor holidays
+    flags = [col for col in features.columns if col.endswith('_valid') or col == 'holiday']
+    features[flags] = features[flags].fillna(0.)
+    return features.astype(np.float32)
+
+
+##############################################################################
+## Feature store
+
+def read_schema(path):
+    with open(os.path.join(path, schema_file), 'r') as f:
+        return json.load(f)
+
+def new_matrix(path, schema):
+    # Name of the next version of the matrix, so it never overwrites the one in use
+    version = 1
+    if os.path.exists(os.path.join(path, schema_file)):
+        version = read_schema(path).get('version', 0) + 1
+    schema['version'] = version
+    schema['matrix'] = 'features-{}.npy'.format(version)
+    return os.path.join(path, schema['matrix'])
+
+def replace_store(path, schema):
+    # The schema is written to a temporary file and renamed over the previous one, which is
+    # the only step that swaps the store: a crash before it leaves the previous schema
+    # pointing to the previous matrix. The previous matrix is removed afterwards.
+    previous = None
+    if os.path.exists(os.path.join(path, schema_file)):
+        previous = read_schema(path).get('matrix', matrix_file)
+    tmp = os.path.join(path, schema_file + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(schema, f, indent=1)
+    os.replace(tmp, os.path.join(path, schema_file))
+    if previous is not None and previous != schema.get('matrix', matrix_file):
+        try:
+            os.remove(os.path.join(path, previous))
+        except FileNotFoundError:
+            pass
+
+def get_time_index(schema):
+    return pd.date_range(schema['start'], periods=schema['shape'][1], freq='h', name='date')
+
+def open_feature_store(path, mode='r'):
+    # Memory-mapped (stations, hours, features) matrix and its schema
+    schema = read_schema(path)
+    matrix = np.load(os.path.join(path, schema.get('matrix', matrix_file)), mmap_mode=mode)
+    if list(matrix.shape) != schema['shape']:
+        raise ValueError('Feature store matrix of shape {} does not match its schema {}'.format(
+            list(matrix.shape), schema['shape']))
+    return matrix, schema
+
+def write_feature_store(path, frames, columns=None, built=None):
+    """ Create the store from a dict of hourly feature frames, one per station. built is the
+    time of the data it was built from (see ingest_scope). """
+    os.makedirs(path, exist_ok=True)
+    stations = sorted(frames)
+    columns = columns or sorted(set(col for frame in frames.values() for col in frame.columns))
+    start = min(frame.index.min() for frame in frames.values())
+    end = max(frame.index.max() for frame in frames.values()) + pd.Timedelta(hours=1)
+    nhours = int((end - start) / pd.Timedelta(hours=1))
+
+    schema = {'stations': stations, 'columns': columns, 'start': str(start), 'freq': 'h',
+              'shape': [len(stations), nhours, len(columns)], 'dtype': 'float32',
+              'built': None if built is None else str(built)}
+    matrix = np.lib.format.open_memmap(new_matrix(path, schema), mode='w+', dtype=np.float32,
+                                       shape=tuple(schema['shape']))
+    matrix[:] = np.nan
+    write_frames(matrix, schema, frames)
+    matrix.flush()
+    del matrix
+    replace_store(path, schema)
+    return schema
+
+def write_frames(matrix, schema, frames):
+    index = get_time_index(schema)
+    for station, frame in frames.items():
+        s = schema['stations'].index(station)
+        rows = index.get_indexer(frame.index)
+        if np.any(rows < 0):
+            raise ValueError('Hours of station {} out of the feature store range'.format(station))
+        matrix[s, rows] = frame.reindex(columns=schema['columns']).to_numpy(dtype=np.float32)
+
+def update_feature_store(path, frames, built=None):
+    """ Overwrite the time ranges covered by frames, growing the store if they go past its end.
+
+    Only the hours in the given frames are rewritten, so new data only needs the affected
+    range to be rebuilt with build_station_features (see ingest_scope).
+    """
+    matrix, schema = open_feature_store(path, mode='r+')
+    if built is not None:
+        schema['built'] = str(built)
+    index = get_time_index(schema)
+    end = max(frame.index.max() for frame in frames.values()) + pd.Timedelta(hours=1)
+    unknown = [station for station in frames if station not in schema['stations']]
+    if len(unknown) > 0:
+        raise KeyError('Stations not in the feature store: {}'.format(unknown))
+
+    if end <= index[-1] + pd.Timedelta(hours=1):
+        # Same shape, so the hours are written in place and only the build time changes
+        write_frames(matrix, schema, frames)
+        matrix.flush()
+        if built is not None:
+            replace_store(path, schema)
+        return schema
+
+    # Copy into a larger matrix, which replaces the store once written. Hours not covered
+    # yet are NaN
+    nhours = int((end - index[0]) / pd.Timedelta(hours=1))
+    grown = np.lib.format.open_memmap(new_matrix(path, schema), mode='w+', dtype=np.float32,
+                                      shape=(matrix.shape[0], nhours, matrix.shape[2]))
+    grown[:, :matrix.shape[1]] = matrix
+    grown[:, matrix.shape[1]:] = np.nan
+    schema['shape'][1] = nhours
+    write_frames(grown, schema, frames)
+    grown.flush()
+    del matrix, grown
+    replace_store(path, schema)
+    return schema
+
+
+##############################################################################
+## Feature build. Run from the root of the repository as python -m tools.features
+
+def define_flags():
+    flags.DEFINE_string(name='pollution_path', default=None, help='Path to the folder with the raw/Anio* folders')
+    flags.DEFINE_string(name='cache_dir', default=None, help='Path to the cache of parsed files')
+    flags.DEFINE_string(name='calendar_file', default=None, help='Calendar csv file')
+    flags.DEFINE_string(name='weather_path', default=None, help='Folder with the AEMET weather_*.json files')
+    flags.DEFINE_string(name='traffic_path', default=None, help='Folder with the hourly traffic parquet files')
+    flags.DEFINE_string(name='station_mapping', default=None, help='Parquet file with the station -> pmed mapping')
+    flags.DEFINE_list(name='stations', default=None, help='Stations to build. All of them if not given')
+    flags.DEFINE_string(name='start', default=None, help='First day. The first day with pollution if not given')
+    flags.DEFINE_string(name='end', default=None,
+                        help='Day after the last one. The day after the last one with pollution if not given')
+    flags.DEFINE_string(name='output_path', default=None, help='Folder of the feature store')
+    flags.DEFINE_boolean(name='update', default=False,
+                         help='Update the range of an existing store instead of creating it. Without start and '
+                              'end, the range is that of the pollution loaded since the last build, taken from the '
+                              'ingest log of the database')
+    flags.DEFINE_string(name='mongo_host', default=None, help='Host of the database with the ingest log')
+    flags.DEFINE_integer(name='mongo_port', default=None, help='Port of the database with the ingest log')
+
+
+def ingest_scope(db, since, colls=('pollution',)):
+    """ Stations and [start, end) days loaded into colls after since, from the ingest log
+    (see database.log_ingest). None if nothing was loaded. Any of them is None when some
+    load covered all of them. """
+    from tools.database import ingest_log_coll
+    query = {'coll': {'$in': list(colls)}}
+    if since is not None:
+        # Times are kept to the millisecond, and a load counted twice is only rebuilt twice
+        query['time'] = {'$gte': pd.Timestamp(since).floor('ms').to_pydatetime()}
+    entries = list(db[ingest_log_coll].find(query, {'stations': 1, 'start': 1, 'end': 1}))
+    if len(entries) == 0:
+        return None
+    stations, starts, ends = ([entry.get(field) for entry in entries] for field in ('stations', 'start', 'end'))
+    return (None if None in stations else sorted(set(s for entry in stations for s in entry)),
+            None if None in starts else pd.Timestamp(min(starts)),
+            None if None in ends else pd.Timestamp(max(ends)))
+
+
+def get_year_files(files, start=None, end=None):
+    # Pollution files of the raw/AnioYYYY folders overlapping [start, end)
+    years = [int(os.path.basename(os.path.dirname(file))[4:8]) for file in files]
+    return [file for file, year in zip(files, years)
+            if (start is None or year >= start.year) and (end is None or year <= (end - pd.Timedelta(1)).year)]
+
+
+def load_sources(start=None, end=None):
+    # Hourly pollution of the years overlapping [start, end), and the optional traffic,
+    # weather and calendar sources
+    from tools import dataclean, timeseries, spatial
+    txt_files, csv_files = dataclean.get_pollution_files(FLAGS.pollution_path)
+    data, failures = dataclean.parse_pollution_files(get_year_files(txt_files + csv_files, start, end),
+                                                     workers=None, cache_dir=FLAGS.cache_dir)
+    for file, error in failures:
+        logging.error('Could not parse {}: {}'.format(file, error))
+    if len(data) == 0:
+        raise ValueError('No pollution files between {} and {} in {}'.format(start, end, FLAGS.pollution_path))
+    pollution = timeseries.to_hourly_series(pd.concat(data, ignore_index=True))
+
+    traffic = None
+    if FLAGS.traffic_path is not None:
+        hourly = pd.concat([pd.read_parquet(file) for file in
+                            sorted(glob.glob(os.path.join(FLAGS.traffic_path, '*_hourly.parquet')))])
+        columns = [col for col in hourly.columns if col.endswith('_mean')]
+        traffic = spatial.aggregate_by_station(hourly, spatial.load_station_mapping(FLAGS.station_mapping),
+                                               columns, by=['fecha'])
+
+    weather = None
+    if FLAGS.weather_path is not None:
+        records = []
+        for file in sorted(glob.glob(os.path.join(FLAGS.weather_path, 'weather_*.json'))):
+            with open(file, 'r') as f:
+                records += json.load(f)
+        weather = pd.DataFrame(records)
+
+    calendar = None
+    if FLAGS.calendar_file is not None:
+        calendar = pd.read_csv(FLAGS.calendar_file, encoding='latin1', delimiter=';')
+    return pollution, traffic, weather, calendar
+
+
+def main(argv):
+    logging.info('=' * 80)
+    logging.info(' ' * 20 + 'Feature build')
+    logging.info('=' * 80)
+
+    if FLAGS.pollution_path is None or FLAGS.output_path is None:
+        logging.error('Paths to the pollution data and to the feature store must be provided.')
+        sys.exit(1)
+    if FLAGS.traffic_path is not None and FLAGS.station_mapping is None:
+        logging.error('A station mapping is needed to use the traffic data.')
+        sys.exit(1)
+
+    # Loads logged from now on are left for the next build
+    built = pd.Timestamp.now(tz='UTC').tz_localize(None)
+    update = FLAGS.update and os.path.exists(os.path.join(FLAGS.output_path, schema_file))
+    if FLAGS.update and not update:
+        logging.info('No feature store in {} yet, so it is created'.format(FLAGS.output_path))
+    start = pd.Timestamp(FLAGS.start) if FLAGS.start is not None else None
+    end = pd.Timestamp(FLAGS.end) if FLAGS.end is not None else None
+    stations = FLAGS.stations
+    if update:
+        schema = read_schema(FLAGS.output_path)
+        if start is None and end is None and FLAGS.mongo_host is not None:
+            from tools import database as db
+            client = db.connect_mongo_daemon(host=FLAGS.mongo_host, port=FLAGS.mongo_port)
+            scope = ingest_scope(db.get_mongo_database(client, 'aire'), schema.get('built'))
+            if scope is None:
+                logging.info('No pollution loaded since the last build at {}'.format(schema.get('built')))
+                return
+            ingested, start, end = scope
+            stations = stations or ingested
+        # Only stations and hours of the store can be updated
+        stations = [s for s in (stations or schema['stations']) if s in schema['stations']]
+        start = max(start, pd.Timestamp(schema['start'])) if start is not None else pd.Timestamp(schema['start'])
+
+    pollution, traffic, weather, calendar = load_sources(start, end)
+    start = start if start is not None else pollution.index.min().floor('D')
+    end = end if end is not None else pollution.index.max().floor('D') + pd.Timedelta(days=1)
+    stations = stations or sorted(pollution['station'].unique())
+
+    logging.info('Building features of {} stations between {} and {}'.format(len(stations), start, end))
+    frames = {station: build_station_features(station, start, end, pollution, traffic, weather, calendar)
+              for station in stations}
+    if update:
+        schema = update_feature_store(FLAGS.output_path, frames, built=built)
+    else:
+        schema = write_feature_store(FLAGS.output_path, frames, built=built)
+    logging.info('Feature store of shape {} written to {}'.format(schema['shape'], FLAGS.output_path))
+    logging.info('=' * 80)
+
+
+if __name__ == '__main__':
+    FLAGS = flags.FLAGS
+    define_flags()
+    app.run(main)
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+""" indicators.py
+
+This module computes the regulatory air quality indicators (8-hour rolling O3 mean, 24-hour
+PM10 and PM2.5 means and hourly NO2) together with their daily maximum and the exceedances
+counted along each year.
+
+Indicators are computed on blocks of new hours. The state carried between blocks is the last
+hours of each station and substance and the running daily maximum and yearly count of each
+indicator, so the cost of an update does not depend on the length of the history. The
+state can be saved to a json file. A backfill is the same computation, vectorized over the
+whole history with an empty state.
+"""
+
+__author__ = "Alejandro de la Calle"
+__copyright__ = "Copyright 2019"
+__credits__ = [""]
+__license__ = ""
+__version__ = "0.1"
+__maintainer__ = "Alejandro de la Calle"
+__email__ = "alejandrodelacallenegro@gmail.com"
+__status__ = "Development"
+
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from absl import logging
+
+
+# Rolling means need min_valid valid hours in their window (75%, as in the EU directive).
+# Exceedances of threshold are counted per hour, or per day when the daily maximum goes over it.
+indicator_specs = {'o3_8h': {'magnitude': '14', 'window': 8, 'min_valid': 6, 'threshold': 120., 'per': 'day'},
+                   'pm10_24h': {'magnitude': '10', 'window': 24, 'min_valid': 18, 'threshold': 50., 'per': 'day'},
+                   'pm25_24h': {'magnitude': '09', 'window': 24, 'min_valid': 18, 'threshold': None, 'per': 'day'},
+                   'no2_1h': {'magnitude': '08', 'window': 1, 'min_valid': 1, 'threshold': 200., 'per': 'hour'}}
+
+one_hour = np.timedelta64(1, 'h')
+
+
+def rolling_mean(values, window, min_valid):
+    """ Mean of the last window hours of every row, NaN if less than min_valid of them are
+    valid. values starts with the window - 1 hours before the first output hour. """
+    ok = ~np.isnan(values)
+    zeros = np.zeros((values.shape[0], 1))
+    sums = np.concatenate([zeros, np.cumsum(np.where(ok, values, 0.), axis=1)], axis=1)
+    counts = np.concatenate([zeros, np.cumsum(ok, axis=1)], axis=1)
+    total = sums[:, window:] - sums[:, :-window]
+    valid = counts[:, window:] - counts[:, :-window]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(valid >= min_valid, total / valid, np.nan)
+
+
+def day_grid(values, first_hour, carry):
+    # Rows laid out as whole days, starting at the midnight before first_hour. The hour
+    # before the first one holds the carry (NaN if the day of first_hour is a new one).
+    offset = int((first_hour - first_hour.astype('datetime64[D]')) / one_hour)
+    ndays = -(-(offset + values.shape[1]) // 24)
+    grid = np.full((values.shape[0], ndays * 24), np.nan)
+    grid[:, offset:offset + values.shape[1]] = values
+    if offset > 0:
+        grid[:, offset - 1] = carry
+    return grid, offset
+
+
+def daily_running_max(values, first_hour, carry):
+    """ Maximum of every day up to each hour, and whether that hour is the first one of its
+    day going over the threshold (see exceedance_events). """
+    grid, offset = day_grid(values, first_hour, carry)
+    running = np.fmax.accumulate(grid.reshape(len(grid), -1, 24), axis=2).reshape(len(grid), -1)
+    previous = np.concatenate([np.full((len(grid), 1), np.nan), running[:, :-1]], axis=1)
+    previous[:, ::24] = np.nan
+    return running[:, offset:offset + values.shape[1]], previous[:, offset:offset + values.shape[1]]
+
+
+def exceedance_events(values, daily_max, previous_max, threshold, per):
+    with np.errstate(invalid='ignore'):
+        if per == 'hour':
+            return values > threshold
+        # A day counts once, at the hour its maximum goes over the threshold
+        return (daily_max > threshold) & ~(previous_max > threshold)
+
+
+def yearly_counts(events, times, carry):
+    """ Events counted from the start of the year of each hour. carry is the count of the
+    year of the first hour before it. """
+    years = times.astype('datetime64[Y]')
+    starts = np.concatenate([[0], np.nonzero(years[1:] != years[:-1])[0] + 1])
+    segment = np.repeat(starts, np.diff(np.concatenate([starts, [len(times)]])))
+    cumulative = np.concatenate([np.zeros((len(events), 1), dtype=np.int64), np.cumsum(events, axis=1)], axis=1)
+    counts = cumulative[:, 1:] - cumulative[:, segment]
+    counts[:, :starts[1] if len(starts) > 1 else len(times)] += carry[:, None]
+    return counts
+
+
+def get_pairs(hourly):
+    # (station, magnitude) pairs of a long hourly series and the pair of each row
+    stations = pd.Categorical(hourly['station'].astype(str) if hourly['station'].dtype != 'category'
+                              else hourly['station'])
+    magnitudes = pd.Categorical(hourly['magnitude'])
+    codes = stations.codes.astype(np.int64) * len(magnitudes.categories) + magnitudes.codes.astype(np.int64)
+    pairs, pair_idx = np.unique(codes, return_inverse=True)
+    pairs = [(str(stations.categories[p // len(magnitudes.categories)]),
+              str(magnitudes.categories[p % len(magnitudes.categories)])) for p in pairs]
+    return pairs, pair_idx
+
+
+def nan_to_none(values):
+    return [None if np.isnan(v) else float(v) for v in values]
+
+
+def none_to_nan(values):
+    return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+
+class IndicatorEngine(object):
+    """ Indicators of consecutive blocks of hourly pollution.
+
+    Each call to update takes the long hourly series of the new hours (see
+    timeseries.to_hourly_series) and returns their indicators. Hours before the end of
+    the previous block cannot be added to indicators already returned, so they are dropped
+    with a warning and counted in dropped (last update) and in the 'dropped' entry of the
+    state (every update). Late data needs a backfill with batch_indicators.
+    """
+
+    def __init__(self, specs=None, state=None):
+        self.specs = indicator_specs if specs is None else specs
+        self.history = max(spec['window'] for spec in self.specs.values()) - 1
+        self.state = state or {'end': None, 'tails': {}, 'daily_max': {}, 'exceedances': {}}
+        self.state.setdefault('dropped', 0)
+        self.dropped = 0
+
+    def save(self, path):
+        # Write to a temporary file first, so an interrupted save never leaves a broken state
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, specs=None):
+        if not os.path.exists(path):
+            return cls(specs)
+        with open(path, 'r') as f:
+            return cls(specs, json.load(f))
+
+    def update(self, hourly):
+        magnitudes = set(spec['magnitude'] for spec in self.specs.values())
+        hourly = hourly[hourly['magnitude'].astype(str).isin(magnitudes).to_numpy()]
+        times = hourly.index.to_numpy().astype('datetime64[h]')
+        end = np.datetime64(self.state['end'], 'h') if self.state['end'] is not None else None
+        self.dropped = int(np.count_nonzero(times < end)) if end is not None else 0
+        if self.dropped > 0:
+            logging.warning('Dropped {} hours before the end of the previous block ({})'.format(
+                self.dropped, self.state['end']))
+            self.state['dropped'] += self.dropped
+            hourly = hourly[times >= end]
+            times = times[times >= end]
+        if len(hourly) == 0:
+            return pd.DataFrame(columns=['station', 'indicator', 'value', 'daily_max', 'exceedances'],
+                                index=pd.DatetimeIndex([], name='date'))
+
+        # Hourly grid of the block. It starts right at the end of the previous block when the
+        # kept hours are still within the windows of the new ones.
+        start = times.min()
+        contiguous = end is not None and start - end <= self.history * one_hour
+        if contiguous:
+            start = end
+        grid_times = np.arange(start, times.max() + one_hour, one_hour)
+
+        pairs, pair_idx = get_pairs(hourly)
+        known = set(pairs)
+        pairs += [tuple(key.split('_')) for key in self.state['tails'] if tuple(key.split('_')) not in known]
+        values = np.where(hourly['valid'].to_numpy(dtype=bool), hourly['value'].to_numpy(dtype=np.float64), np.nan)
+        dense = np.full((len(pairs), len(grid_times) + self.history), np.nan)
+        dense[pair_idx, self.history + ((times - start) / one_hour).astype(np.int64)] = values
+        if contiguous:
+            for p, (station, magnitude) in enumerate(pairs):
+                tail = self.state['tails'].get(station + '_' + magnitude)
+                if tail is not None:
+                    dense[p, :self.history] = none_to_nan(tail)
+
+        # Running daily maximum and yearly counts go on only within the same day and year
+        last = end - one_hour if end is not None else None
+        same_day = last is not None and last.astype('datetime64[D]') == start.astype('datetime64[D]')
+        same_year = last is not None and last.astype('datetime64[Y]') == start.astype('datetime64[Y]')
+
+        frames = []
+        for name, spec in self.specs.items():
+            rows = [p for p, (_, magnitude) in enumerate(pairs) if magnitude == spec['magnitude']]
+            if len(rows) == 0:
+                continue
+            keys = [pairs[p][0] + '_' + name for p in rows]
+            carry_max = np.array([self.state['daily_max'].get(key) if same_day else None for key in keys],
+                                 dtype=np.float64)
+            carry_count = np.array([self.state['exceedances'].get(key, 0) if same_year else 0 for key in keys],
+                                   dtype=np.int64)
+
+            window = dense[rows, self.history - spec['window'] + 1:]
+            means = rolling_mean(window, spec['window'], spec['min_valid'])
+            daily_max, previous_max = daily_running_max(means, start, carry_max)
+            if spec['threshold'] is None:
+                counts = np.zeros(means.shape, dtype=np.int64)
+            else:
+                events = exceedance_events(means, daily_max, previous_max, spec['threshold'], spec['per'])
+                counts = yearly_counts(events, grid_times, carry_count)
+
+            for key, maximum, count in zip(keys, daily_max[:, -1], counts[:, -1]):
+                self.state['daily_max'][key] = None if np.isnan(maximum) else float(maximum)
+                self.state['exceedances'][key] = int(count)
+            frames.append(pd.DataFrame({'station': np.repeat([pairs[p][0] for p in rows], len(grid_times)),
+                                        'indicator': name, 'value': means.ravel().astype(np.float32),
+                                        'daily_max': daily_max.ravel().astype(np.float32),
+                                        'exceedances': counts.ravel().astype(np.int32)},
+                                       index=pd.DatetimeIndex(np.tile(grid_times, len(rows)), name='date')))
+
+        for p, (station, magnitude) in enumerate(pairs):
+            self.state['tails'][station + '_' + magnitude] = nan_to_none(dense[p, dense.shape[1] - self.history:])
+        self.state['end'] = str(grid_times[-1] + one_hour)
+
+        indicators = pd.concat(frames)
+        indicators['station'] = indicators['station'].astype('category')
+        indicators['indicator'] = indicators['indicator'].astype('category')
+        return indicators.sort_index(kind='stable')
+
+
+def batch_indicators(hourly, specs=None):
+    """ Indicators of the whole history at once, as for a backfill. """
+    return IndicatorEngine(specs).update(hourly)
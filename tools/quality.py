@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+""" quality.py
+
+This module cleans the hourly pollution data of all stations and substances at once. Hours
+are flagged as missing, invalid (V flag of the raw files) or implausible for their substance,
+short gaps are filled by linear interpolation, and a quality report is drawn per station and
+substance. Everything works on the dense (pairs, hours) arrays of timeseries.to_dense_hourly.
+"""
+
+__author__ = "Alejandro de la Calle"
+__copyright__ = "Copyright 2019"
+__credits__ = [""]
+__license__ = ""
+__version__ = "0.1"
+__maintainer__ = "Alejandro de la Calle"
+__email__ = "alejandrodelacallenegro@gmail.com"
+__status__ = "Development"
+
+
+import numpy as np
+import pandas as pd
+from tools.codes import estaciones_aire, sustancias
+from tools.timeseries import to_dense_hourly
+
+
+# Flag of every hour. Hours filled by interpolation keep the reason why they were empty
+# only through this flag.
+flag_codes = {'ok': 0, 'missing': 1, 'invalid': 2, 'implausible': 3, 'interpolated': 4}
+
+# Plausible hourly values of each substance, in the units of the open data (mg/m3 for CO and
+# the hydrocarbons TCH, CH4 and NMHC, ug/m3 for the rest). Values outside are sensor faults.
+plausible_ranges = {'SO2': (0., 1000.), 'CO': (0., 50.), 'NO': (0., 2000.), 'NO2': (0., 1000.),
+                    'PM2.5': (0., 1000.), 'PM10': (0., 2000.), 'NOx': (0., 3000.), 'O3': (0., 500.),
+                    'TOL': (0., 500.), 'BEN': (0., 100.), 'EBE': (0., 200.), 'MXY': (0., 200.),
+                    'PXY': (0., 200.), 'OXY': (0., 200.), 'TCH': (0., 20.), 'CH4': (0., 20.),
+                    'NMHC': (0., 5.), 'HCl': (0., 100.)}
+
+
+def get_dense_quality(df, start=None, end=None):
+    """ Dense hourly values and validity. Returns the hourly index, the (station, magnitude)
+    pairs, the raw values (NaN on hours with no record) and the boolean validity mask. """
+    index, pairs, values = to_dense_hourly(df, mask_invalid=False, start=start, end=end)
+    _, _, masked = to_dense_hourly(df, mask_invalid=True, start=start, end=end)
+    # Hours with a value that was masked are those flagged as invalid
+    valid = ~np.isnan(masked) | np.isnan(values)
+    return index, pairs, values, valid
+
+
+def get_range_bounds(pairs, ranges=None):
+    # Lower and upper plausible bound of every pair. Substances with no range are not bounded
+    ranges = plausible_ranges if ranges is None else ranges
+    bounds = [ranges.get(sustancias.get(magnitude, magnitude), (-np.inf, np.inf)) for _, magnitude in pairs]
+    bounds = np.array(bounds, dtype=np.float64).reshape(len(pairs), 2)
+    return bounds[:, 0], bounds[:, 1]
+
+
+def implausible_mask(values, pairs, ranges=None):
+    low, high = get_range_bounds(pairs, ranges)
+    with np.errstate(invalid='ignore'):
+        return (values < low[:, None]) | (values > high[:, None])
+
+
+def find_runs(mask):
+    """ Runs of True along the last axis of a 2d mask. Returns the row, start and length of
+    every run, ordered by row and start. """
+    padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return rows, starts, ends - starts
+
+
+def interpolate_short_gaps(values, max_gap, runs=None):
+    """ Fill gaps of NaN of at most max_gap hours by linear interpolation between the hours
+    on both sides. Gaps at the edges are not filled. Returns the filled copy of values and
+    the mask of the hours filled. """
+    rows, starts, lengths = find_runs(np.isnan(values)) if runs is None else runs
+    short = (lengths <= max_gap) & (starts > 0) & (starts + lengths < values.shape[1])
+    rows, starts, lengths = rows[short], starts[short], lengths[short]
+
+    # One entry per filled hour: its row, its position and its step within the gap
+    total = int(lengths.sum())
+    gap = np.repeat(np.arange(len(lengths)), lengths)
+    step = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths) + 1
+    fill_rows = rows[gap]
+    fill_cols = starts[gap] + step - 1
+    left = values[rows, starts - 1][gap]
+    right = values[rows, starts + lengths][gap]
+
+    filled = values.copy()
+    filled[fill_rows, fill_cols] = left + (right - left) * step / (lengths[gap] + 1)
+    mask = np.zeros(values.shape, dtype=bool)
+    mask[fill_rows, fill_cols] = True
+    return filled, mask
+
+
+def clean_dense(values, valid, pairs, max_gap=3, ranges=None):
+    """ Clean dense hourly values. Invalid and implausible hours are set to NaN, and gaps of
+    at most max_gap hours are interpolated (max_gap=0 disables it).
+    Returns the cleaned float32 values and the uint8 flags of every hour. """
+    flags = np.zeros(values.shape, dtype=np.uint8)
+    flags[np.isnan(values)] = flag_codes['missing']
+    flags[~valid] = flag_codes['invalid']
+    implausible = implausible_mask(values, pairs, ranges) & valid
+    flags[implausible] = flag_codes['implausible']
+
+    cleaned = np.where(flags == flag_codes['ok'], values, np.nan).astype(np.float32)
+    if max_gap > 0:
+        cleaned, filled = interpolate_short_gaps(cleaned, max_gap)
+        flags[filled] = flag_codes['interpolated']
+    return cleaned, flags
+
+
+def clean_pollution(df, max_gap=3, ranges=None, start=None, end=None):
+    """ Clean a frame of daily pollution records (txt or csv parse). Returns the hourly
+    index, the (station, magnitude) pairs, the cleaned values and their flags. """
+    index, pairs, values, valid = get_dense_quality(df, start=start, end=end)
+    cleaned, flags = clean_dense(values, valid, pairs, max_gap=max_gap, ranges=ranges)
+    return index, pairs, cleaned, flags
+
+
+def quality_report(pairs, flags):
+    """ Quality of every station and substance: fraction of hours of each flag, and the
+    number and longest of the gaps (hours left empty after cleaning) and invalid runs. """
+    hours = flags.shape[1]
+    counts = np.stack([np.count_nonzero(flags == code, axis=1) for code in flag_codes.values()], axis=1)
+    report = pd.DataFrame(counts / max(hours, 1), columns=list(flag_codes), dtype=np.float32)
+
+    empty = (flags != flag_codes['ok']) & (flags != flag_codes['interpolated'])
+    for name, mask in (('gap', empty), ('invalid_run', flags == flag_codes['invalid'])):
+        rows, _, lengths = find_runs(mask)
+        report['n' + name + 's'] = np.bincount(rows, minlength=len(pairs))
+        longest = np.zeros(len(pairs), dtype=np.int64)
+        np.maximum.at(longest, rows, lengths)
+        report['longest_' + name] = longest
+
+    report.insert(0, 'name', [estaciones_aire.get(station, station) for station, _ in pairs])
+    report.index = pd.MultiIndex.from_tuples([(station, sustancias.get(magnitude, magnitude))
+                                              for station, magnitude in pairs], names=['station', 'substance'])
+    return report
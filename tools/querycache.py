@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+""" querycache.py
+
+This module caches the results of the pollution queries of tools.database. Results are kept
+in memory, with the least recently used ones evicted first, and optionally in Arrow files on
+disk, so they outlive the process. Queries are keyed by a hash of their normalized arguments,
+so the same query written with station names or codes, or with dates as strings or
+timestamps, hits the same entry.
+
+Entries are never served after a load that wrote to their stations and time range. Loads
+append what they wrote to the ingest log (see database.log_ingest), and before serving an
+entry the cache looks in the log for a load overlapping it since it was computed.
+
+    cache = QueryCache(db, disk_dir='/data/query_cache')
+    hourly = cached_query_pollution(cache, station='Escuelas Aguirre', substance='NO2', start='2018-01-01')
+"""
+
+__author__ = "Alejandro de la Calle"
+__copyright__ = "Copyright 2019"
+__credits__ = [""]
+__license__ = ""
+__version__ = "0.1"
+__maintainer__ = "Alejandro de la Calle"
+__email__ = "alejandrodelacallenegro@gmail.com"
+__status__ = "Development"
+
+
+import os
+import glob
+import json
+import time
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from bson import ObjectId
+from tools import database
+
+
+##############################################################################
+## Keys
+
+def normalize_value(value):
+    # json-friendly value that is the same for equivalent arguments
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (datetime.date, np.datetime64)):
+        return pd.Timestamp(value).isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {str(key): normalize_value(v) for key, v in value.items()}
+    if isinstance(value, (list, tuple, set, np.ndarray)):
+        return [normalize_value(v) for v in value]
+    return str(value)
+
+def query_key(name, params):
+    spec = {'name': name, 'params': normalize_value(params)}
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+def get_codes(values, get_code):
+    # Sorted codes of names or codes, single or lists. None stands for all of them
+    if values is None:
+        return None
+    return sorted(set(get_code(value) for value in np.atleast_1d(values)))
+
+def get_time(value):
+    return None if value is None else pd.Timestamp(value)
+
+def get_scope(coll, stations=None, start=None, end=None):
+    # Stations and time range [start, end) read by a query
+    return {'coll': coll, 'stations': stations,
+            'start': None if start is None else pd.Timestamp(start).to_pydatetime(),
+            'end': None if end is None else pd.Timestamp(end).to_pydatetime()}
+
+def scope_to_json(scope):
+    return {key: value.isoformat() if isinstance(value, datetime.datetime) else value for key, value in scope.items()}
+
+def scope_from_json(scope):
+    return get_scope(scope['coll'], scope['stations'], scope['start'], scope['end'])
+
+
+##############################################################################
+## Invalidation
+
+def overlap_query(scope, since, seen=None):
+    """ Query of the ingest log entries written since the given time (naive UTC) to the
+    stations and time range of scope, other than those seen. Entries with no stations or
+    bounds cover all of them. """
+    query = [{'coll': scope['coll']}, {'time': {'$gte': since}}]
+    if seen:
+        query.append({'_id': {'$nin': [ObjectId(_id) for _id in seen]}})
+    if scope['stations'] is not None:
+        query.append({'$or': [{'stations': None}, {'stations': {'$in': scope['stations']}}]})
+    if scope['end'] is not None:
+        query.append({'$or': [{'start': None}, {'start': {'$lt': scope['end']}}]})
+    if scope['start'] is not None:
+        query.append({'$or': [{'end': None}, {'end': {'$gt': scope['start']}}]})
+    return {'$and': query}
+
+
+class QueryCache(object):
+    """ LRU cache of query results with a time to live, invalidated by the ingest log.
+
+    Entries are dataframes, kept in memory up to max_entries and max_bytes. With disk_dir,
+    they are also written as Arrow files, up to max_disk_bytes. Entries older than ttl
+    seconds are recomputed (None keeps them until they are invalidated or evicted).
+    Writers and readers may run on different hosts, so loads logged up to skew seconds
+    before an entry was computed also invalidate it, unless they were already in the log
+    when the query ran. """
+
+    def __init__(self, db, max_entries=256, max_bytes=512 * 2**20, ttl=None, disk_dir=None,
+                 max_disk_bytes=4 * 2**30, skew=60.):
+        self.db = db
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.skew = datetime.timedelta(seconds=skew)
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.counts = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'invalidated': 0, 'expired': 0}
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, entries=len(self.entries), nbytes=self.nbytes)
+
+    def count(self, name):
+        # The cache is shared across threads, so counters are updated under the lock too
+        with self.lock:
+            self.counts[name] += 1
+
+    def get_since(self, computed):
+        return datetime.datetime.fromisoformat(computed) - self.skew
+
+    def get_seen(self, scope, computed):
+        # Loads overlapping scope already logged when the query runs, so they are in its result
+        query = overlap_query(scope, self.get_since(computed))
+        return [str(doc['_id']) for doc in self.db[database.ingest_log_coll].find(query, {'_id': 1})]
+
+    def is_fresh(self, entry):
+        if self.ttl is not None and time.time() - entry['stored'] > self.ttl:
+            self.count('expired')
+            return False
+        query = overlap_query(entry['scope'], self.get_since(entry['computed']), entry['seen'])
+        if self.db[database.ingest_log_coll].find_one(query, {'_id': 1}) is not None:
+            self.count('invalidated')
+            return False
+        return True
+
+    ##########################################################################
+    ## Memory
+
+    def get_memory(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        return entry
+
+    def put_memory(self, key, entry):
+        with self.lock:
+            self.drop_memory(key)
+            self.entries[key] = entry
+            self.nbytes += entry['nbytes']
+            # The entry just stored is kept even if it is over max_bytes by itself
+            while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.nbytes > self.max_bytes):
+                self.drop_memory(next(iter(self.entries)))
+
+    def drop_memory(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry['nbytes']
+
+    ##########################################################################
+    ## Disk
+
+    def entry_path(self, key):
+        return os.path.join(self.disk_dir, key + '.arrow')
+
+    def get_disk(self, key):
+        from pyarrow import feather
+        path = self.entry_path(key)
+        if not os.path.exists(path):
+            return None
+        table = feather.read_table(path)
+        meta = json.loads(table.schema.metadata[b'querycache'])
+        # Touch the entry, so eviction sees it as recently used
+        os.utime(path)
+        frame = table.to_pandas()
+        return {'frame': frame, 'scope': scope_from_json(meta['scope']), 'computed': meta['computed'],
+                'seen': meta['seen'], 'stored': meta['stored'], 'nbytes': int(frame.memory_usage(deep=True).sum())}
+
+    def put_disk(self, key, entry):
+        import pyarrow as pa
+        from pyarrow import feather
+        table = pa.Table.from_pandas(entry['frame'])
+        meta = {'scope': scope_to_json(entry['scope']), 'computed': entry['computed'], 'seen': entry['seen'],
+                'stored': entry['stored']}
+        table = table.replace_schema_metadata(dict(table.schema.metadata or {}, querycache=json.dumps(meta)))
+        # Write to a temporary file first, so readers never find a broken entry
+        tmp = self.entry_path(key) + '.{}.tmp'.format(os.getpid())
+        feather.write_feather(table, tmp)
+        os.replace(tmp, self.entry_path(key))
+        self.evict_disk()
+
+    def drop_disk(self, key):
+        if self.disk_dir is not None and os.path.exists(self.entry_path(key)):
+            os.remove(self.entry_path(key))
+
+    def evict_disk(self):
+        entries = sorted(glob.glob(os.path.join(self.disk_dir, '*.arrow')), key=os.path.getmtime)
+        total = sum(os.path.getsize(entry) for entry in entries)
+        while total > self.max_disk_bytes and len(entries) > 1:
+            entry = entries.pop(0)
+            total -= os.path.getsize(entry)
+            os.remove(entry)
+
+    ##########################################################################
+    ## Lookups
+
+    def get(self, key):
+        # Fresh result of key, looking in memory first and then on disk. Stale entries are dropped.
+        entry = self.get_memory(key)
+        tier = 'hits'
+        if entry is None and self.disk_dir is not None:
+            entry = self.get_disk(key)
+            tier = 'disk_hits'
+        if entry is None:
+            return None
+        if not self.is_fresh(entry):
+            self.invalidate(key)
+            return None
+        if tier == 'disk_hits':
+            self.put_memory(key, entry)
+        self.count(tier)
+        return entry['frame'].copy()
+
+    def put(self, key, scope, frame, computed, seen):
+        entry = {'frame': frame, 'scope': scope, 'computed': computed, 'seen': seen, 'stored': time.time(),
+                 'nbytes': int(frame.memory_usage(deep=True).sum())}
+        self.put_memory(key, entry)
+        if self.disk_dir is not None:
+            self.put_disk(key, entry)
+
+    def load(self, name, params, scope, function, *args, **kwargs):
+        """ Result of function(*args, **kwargs), cached under the query name and its
+        normalized params. scope holds the stations and time range the query reads. """
+        key = query_key(name, params)
+        frame = self.get(key)
+        if frame is not None:
+            return frame
+        self.count('misses')
+        # Taken before the query runs, so loads logged while it runs invalidate the result
+        computed = database.utc_now().isoformat()
+        seen = self.get_seen(scope, computed)
+        frame = function(*args, **kwargs)
+        self.put(key, scope, frame, computed, seen)
+        return frame.copy()
+
+    def invalidate(self, key=None):
+        # Drop an entry, or every entry if no key is given
+        with self.lock:
+            keys = list(self.entries) if key is None else [key]
+            for k in keys:
+                self.drop_memory(k)
+        if self.disk_dir is None:
+            return
+        if key is None:
+            for entry in glob.glob(os.path.join(self.disk_dir, '*.arrow')):
+                os.remove(entry)
+        else:
+            self.drop_disk(key)
+
+
+##############################################################################
+## Cached queries of tools.database
+
+def cached_query_pollution(cache, coll='pollution_buckets', station=None, substance=None, start=None, end=None):
+    stations = get_codes(station, database.get_station_code)
+    substances = get_codes(substance, database.get_substance_code)
+    start, end = get_time(start), get_time(end)
+    params = {'coll': coll, 'station': stations, 'substance': substances, 'start': start, 'end': end}
+    return cache.load('query_pollution', params, get_scope(coll, stations, start, end), database.query_pollution,
+                      cache.db, coll, station=stations, substance=substances, start=start, end=end)
+
+def cached_read_pollution_buckets(cache, coll, station=None, magnitude=None, start=None, end=None):
+    stations = None if station is None else sorted(set(np.atleast_1d(station).tolist()))
+    magnitudes = None if magnitude is None else sorted(set(np.atleast_1d(magnitude).tolist()))
+    start, end = get_time(start), get_time(end)
+    params = {'coll': coll, 'station': stations, 'magnitude': magnitudes, 'start': start, 'end': end}
+    return cache.load('read_pollution_buckets', params, get_scope(coll, stations, start, end),
+                      database.read_pollution_buckets, cache.db, coll, station=stations, magnitude=magnitudes,
+                      start=start, end=end)
+
+def cached_pollution_statistics(cache, coll='pollution', station=None, substance=None, start=None, end=None,
+                                period='month', stats=('mean', 'max'), percentiles=None, by_day_type=False,
+                                holidays=None, engine='mongo'):
+    stations = get_codes(station, database.get_station_code)
+    substances = get_codes(substance, database.get_substance_code)
+    start, end = get_time(start), get_time(end)
+    if holidays is not None:
+        holidays = sorted(set(pd.Timestamp(day).normalize() for day in holidays))
+    # The engine gives the same result, so it is not part of the key
+    params = {'coll': coll, 'station': stations, 'substance': substances, 'start': start, 'end': end,
+              'period': period, 'stats': list(stats), 'percentiles': list(percentiles or []),
+              'by_day_type': by_day_type, 'holidays': holidays if by_day_type else None}
+    return cache.load('pollution_statistics', params, get_scope(coll, stations, start, end),
+                      database.pollution_statistics, cache.db, coll, station=stations, substance=substances,
+                      start=start, end=end, period=period, stats=stats, percentiles=percentiles,
+                      by_day_type=by_day_type, holidays=holidays, engine=engine)
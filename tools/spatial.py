@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+""" spatial.py
+
+This module contain routines for joining the traffic measure points (pmed) with the air
+quality stations: radius and k-nearest queries over a KD-tree, and a persisted
+station -> pmed mapping with distance weights.
+"""
+
+__author__ = "Alejandro de la Calle"
+__copyright__ = "Copyright 2019"
+__credits__ = [""]
+__license__ = ""
+__version__ = "0.1"
+__maintainer__ = "Alejandro de la Calle"
+__email__ = "alejandrodelacallenegro@gmail.com"
+__status__ = "Development"
+
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+
+# Distances are computed on a local plane centered on Madrid (equirectangular projection).
+# Over the extent of the city the error is far below the accuracy of the coordinates.
+earth_radius = 6371008.8
+madrid_latitude = 40.4168
+
+
+def to_local_xy(lon, lat, lat0=madrid_latitude):
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    return np.column_stack([earth_radius * lon * np.cos(np.radians(lat0)), earth_radius * lat])
+
+
+def get_pmed_points(docs, id_field='id'):
+    # Ids, longitudes and latitudes of the pmed documents with a GeoJSON location
+    docs = [doc for doc in docs if 'location' in doc]
+    ids = np.array([doc[id_field] for doc in docs])
+    coords = np.array([doc['location']['coordinates'] for doc in docs], dtype=np.float64).reshape(-1, 2)
+    return ids, coords[:, 0], coords[:, 1]
+
+
+class PointIndex(object):
+    """ KD-tree over a set of points given by their ids and lon/lat coordinates. """
+
+    def __init__(self, ids, lon, lat):
+        self.ids = np.asarray(ids)
+        self.tree = cKDTree(to_local_xy(lon, lat))
+
+    @classmethod
+    def from_pmed_documents(cls, docs, id_field='id'):
+        return cls(*get_pmed_points(docs, id_field=id_field))
+
+    def query_radius(self, lon, lat, radius):
+        # Positions and distances (in meters) of the points within radius of each query point
+        xy = to_local_xy(np.atleast_1d(lon), np.atleast_1d(lat))
+        neighbours = self.tree.query_ball_point(xy, r=radius)
+        distances = [np.hypot(*(self.tree.data[idx] - point).T) if len(idx) > 0 else np.zeros(0)
+                     for point, idx in zip(xy, neighbours)]
+        return [np.asarray(idx, dtype=np.int64) for idx in neighbours], distances
+
+    def query_nearest(self, lon, lat, k=1, max_distance=np.inf):
+        # (nqueries, k) arrays with the distances and positions of the k nearest points.
+        # Missing neighbours get an infinite distance and position len(self.ids).
+        xy = to_local_xy(np.atleast_1d(lon), np.atleast_1d(lat))
+        distances, idx = self.tree.query(xy, k=k, distance_upper_bound=max_distance)
+        return distances.reshape(len(xy), k), idx.reshape(len(xy), k)
+
+
+def build_station_mapping(stations, index, radius=None, k=None, power=1.):
+    """ Station -> pmed mapping with inverse distance weights.
+
+    stations is a dataframe with station, lon and lat columns. Pmeds are those within
+    radius meters, the k nearest, or the k nearest within radius when both are given.
+    Weights of each station are proportional to 1 / distance**power and add up to one.
+    """
+    if radius is None and k is None:
+        raise ValueError('A radius or a number of neighbours must be given')
+    lon = stations['lon'].to_numpy()
+    lat = stations['lat'].to_numpy()
+
+    if k is not None:
+        distances, idx = index.query_nearest(lon, lat, k=k, max_distance=np.inf if radius is None else radius)
+        station_idx = np.repeat(np.arange(len(stations)), k)
+        distances, idx = distances.ravel(), idx.ravel()
+        found = idx < len(index.ids)
+        station_idx, distances, idx = station_idx[found], distances[found], idx[found]
+    else:
+        idx, distances = index.query_radius(lon, lat, radius)
+        station_idx = np.repeat(np.arange(len(stations)), [len(i) for i in idx])
+        idx = np.concatenate(idx) if len(idx) > 0 else np.zeros(0, dtype=np.int64)
+        distances = np.concatenate(distances) if len(distances) > 0 else np.zeros(0)
+
+    # A pmed right on top of a station would get an infinite weight, so distances are floored at 1m
+    weights = 1. / np.maximum(distances, 1.) ** power
+    weights /= np.bincount(station_idx, weights=weights, minlength=len(stations))[station_idx]
+
+    return pd.DataFrame({'station': stations['station'].to_numpy()[station_idx], 'pmed': index.ids[idx],
+                         'distance': distances.astype(np.float32), 'weight': weights.astype(np.float32)})
+
+
+def save_station_mapping(mapping, path):
+    mapping.to_parquet(path, index=False)
+
+
+def load_station_mapping(path):
+    return pd.read_parquet(path)
+
+
+def aggregate_by_station(traffic, mapping, value_columns, pmed_column='id', by=None):
+    """ Weighted mean of traffic values of the pmeds of each station.
+
+    traffic holds one row per pmed (and per each of the columns in by, e.g. the date).
+    Readings that are NaN are left out, and the weights of the others renormalized. A
+    station with no reading of a column gets NaN.
+    """
+    by = [] if by is None else list(by)
+    value_columns = list(value_columns)
+    joined = traffic[[pmed_column] + by + value_columns].merge(
+        mapping[['station', 'pmed', 'weight']], left_on=pmed_column, right_on='pmed', how='inner')
+    values = joined[value_columns].to_numpy(dtype=np.float64)
+    weights = np.where(np.isnan(values), 0., joined['weight'].to_numpy(dtype=np.float64)[:, None])
+    keys = [joined[col] for col in ['station'] + by]
+    sums = pd.DataFrame(np.where(np.isnan(values), np.nan, values * weights), columns=value_columns,
+                        index=joined.index).groupby(keys, observed=True).sum(min_count=1)
+    totals = pd.DataFrame(weights, columns=value_columns, index=joined.index).groupby(keys, observed=True).sum()
+    return sums / totals
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+""" timeseries.py
+
+This module contain routines for reshaping the wide daily pollution frames (one row per
+station, magnitude and day, with columns H01..H24 and V01..V24) into hourly time series.
+"""
+
+__author__ = "Alejandro de la Calle"
+__copyright__ = "Copyright 2019"
+__credits__ = [""]
+__license__ = ""
+__version__ = "0.1"
+__maintainer__ = "Alejandro de la Calle"
+__email__ = "alejandrodelacallenegro@gmail.com"
+__status__ = "Development"
+
+
+import numpy as np
+import pandas as pd
+
+
+horasstr = ['H{:02d}'.format(h) for h in range(1, 25)]
+valstr = ['V{:02d}'.format(v) for v in range(1, 25)]
+
+
+def get_station_codes(df):
+    # Full station code, as in the estaciones_aire dictionary (e.g. '28079004')
+    code = (df['PROVINCIA'].astype(np.int64).to_numpy() * 1000000 +
+            df['MUNICIPIO'].astype(np.int64).to_numpy() * 1000 +
+            df['ESTACION'].astype(np.int64).to_numpy())
+    return np.char.zfill(code.astype(str), 8)
+
+
+def get_magnitude_codes(df):
+    return np.char.zfill(df['MAGNITUD'].astype(np.int64).to_numpy().astype(str), 2)
+
+
+def get_day_array(df):
+    # Days as datetime64, computed from the ANO/MES/DIA columns. The txt files have
+    # two-digit years.
+    year = df['ANO'].astype(np.int64).to_numpy()
+    year = np.where(year < 100, np.where(year < 50, 2000 + year, 1900 + year), year)
+    month = df['MES'].astype(np.int64).to_numpy()
+    day = df['DIA'].astype(np.int64).to_numpy()
+    months = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+    return months.astype('datetime64[D]') + (day - 1).astype('timedelta64[D]')
+
+
+def get_hourly_blocks(df, mask_invalid=True):
+    # (nrows, 24) arrays with the hourly values and their validity. Invalid hours are NaN
+    # if mask_invalid is set.
+    values = df[horasstr].to_numpy(dtype=np.float32)
+    valid = df[valstr].to_numpy()
+    if valid.dtype != bool:
+        # 'V' flags of raw frames, possibly mixed with booleans in documents of both kinds
+        valid = (valid == 'V') | (valid == True)
+    if mask_invalid:
+        values = np.where(valid, values, np.float32(np.nan))
+    return values, valid
+
+
+def get_hourly_times(days):
+    # Hour H01 covers from 00:00 to 01:00, and it is labelled by its start
+    return (days.astype('datetime64[h]')[:, None] + np.arange(24, dtype='timedelta64[h]')).ravel()
+
+
+def to_hourly_series(df, mask_invalid=True, dropna=False):
+    """ Long hourly series with a DatetimeIndex and station, magnitude, value and valid columns. """
+    values, valid = get_hourly_blocks(df, mask_invalid=mask_invalid)
+    times = get_hourly_times(get_day_array(df))
+
+    # Station and magnitude are repeated 24 times, so they are stored as categorical codes
+    stations, station_idx = np.unique(get_station_codes(df), return_inverse=True)
+    magnitudes, magnitude_idx = np.unique(get_magnitude_codes(df), return_inverse=True)
+
+    hourly = pd.DataFrame({'station': pd.Categorical.from_codes(np.repeat(station_idx, 24), stations),
+                           'magnitude': pd.Categorical.from_codes(np.repeat(magnitude_idx, 24), magnitudes),
+                           'value': values.ravel(), 'valid': valid.ravel()},
+                          index=pd.DatetimeIndex(times, name='date'))
+    if dropna:
+        hourly = hourly[~np.isnan(hourly['value'].to_numpy())]
+    return hourly.sort_index(kind='stable')
+
+
+def to_dense_hourly(df, mask_invalid=True, start=None, end=None):
+    """ Dense (station, magnitude) x hour array.
+
+    Returns the hourly DatetimeIndex, the list of (station, magnitude) pairs and a float32
+    array of shape (len(pairs), len(index)) with NaN on missing or invalid hours.
+    """
+    values, valid = get_hourly_blocks(df, mask_invalid=mask_invalid)
+    days = get_day_array(df)
+
+    first = np.datetime64(start, 'D') if start is not None else days.min()
+    last = np.datetime64(end, 'D') if end is not None else days.max()
+    ndays = int((last - first).astype(np.int64)) + 1
+    index = pd.date_range(pd.Timestamp(first), periods=ndays * 24, freq='h', name='date')
+
+    keys = pd.MultiIndex.from_arrays([get_station_codes(df), get_magnitude_codes(df)])
+    # Codes are as narrow as the number of levels allows, so they are widened before combining them
+    pair_codes = keys.codes[0].astype(np.int64) * len(keys.levels[1]) + keys.codes[1].astype(np.int64)
+    pairs, pair_idx = np.unique(pair_codes, return_inverse=True)
+    pairs = [(keys.levels[0][p // len(keys.levels[1])], keys.levels[1][p % len(keys.levels[1])]) for p in pairs]
+
+    # Each row of the frame fills a contiguous run of 24 hours of its pair
+    day_idx = (days - first).astype(np.int64)
+    inside = (day_idx >= 0) & (day_idx < ndays)
+    dense = np.full((len(pairs), ndays, 24), np.nan, dtype=np.float32)
+    dense[pair_idx[inside], day_idx[inside]] = values[inside]
+    return index, pairs, dense.reshape(len(pairs), ndays * 24)